@@ -1,7 +1,28 @@
 # Render a box with up to three animations
 #
-import time
+try:
+	import heapq
+except ImportError:
+	import uheapq as heapq
 from icon import Icon
+from metrics import metrics
+
+
+class IconSlot:
+	"""
+	An icon on the display
+	"""
+	__slots__ = ('icon', 'x', 'y', 'rows', 'cols', 'remaining')
+
+	def __init__(self, icon, x, y, num_frames):
+		self.icon = icon
+		self.x = x
+		self.y = y
+		self.rows = icon.rows
+		self.cols = icon.cols
+		# Number of frames left to draw before the icon is unloaded
+		self.remaining = num_frames
+
 
 class AnimationScene:
 	"""Render animations from https://developer.lametric.com"""
@@ -12,12 +33,25 @@ class AnimationScene:
 		self.intensity = 16
 		self.icons = []
 		self.icon_id = 0
-		self.states = []
-		self.on_screen_icons = []
+		# Icons on the display
+		self.slots = []
+		# Heap of (time in ms the next frame is due, sequence number, slot)
+		self.timeline = []
+		self.seq = 0
+		# Time in ms of the most recently rendered frame
+		self.now = 0
+		# Pixels between icons, see padding_for()
+		self.padding = None
+		# Frame rate requested from the render loop, defaults to the display's
+		self.fps = None
 		if not config:
 			return
 		if 'debug' in config:
 			self.debug = config['debug']
+		if 'fps' in config:
+			self.fps = config['fps']
+		if 'padding' in config:
+			self.padding = config['padding']
 		if 'intensity' in config:
 			self.intensity = int(round(config['intensity']*255))
 		if 'icons' in config:
@@ -45,45 +79,65 @@ class AnimationScene:
 		return 0  # signal that we did not handle the input
 
 	def render(self, frame, dropped_frames, fps):
-		t0 = time.time()
+		t = metrics.start()
 		display = self.display
-		intensity = self.intensity
+		# Icon frames are scheduled in milliseconds rather than in display
+		# frames, so that delays that aren't a multiple of the frame time
+		# don't add up to drift
+		now = frame * 1000 // fps
+		self.now = now
+		timeline = self.timeline
+		due_slots = []
+		while timeline and timeline[0][0] <= now:
+			due_slots.append(heapq.heappop(timeline))
 		unload_queue = []
-		for state in self.on_screen_icons:
-			if frame < state['next_frame_at']:
+		for due, seq, slot in due_slots:
+			icon = slot.icon
+			delay = icon.frame_length()
+			icon.blit(display, slot.x, slot.y)
+			slot.remaining -= 1
+			if not slot.remaining:
+				unload_queue.append(slot)
 				continue
-
-			state['remaining_frames'] -= 1
-			if state['remaining_frames'] == 0:
-				# Queue icon for removal from screen
-				unload_queue.append(state['i'])
-
-			n = state['num_frames']
-			index = n - (state['remaining_frames'] % n) - 1
-			x_pos = state['x_pos']
-			y_pos = state['y_pos']
-			icon = self.icons[state['i']]
-			# Do not repaint until some specified time in the future
-			state['next_frame_at'] = frame + int(fps * icon.frame_length() / 1000)
-			# Render icon
-			icon.blit(self.display, x_pos, y_pos)
-
-		t2 = time.time()
-		t1 = t2 - t0
+			# Keep to the exact schedule if the next frame is already due,
+			# it's drawn with the next display frame
+			due += delay
+			if due < now - 1000 // fps:
+				# Too far behind (e.g. delays shorter than a display frame),
+				# pick up from here
+				due = now + delay
+			heapq.heappush(timeline, (due, seq, slot))
+
+		metrics.stop('animation_blit_us', t)
 		display.render()
-		t3 = time.time()
-		t2 = t3 - t2
-		if self.debug:
-			print('AnimationScene: Spent {}ms plotting icons, {}ms updating LedMatrix+HAL, {}ms total'.format(round(t1*1000.0), round(t2*1000.0), round((t3-t0)*1000.0)))
 
-		for i in unload_queue:
-			self.unload_icon(i)
+		for slot in unload_queue:
+			self.unload_icon(slot)
 
-		if not self.on_screen_icons:
+		if not self.slots:
 			return False  # Nothing more to display
 
 		return True  # We still have icons left to render
 
+	def next_wakeup(self, frame, fps):
+		"""
+		Return the frame number at which the next icon frame is due
+		"""
+		if not self.timeline:
+			return frame
+		# Round up, frames are never drawn early
+		return max(frame, -(-self.timeline[0][0] * fps // 1000))
+
+	def close(self):
+		"""
+		Close all icon files, called before the scene is unloaded
+		"""
+		for icon in self.icons:
+			icon.close()
+		self.icons = []
+		self.slots = []
+		self.timeline = []
+
 	def add_icon(self, filename):
 		"""
 		See animations/README.md for details
@@ -91,71 +145,83 @@ class AnimationScene:
 		icon = Icon(filename)
 		self.icons.append(icon)
 
+	def padding_for(self, rows, cols):
+		"""
+		Spacing between icons, by default one pixel on displays with a single
+		row of icons
+		"""
+		if self.padding is not None:
+			return self.padding
+		return 1 if self.display.stride < 2*rows else 0
+
+	def find_slot(self, rows, cols):
+		"""
+		Return the position (x, y) of the first free slot for an icon of the
+		given size, or None if there's no room for it.  Slots are laid out in
+		rows of icons centered on the display.
+		"""
+		display = self.display
+		padding = self.padding_for(rows, cols)
+		per_row = (display.columns + padding) // (cols + padding)
+		num_rows = display.stride // rows
+		if not per_row or not num_rows:
+			return None
+		x0 = (display.columns - per_row*(cols + padding) + padding) // 2
+		y0 = (display.stride - num_rows*rows) // 2
+		for row in range(num_rows):
+			y = y0 + row*rows
+			for col in range(per_row):
+				x = x0 + col*(cols + padding)
+				for slot in self.slots:
+					if x < slot.x + slot.cols and slot.x < x + cols and y < slot.y + slot.rows and slot.y < y + rows:
+						break
+				else:
+					return (x, y)
+		return None
+
 	def load_icon(self):
 		"""
-		Load icon into first available slot
+		Load the next icon into the first available slot.  Returns False if
+		there's no room for it.
 		"""
-		cols = bytearray(b' ' * 32)
-		icon_width = 8
-		padding = 1 if self.display.columns == 32 else 0
-		for state in self.on_screen_icons:
-			icon_x = state['x_pos'] + (state['y_pos']<<1)
-			cols[icon_x:icon_x+icon_width] = ('x'*icon_width).encode()
-
-		x = 0
-		space = ord(' ')
-		need = icon_width+padding
-		for i in range(32):
-			if cols[i] != space:
-				x = i+1
-			elif i+1 == x+need:
+		for attempt in range(len(self.icons)):
+			icon = self.icons[self.icon_id]
+			pos = self.find_slot(icon.rows, icon.cols)
+			if pos:
 				break
-		if i+1 != x+need:
-			# no available space
-			return False
-		if not x:
-			# center for 32x8 displays
-			x += 3 if self.display.columns == 32 else 0
+			if self.slots:
+				# Wait for an icon to be unloaded
+				return False
+			# Doesn't fit on the display at all, try the next one
+			if self.debug:
+				print('Animation: icon {} does not fit on the display'.format(self.icon_id))
+			self.icon_id = (self.icon_id + 1) % len(self.icons)
 		else:
-			# left-pad next icon
-			x += padding
+			return False
 
-		icon = self.icons[self.icon_id]
 		num_frames = icon.frame_count()
-		state = {
-			'i': self.icon_id,               # for unloading the icon
-			'x_pos': x if self.display.columns == 32 else x & 0xf,
-			'y_pos': 0 if self.display.columns == 32 else (x >> 4) << 3,
-			'num_frames': num_frames,        # cached for convenience
-			'remaining_frames': num_frames,  # keep track of the currently rendered frame
-			'next_frame_at': 0               # for handling delays
-		}
-
+		slot = IconSlot(icon, pos[0], pos[1], num_frames)
 		# Ensure a minimum display time
 		t_icon = icon.length_total()
 		for i in range(1,6):
 			if t_icon*i >= 4000:
 				break
-			state['remaining_frames'] += num_frames
+			slot.remaining += num_frames
 
-		self.on_screen_icons.append(state)
+		self.slots.append(slot)
+		self.seq += 1
+		heapq.heappush(self.timeline, (self.now, self.seq, slot))
 		if self.debug:
-			print('Animation: loaded icon {} at ({}, {})'.format(self.icon_id, state['x_pos'], state['y_pos']))
+			print('Animation: loaded icon {} at ({}, {})'.format(self.icon_id, slot.x, slot.y))
 		self.icon_id = (self.icon_id + 1) % len(self.icons)
 		return True
 
-	def unload_icon(self, i):
+	def unload_icon(self, slot):
 		display = self.display
-		for state in self.on_screen_icons:
-			if state['i'] == i:
-				icon = self.icons[i]
-				height = icon.rows
-				width = icon.cols
-				x_pos = state['x_pos']
-				y_pos = state['y_pos']
-				for y in range(height):
-					for x in range(width):
-						display.put_pixel(x_pos+x, y_pos+y, 0, 0, 0)
-				self.on_screen_icons.remove(state)
-				return
-
+		icon = slot.icon
+		# The next time it's shown, draw the whole icon
+		icon.invalidate()
+		for y in range(slot.rows):
+			for x in range(slot.cols):
+				display.put_pixel(slot.x+x, slot.y+y, 0, 0, 0)
+		self.slots.remove(slot)
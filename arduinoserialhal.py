@@ -7,6 +7,7 @@
 # or under MicroPython.
 #
 import serial
+import select
 import time
 
 class ArduinoSerialHAL:
@@ -33,6 +34,21 @@ class ArduinoSerialHAL:
 		line = self.ser.readline()
 		return line
 
+	def wait_input(self, timeout_ms):
+		"""
+		Wait for data from the MCU for up to timeout_ms milliseconds.
+		Returns True if there is data to process.
+		"""
+		if self.ser.in_waiting:
+			return True
+		try:
+			readable, _, _ = select.select([self.ser], [], [], timeout_ms / 1000.0)
+		except (OSError, ValueError, TypeError):
+			# Not a file descriptor backed port (e.g. on Windows)
+			time.sleep(timeout_ms / 1000.0)
+			return bool(self.ser.in_waiting)
+		return bool(readable)
+
 	def reset(self):
 		"""
 		(Re-)open serial ports and resynchronize the protocol
@@ -0,0 +1,272 @@
+# asyncio based main loop for the host computer
+#
+# This is an alternative to the synchronous loop at the end of main.py.  It
+# runs the following as separate coroutines:
+#
+# - frame ticking, which sleeps until RenderLoop's next frame deadline
+# - input from the HAL (e.g. button presses from the MCU)
+# - network fetches for scenes implementing refresh()
+# - reloading of the config file
+#
+# Anything that might block runs in a thread pool so that the event loop is
+# always ready to tick the next frame:
+#
+# - rendering and all other calls into the display and the HAL driver that
+#   write to it are made from a single "frame" thread, which keeps the
+#   serial protocol from being interleaved.  Background jobs (see
+#   jobqueue.py) and idle time garbage collection run there too, between
+#   frames.
+# - reading input runs in its own thread.  It reads from the serial port
+#   while the frame thread writes to it, which relies on the port allowing
+#   one reader and one writer at the same time (as pyserial's does).
+# - network fetches run in their own threads
+#
+# Scenes may implement render(), reset() and refresh() as coroutines.  Such
+# scenes are wrapped with AsyncSceneAdapter so that RenderLoop can call them
+# from the frame thread.  Regular scenes are used as is.
+#
+# Enable it by setting "asyncio": true in the config file.
+#
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from timeservice import clock
+from jobqueue import jobs
+from memmanager import manager as memory
+
+# Events sent by the MCU, mapped to the button state used by RenderLoop
+EVENTS = {
+	'LEFTB_SHRT_PRESS': 0x01,
+	'LEFTB_LONG_PRESS': 0x02,
+}
+
+
+class AsyncSceneAdapter:
+	"""
+	Make a scene with coroutine methods callable from the frame thread
+	"""
+
+	def __init__(self, scene, loop):
+		self.scene = scene
+		self.loop = loop
+
+	def call(self, method, *args):
+		result = method(*args)
+		if asyncio.iscoroutine(result):
+			# Run the coroutine on the event loop and wait for its result
+			result = asyncio.run_coroutine_threadsafe(result, self.loop).result()
+		return result
+
+	def reset(self):
+		return self.call(self.scene.reset)
+
+	def render(self, frame, dropped_frames, fps):
+		return self.call(self.scene.render, frame, dropped_frames, fps)
+
+	def input(self, button_state):
+		return self.call(self.scene.input, button_state)
+
+	def set_intensity(self, value=None):
+		return self.scene.set_intensity(value)
+
+	def __getattr__(self, name):
+		# Forward anything else, e.g. next_wakeup() or refresh()
+		return getattr(self.scene, name)
+
+
+def is_async_scene(scene):
+	for name in ('render', 'reset', 'input'):
+		if asyncio.iscoroutinefunction(getattr(scene, name, None)):
+			return True
+	return False
+
+
+class AsyncRenderLoop:
+	"""
+	Drive a RenderLoop and the HAL from an asyncio event loop
+	"""
+
+	def __init__(self, render_loop, driver, config, config_file='config.json'):
+		self.r = render_loop
+		self.driver = driver
+		self.config = config
+		self.config_file = config_file
+		self.debug = False
+		self.config_reload_interval = 10
+		if 'debug' in config:
+			self.debug = config['debug']
+		if 'rtcSyncInterval' in config:
+			# The MCU's RTC is resynchronized from the frame thread, see
+			# timeservice.py
+			clock.configure({'rtcSyncInterval': config['rtcSyncInterval']})
+		if 'configReloadInterval' in config:
+			self.config_reload_interval = config['configReloadInterval']
+		self.button_state = 0
+		# Set when the frame thread asked to exit, e.g. by VirtualHAL
+		self.exit_code = None
+		self.loop = None
+		self.wakeup = None
+		# All display and driver output happens on this thread, input is
+		# read on the input thread
+		self.frame_executor = ThreadPoolExecutor(1)
+		self.input_executor = ThreadPoolExecutor(1)
+		self.network_executor = ThreadPoolExecutor(2)
+
+	def run(self):
+		asyncio.run(self.main())
+		if self.exit_code is not None:
+			raise SystemExit(self.exit_code)
+
+	async def main(self):
+		self.loop = asyncio.get_running_loop()
+		self.wakeup = asyncio.Event()
+		tasks = [self.input(), self.config_reload()]
+		for i in range(len(self.r.scenes)):
+			scene = self.r.scenes[i]
+			if hasattr(scene, 'load'):
+				# Scenes from sceneregistry.py are only loaded on first use,
+				# but what they implement is needed up front.  Scenes are
+				# never unloaded on the host computer, so this is kept.
+				scene = scene.load()
+			if hasattr(scene, 'refresh'):
+				# Fetch data in the background rather than when the scene
+				# is switched to
+				scene.background_refresh = True
+				tasks.append(self.network(scene))
+			if is_async_scene(scene):
+				self.r.scenes[i] = AsyncSceneAdapter(scene, self.loop)
+		tasks = [asyncio.ensure_future(task) for task in tasks]
+		# Everything else is stopped when frame ticking stops
+		await self.frames()
+		for task in tasks:
+			task.cancel()
+		await asyncio.gather(*tasks, return_exceptions=True)
+
+	async def frames(self):
+		"""
+		Render frames on RenderLoop's schedule
+		"""
+		r = self.r
+		while self.exit_code is None:
+			delay = r.time_to_next_frame()
+			if delay > 0 and not self.button_state:
+				stepping = jobs.jobs and r.job_us_left > 0
+				if stepping:
+					# Come back soon to step the jobs again
+					delay = min(delay, r.job_poll_us)
+				try:
+					await asyncio.wait_for(self.wakeup.wait(), delay / 1000000.0)
+				except asyncio.TimeoutError:
+					pass
+				self.wakeup.clear()
+				if stepping:
+					await self.loop.run_in_executor(self.frame_executor, self.idle)
+				continue
+			button_state = self.button_state
+			self.button_state = 0
+			await self.loop.run_in_executor(self.frame_executor, self.step, button_state)
+
+	def step(self, button_state):
+		"""
+		Handle input and render a frame, called on the frame thread
+		"""
+		try:
+			button_state = self.r.handle_input(button_state)
+			self.r.render_frame(button_state)
+		except SystemExit as e:
+			self.exit_code = e.code
+			return
+		self.idle()
+
+	def idle(self):
+		"""
+		Step background jobs and collect garbage in the time left before the
+		next frame, as the synchronous loop does, called on the frame thread
+		"""
+		r = self.r
+		r.run_jobs()
+		memory.idle(r.time_to_next_frame())
+
+	def read_input(self):
+		"""
+		Wait for and return the next line of input, called on the input thread
+		"""
+		wait_input = getattr(self.driver, 'wait_input', None)
+		if wait_input:
+			wait_input(100)
+		line = self.driver.process_input()
+		if not line:
+			if not wait_input:
+				time.sleep(0.05)
+			return None
+		if isinstance(line, bytes):
+			line = line.decode('utf-8', 'replace')
+		return line.strip()
+
+	async def input(self):
+		"""
+		Pick up button presses and log messages from the HAL
+		"""
+		while True:
+			event = await self.loop.run_in_executor(self.input_executor, self.read_input)
+			if not event:
+				continue
+			if event in EVENTS:
+				self.button_state |= EVENTS[event]
+				self.wakeup.set()
+			else:
+				print('MCU: {}'.format(event))
+
+	async def network(self, scene):
+		"""
+		Periodically let a scene fetch data, following its retry schedule
+		if it has one
+		"""
+		interval = getattr(scene, 'refresh_interval', 1800)
+		name = scene.__class__.__name__
+		while True:
+			try:
+				if asyncio.iscoroutinefunction(scene.refresh):
+					await scene.refresh()
+				else:
+					await self.loop.run_in_executor(self.network_executor, scene.refresh)
+			except Exception as e:
+				print('AsyncRenderLoop: {}.refresh() failed: {}'.format(name, e))
+			next_attempt = getattr(scene, 'next_attempt', None)
+			if next_attempt is not None:
+				# Come back when the scene wants to fetch or retry, but at
+				# least every minute in case the clock was set
+				delay = min(60, next_attempt - time.time())
+			else:
+				# Check again well before the data is considered stale
+				delay = interval / 10
+			await asyncio.sleep(max(delay, 1))
+
+	async def config_reload(self):
+		"""
+		Reload the config file when it changes and apply render loop settings
+		"""
+		try:
+			mtime = os.stat(self.config_file).st_mtime
+		except OSError:
+			mtime = None
+		while True:
+			await asyncio.sleep(self.config_reload_interval)
+			try:
+				t = os.stat(self.config_file).st_mtime
+				if t == mtime:
+					continue
+				mtime = t
+				f = open(self.config_file)
+				config = json.loads(f.read())
+				f.close()
+			except (OSError, ValueError) as e:
+				print('AsyncRenderLoop: failed to reload {}: {}'.format(self.config_file, e))
+				continue
+			print('AsyncRenderLoop: reloaded {}'.format(self.config_file))
+			self.config = config
+			if 'Time' in config:
+				clock.configure(config['Time'])
+			await self.loop.run_in_executor(self.frame_executor, self.r.reconfigure, config)
@@ -1,6 +1,6 @@
 from network import WLAN
-from machine import RTC
 from pixelfont import PixelFont
+from timeservice import clock
 
 class BootScene:
 	"""
@@ -16,7 +16,6 @@ class BootScene:
 		self.display = display
 		self.debug = False
 		self.intensity = 16
-		self.rtc = RTC()
 		self.wlan = WLAN()
 		if not config:
 			return
@@ -58,7 +57,7 @@ class BootScene:
 			if not frame:
 				dots = '?'
 			text = 'wifi{}'.format(dots)
-		elif not self.rtc.synced():
+		elif not clock.synced:
 			text = 'clock{}'.format(dots)
 		else:
 			text = 'loading'
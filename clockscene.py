@@ -5,12 +5,12 @@
 # the current time while the host computer is offline.
 #
 import time
-if not hasattr(time, 'ticks_ms'):
-	# Emulate https://docs.pycom.io/firmwareapi/micropython/utime.html
-	time.ticks_ms = lambda: int(time.time() * 1000)
+# Provides time.ticks_ms() on CPython
+import ticks
 
 # Local imports
 from pixelfont import PixelFont
+from timeservice import clock
 
 
 class ClockScene:
@@ -21,6 +21,13 @@ class ClockScene:
 		self.intensity = 16
 		self.date_was_shown = False
 		self.columns = display.columns
+		# What's on the display: the state it was drawn from, the text
+		# drawn at each position and the weekday highlighted
+		self.state = None
+		self.drawn = {}
+		self.weekday_drawn = -1
+		# Frame number at which the display needs to change next
+		self.next_change = 0
 		if not config:
 			return
 		if 'debug' in config:
@@ -29,13 +36,23 @@ class ClockScene:
 			self.intensity = int(round(config['intensity']*255))
 
 	def reset(self):
-		pass
+		self.invalidate()
+
+	def invalidate(self):
+		"""
+		Forget what was drawn, so that the next frame is drawn in full
+		"""
+		self.state = None
+		self.drawn = {}
+		self.weekday_drawn = -1
+		self.next_change = 0
 
 	def input(self, button_state):
 		if button_state & 0x22:
 			# Handle long-press on either button
 			self.button_state ^= 1
 			self.display.clear()
+			self.invalidate()
 			return button_state & ~0x22
 
 		return 0  # signal that we did not handle the button press
@@ -47,57 +64,130 @@ class ClockScene:
 				self.intensity = 16
 		return self.intensity
 
+	def next_wakeup(self, frame, fps):
+		"""
+		Return the frame number at which the display needs to change next
+		"""
+		return self.next_change
+
+	def draw_text(self, key, text, x_off, y_off):
+		"""
+		Render text like LedMatrix.render_text(), but only the characters
+		that differ from the text last drawn at the same position
+		"""
+		display = self.display
+		prev = self.drawn.get(key)
+		self.drawn[key] = text
+		if prev == text:
+			return
+		if prev is None or len(prev) != len(text):
+			display.render_text(PixelFont, text, x_off, y_off, self.intensity)
+			return
+		start = 0
+		while text[start] == prev[start]:
+			start += 1
+		end = len(text)
+		while text[end-1] == prev[end-1]:
+			end -= 1
+		for i in range(start, len(text)):
+			if display.text_shift(text, i) != display.text_shift(prev, i):
+				# Laid out differently, start over
+				start = 0
+				end = len(text)
+				break
+		# A character moved left overlaps the one before it, so it needs
+		# redrawing too
+		while end < len(text) and display.text_shift(text, end):
+			end += 1
+		display.render_text(PixelFont, text, x_off, y_off, self.intensity, start, end)
+
 	def render(self, frame, dropped_frames, fps):
 		"""
 		Render the current time and day of week
+
+		Only what changed since the previous frame is drawn, and nothing at
+		all when the display would look the same.
 		"""
 		display = self.display
 		intensity = self.intensity
 
 		# Automatically switch to showing the date for a few secs
-		tmp = fps << 6
-		tmp = ((fps << 4) + frame) % tmp
+		period = fps << 6
+		tmp = ((fps << 4) + frame) % period
+		show_date = self.button_state or tmp <= (fps<<2)
+
+		# Frames until the date is shown or hidden again
+		if self.button_state:
+			frames_left = period
+		elif show_date:
+			frames_left = (fps<<2) + 1 - tmp
+		else:
+			frames_left = period - tmp
+
+		(year, month, day, hour, minute, second, weekday, _) = clock.localtime()[:8]
+		ms_left = clock.ms_until_minute()
+		colon = True
+		if not show_date and self.columns == 32:
+			# The colon is off for 400 ms every second
+			ticks = time.ticks_ms()
+			phase = ticks % 1000
+			colon = phase >= 400
+			ms_left = min(ms_left, (1000 if colon else 400) - phase)
+		self.next_change = frame + min(frames_left, -(-ms_left * fps // 1000))
+
+		if show_date:
+			state = (True, year, month, day, weekday, intensity)
+		else:
+			state = (False, hour, minute, colon, weekday, intensity)
+		if state == self.state:
+			return True
+		if self.state:
+			if self.state[-1] != intensity:
+				self.drawn = {}
+				self.weekday_drawn = -1
+			elif self.state[0] != show_date:
+				self.drawn = {}
+		self.state = state
 
 		y_off = 1
-		(year, month, day, hour, minute, second, weekday, _) = time.localtime()[:8]
-		if not self.button_state and tmp > (fps<<2):
+		if not show_date:
 			if self.date_was_shown:
 				display.clear()
 				self.date_was_shown = False
+				self.drawn = {}
+				self.weekday_drawn = -1
 			if self.columns == 32:
 				text = '  {:02d}:{:02d}  '.format(hour, minute)
-				if (int(time.ticks_ms() // 100.0) % 10) < 4:
+				if not colon:
 					text = text.replace(':', ' ')
-				display.render_text(PixelFont, text, 2, y_off, intensity)
+				self.draw_text('time', text, 2, y_off)
 			else:
-				text = '{:02d}'.format(hour)
-				display.render_text(PixelFont, text, 4, y_off, intensity)
-				text = '{:02d}'.format(minute)
-				display.render_text(PixelFont, text, 4, y_off+8, intensity)
+				self.draw_text('hour', '{:02d}'.format(hour), 4, y_off)
+				self.draw_text('minute', '{:02d}'.format(minute), 4, y_off+8)
 		else:
 			if self.columns == 32:
 				text = '{:02d}.{:02d}.{:02d}'.format(day, month, year % 100)
-				display.render_text(PixelFont, text, 2, y_off, intensity)
+				self.draw_text('date', text, 2, y_off)
 			else:
-				text = '{:02d}{:02d}'.format(day, month)
-				display.render_text(PixelFont, text, 0, y_off, intensity)
+				self.draw_text('date', '{:02d}{:02d}'.format(day, month), 0, y_off)
 				display.put_pixel(7, y_off+PixelFont.height, intensity, intensity, intensity)
-				text = '{:04d}'.format(year)
-				display.render_text(PixelFont, text, 0, y_off+8, intensity)
+				self.draw_text('year', '{:04d}'.format(year), 0, y_off+8)
 			self.date_was_shown = True
 
-		x_off = 2 if self.columns == 32 else 1
-		lower_intensity = intensity // 3
-		for i in range(7):
-			color = intensity if i == weekday else lower_intensity
-			b = (color << 1) // 7
-			display.put_pixel(x_off, 7, color, color, b)
-			if self.columns == 32:
-				display.put_pixel(x_off+1, 7, color, color, b)
-				display.put_pixel(x_off+2, 7, color, color, b)
-				x_off += 4
-			else:
-				x_off += 2
+		if weekday != self.weekday_drawn:
+			x_off = 2 if self.columns == 32 else 1
+			lower_intensity = intensity // 3
+			for i in range(7):
+				color = intensity if i == weekday else lower_intensity
+				b = (color << 1) // 7
+				display.put_pixel(x_off, 7, color, color, b)
+				if self.columns == 32:
+					display.put_pixel(x_off+1, 7, color, color, b)
+					display.put_pixel(x_off+2, 7, color, color, b)
+					x_off += 4
+				else:
+					x_off += 2
+			self.weekday_drawn = weekday
 
 		display.render()
 		if self.button_state == 2:
@@ -15,18 +15,21 @@ class FireScene:
 		"""
 		self.display = display
 		self.intensity = 32
-		self.remaining_frames = self.display.fps<<2
-		if not config:
-			return
-		if 'intensity' in config:
-			self.intensity = int(round(config['intensity']*255))
+		# Frame rate requested from the render loop, defaults to the display's
+		self.fps = None
+		if config:
+			if 'intensity' in config:
+				self.intensity = int(round(config['intensity']*255))
+			if 'fps' in config:
+				self.fps = config['fps']
+		self.remaining_frames = (self.fps or self.display.fps)<<2
 
 	def reset(self):
 		"""
 		This method is called before transitioning to this scene.
 		Use it to (re-)initialize any state necessary for your scene.
 		"""
-		self.remaining_frames = self.display.fps<<2
+		self.remaining_frames = (self.fps or self.display.fps)<<2
 
 	def input(self, button_state):
 		"""
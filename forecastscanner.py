@@ -0,0 +1,320 @@
+# Streaming parser for SMHI forecasts (see weatherscene.py)
+#
+# Forecast responses run to hundreds of kilobytes, of which the weather scene
+# needs a few values per hour.  Rather than reading the response a byte at a
+# time, ForecastScanner reads it in chunks into a fixed buffer, finds keys in
+# it with find() and carries partial tokens over to the next chunk.  The
+# temperature, wind speed and weather symbol of the upcoming hours are stored
+# in a Timeline, and reading stops as soon as it is full.
+#
+try:
+	from uarray import array
+except ImportError:
+	from array import array
+from timeservice import days_from_civil, EPOCH
+from memmanager import manager as memory
+
+# MicroPython's bytearray may lack find()
+has_find = hasattr(bytearray, 'find')
+
+
+def parse_time(s):
+	"""
+	Convert a validTime such as b'2024-01-01T12:00:00Z' (only the hour is
+	looked at) into seconds since the epoch of time.time()
+	"""
+	s = s.decode()
+	days = days_from_civil(int(s[0:4]), int(s[5:7]), int(s[8:10]))
+	return days*86400 + int(s[11:13])*3600 - EPOCH
+
+
+class Timeline:
+	"""
+	Forecast entries in parallel arrays, allocated up front: minutes since
+	`base` (seconds since the epoch), temperature and wind speed in tenths,
+	and weather symbol
+	"""
+
+	def __init__(self, capacity=25):
+		self.capacity = capacity
+		self.base = 0
+		self.size = 0
+		self.offsets = array('h', [0] * capacity)
+		self.temperature = array('h', [0] * capacity)
+		self.wind_speed = array('h', [0] * capacity)
+		self.symbol = array('h', [0] * capacity)
+
+	def clear(self, base):
+		self.base = base - base % 3600
+		self.size = 0
+
+	def append(self, t, temperature, wind_speed, symbol):
+		"""
+		Add an entry for time t, returns False when the timeline is full
+		"""
+		i = self.size
+		if i >= self.capacity:
+			return False
+		self.offsets[i] = (t - self.base) // 60
+		self.temperature[i] = int(round(temperature*10))
+		self.wind_speed[i] = int(round(wind_speed*10))
+		self.symbol[i] = symbol
+		self.size = i + 1
+		return True
+
+	def time(self, i):
+		return self.base + self.offsets[i]*60
+
+	def end(self):
+		"""
+		Time of the last entry, or 0 if there are none
+		"""
+		if not self.size:
+			return 0
+		return self.time(self.size - 1)
+
+	def slot(self, t):
+		"""
+		Index of the entry to show at time t, which is the first one after
+		it (i.e. the forecast for the next hour), or the last one when the
+		timeline has run out.  Returns -1 if it's empty.
+		"""
+		offset = (t - self.base) // 60
+		offsets = self.offsets
+		for i in range(self.size):
+			if offsets[i] > offset:
+				return i
+		return self.size - 1
+
+	def values(self, i):
+		"""
+		Return (temperature, wind speed, weather symbol, time) of an entry
+		"""
+		return (self.temperature[i] / 10, self.wind_speed[i] / 10, self.symbol[i], self.time(i))
+
+
+class ForecastScanner:
+	"""
+	Fill a Timeline with the temperature, wind speed and weather symbol of
+	each entry in an SMHI forecast response.  The response is either read
+	in chunks into a fixed buffer by scan(), or handed over a piece at a
+	time to feed() as it arrives.
+	"""
+
+	keys = (b'"t"', b'"ws"', b'"Wsymb2"', b'"validTime"')
+
+	def __init__(self, size=512):
+		# The buffer is the 'http' arena (see memmanager.py), taken for the
+		# response being parsed by begin()
+		self.size = size
+		self.buf = None
+		self.mv = None
+		# Unconsumed data is buf[start:end]
+		self.start = 0
+		self.end = 0
+		self.f = None
+		self.eof = False
+		# Number of reads and bytes read for the most recent response
+		self.reads = 0
+		self.bytes_read = 0
+		# Parser state, see process()
+		self.timeline = None
+		self.t_start = 0
+		self.values = [None, None, None]
+		self.t = 0
+		self.state = 0
+		self.key = 0
+		# Unconsumed bytes to keep when more data is needed, -1 when done
+		self.keep = 0
+
+	def begin(self, timeline, start):
+		"""
+		Start parsing a response into the timeline, with entries from the
+		hour before `start` (seconds since the epoch) onwards
+		"""
+		# Only buf[:size] is used when the arena is larger
+		self.buf = memory.arena('http', self.size)
+		self.mv = memoryview(self.buf)
+		self.start = self.end = 0
+		self.eof = False
+		self.reads = self.bytes_read = 0
+		timeline.clear(start)
+		self.timeline = timeline
+		self.t_start = start
+		self.state = 0
+		self.keep = 0
+
+	def find(self, needle):
+		"""
+		Return the position of needle in the unconsumed data, or -1
+		"""
+		buf = self.buf
+		if has_find:
+			return buf.find(needle, self.start, self.end)
+		# Compare in place rather than searching a copy of the data
+		first = needle[0]
+		n = len(needle)
+		for i in range(self.start, self.end - n + 1):
+			if buf[i] == first:
+				j = 1
+				while j < n and buf[i + j] == needle[j]:
+					j += 1
+				if j == n:
+					return i
+		return -1
+
+	def compact(self):
+		"""
+		Move the unconsumed bytes worth keeping to the start of the buffer,
+		returns False if there's no room left for more data
+		"""
+		start = max(self.start, self.end - self.keep)
+		n = self.end - start
+		if n and start:
+			self.buf[:n] = self.mv[start:start + n]
+		self.start = 0
+		self.end = n
+		return n < self.size
+
+	def fill(self):
+		"""
+		Read the next chunk from the response.  Returns False at the end of
+		it.
+		"""
+		if self.eof or not self.compact():
+			return False
+		count = self.f.readinto(self.mv[self.end:self.size])
+		self.reads += 1
+		if not count:
+			self.eof = True
+			return False
+		self.end += count
+		self.bytes_read += count
+		return True
+
+	def feed(self, data):
+		"""
+		Parse the next piece of the response, returns False once the
+		timeline is full and no more data is needed
+		"""
+		pos = 0
+		self.reads += 1
+		self.bytes_read += len(data)
+		while self.keep >= 0 and pos < len(data):
+			if not self.compact():
+				# A token longer than the buffer
+				self.keep = -1
+				break
+			n = min(self.size - self.end, len(data) - pos)
+			self.mv[self.end:self.end + n] = data[pos:pos + n]
+			self.end += n
+			pos += n
+			self.process()
+		return self.keep >= 0
+
+	def scan(self, f, timeline, start, chunks_per_step=8):
+		"""
+		Generator yielding None every chunks_per_step chunks, which reads the
+		response from f into the timeline and returns the number of entries
+		stored
+		"""
+		self.begin(timeline, start)
+		self.f = f
+		while True:
+			if not self.fill():
+				return timeline.size
+			self.process()
+			if self.keep < 0:
+				return timeline.size
+			if self.reads % chunks_per_step == 0:
+				yield
+
+	def process(self):
+		"""
+		Parse the data in the buffer until more is needed (self.keep is set
+		to the number of unconsumed bytes to keep) or the timeline is full
+		(self.keep is set to -1)
+		"""
+		keys = self.keys
+		buf = self.buf
+		values = self.values
+		timeline = self.timeline
+		# Scanning for: 0 a validTime key, 1 its value, 2 the keys of the
+		# values, 3 the start of an array, 4 its first entry
+		state = self.state
+		key = self.key
+		keep = -1
+		while keep < 0:
+			if state == 0:
+				i = self.find(keys[3])
+				if i < 0:
+					keep = 10
+				else:
+					self.start = i + 11
+					state = 1
+			elif state == 1:
+				i = self.find(b'"')
+				if i < 0:
+					keep = 0
+				elif self.end - i <= 13:
+					keep = self.end - i
+				else:
+					self.start = i + 1
+					state = 0
+					try:
+						self.t = parse_time(bytes(buf[i+1:i+14]))
+						if self.t > self.t_start - 3600:
+							values[0] = values[1] = values[2] = None
+							state = 2
+					except ValueError:
+						pass
+			elif state == 2:
+				# Values may come in any order, pick the nearest key.  An
+				# entry lacking some of them ends at the next validTime.
+				key = -1
+				pos = -1
+				for k in range(len(keys)):
+					if k == 3 or values[k] is None:
+						i = self.find(keys[k])
+						if i >= 0 and (pos < 0 or i < pos):
+							key = k
+							pos = i
+				if key < 0:
+					keep = 10
+				elif key == 3:
+					state = 0
+				else:
+					self.start = pos + len(keys[key])
+					state = 3
+			elif state == 3:
+				i = self.find(b'[')
+				if i < 0:
+					keep = 0
+				else:
+					self.start = i + 1
+					state = 4
+			else:
+				keep = self.end - self.start
+				for i in range(self.start, self.end):
+					c = buf[i]
+					# ',', ']' or ' '
+					if c == 0x2c or c == 0x5d or c == 0x20:
+						values[key] = bytes(buf[self.start:i])
+						self.start = i + 1
+						state = 2
+						keep = -1
+						break
+				if values[0] is not None and values[1] is not None and values[2] is not None:
+					state = 0
+					try:
+						entry = (float(values[0].decode()), float(values[1].decode()), int(values[2].decode()))
+					except ValueError:
+						entry = None
+					if entry:
+						timeline.append(self.t, entry[0], entry[1], entry[2])
+					if timeline.size == timeline.capacity:
+						# Done
+						break
+		self.state = state
+		self.key = key
+		self.keep = keep
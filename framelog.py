@@ -0,0 +1,175 @@
+# Compact binary log of frames sent to a LED matrix display
+#
+# The log starts with an 8 byte header:
+#
+#   b'LMXF', version (1 byte), reserved (1 byte), number of pixels (uint16 LE)
+#
+# ..followed by one record per frame:
+#
+#   timestamp in ms relative to the start of the log (uint32 LE)
+#   number of changed pixels (uint16 LE)
+#   changed pixels, 5 bytes each: address (uint16 LE), r, g, b
+#
+# Only pixels that changed since the previous frame are stored, which keeps
+# recordings of mostly static scenes (clock, weather) very small.
+#
+# Logs are only ever appended to.  With a size cap, the log is rotated when it
+# grows beyond the cap: the current log is renamed to <filename>.1 (replacing
+# any previous one) and a new log is started.  Timestamps may go backwards
+# when a log is appended to after a restart.
+#
+try:
+	import uos as os
+except ImportError:
+	import os
+try:
+	from ustruct import pack_into, unpack_from
+except ImportError:
+	from struct import pack_into, unpack_from
+
+MAGIC = b'LMXF'
+VERSION = 1
+HEADER_SIZE = 8
+RECORD_HEADER_SIZE = 6
+PIXEL_SIZE = 5
+
+
+class FrameLogWriter:
+	"""
+	Write frames to a frame log, pixel by pixel.  With append=True an
+	existing log for the same number of pixels is added to.  With max_bytes
+	set, the log is rotated when it grows beyond that size.
+	"""
+
+	def __init__(self, filename, num_pixels, max_bytes=0, append=False):
+		self.filename = filename
+		self.num_pixels = num_pixels
+		self.max_bytes = max_bytes
+		self.f = None
+		self.size = 0
+		if append:
+			self.size = self.existing_size()
+		self.open()
+		# Changed pixels are collected here until end_frame() is called
+		self.pixels = bytearray(num_pixels*PIXEL_SIZE)
+		self.num_changed = 0
+		self.record = bytearray(RECORD_HEADER_SIZE)
+
+	def existing_size(self):
+		"""
+		Return the size of an existing log we can append to, or 0
+		"""
+		try:
+			f = open(self.filename, 'rb')
+		except OSError:
+			return 0
+		header = f.read(HEADER_SIZE)
+		f.seek(0, 2)
+		size = f.tell()
+		f.close()
+		if len(header) != HEADER_SIZE or header[0:4] != MAGIC or header[4] != VERSION:
+			return 0
+		if unpack_from('<H', header, 6)[0] != self.num_pixels:
+			return 0
+		return size
+
+	def open(self):
+		if self.size:
+			self.f = open(self.filename, 'ab')
+			return
+		self.f = open(self.filename, 'wb')
+		header = bytearray(HEADER_SIZE)
+		header[0:4] = MAGIC
+		header[4] = VERSION
+		pack_into('<H', header, 6, self.num_pixels)
+		self.f.write(header)
+		self.size = HEADER_SIZE
+
+	def rotate(self):
+		"""
+		Move the current log out of the way and start a new one
+		"""
+		self.f.close()
+		rotated = self.filename + '.1'
+		try:
+			os.remove(rotated)
+		except OSError:
+			pass
+		os.rename(self.filename, rotated)
+		self.size = 0
+		self.open()
+
+	def put_pixel(self, addr, r, g, b):
+		"""
+		Record a changed pixel in the current frame
+		"""
+		if self.num_changed == self.num_pixels:
+			return
+		offset = self.num_changed*PIXEL_SIZE
+		pack_into('<HBBB', self.pixels, offset, addr, r, g, b)
+		self.num_changed += 1
+
+	def end_frame(self, t_ms):
+		"""
+		Write the current frame to the log
+		"""
+		pack_into('<IH', self.record, 0, t_ms & 0xffffffff, self.num_changed)
+		self.f.write(self.record)
+		if self.num_changed:
+			self.f.write(memoryview(self.pixels)[:self.num_changed*PIXEL_SIZE])
+		self.size += RECORD_HEADER_SIZE + self.num_changed*PIXEL_SIZE
+		self.num_changed = 0
+		if self.max_bytes and self.size >= self.max_bytes:
+			self.rotate()
+
+	def flush(self):
+		if self.f:
+			self.f.flush()
+
+	def close(self):
+		if self.f:
+			self.f.close()
+			self.f = None
+
+
+class FrameLogReader:
+	"""
+	Iterate over the frames in a frame log
+	"""
+
+	def __init__(self, filename):
+		self.f = open(filename, 'rb')
+		header = self.f.read(HEADER_SIZE)
+		if len(header) != HEADER_SIZE or header[0:4] != MAGIC:
+			self.f.close()
+			raise ValueError('Not a frame log: {}'.format(filename))
+		if header[4] != VERSION:
+			self.f.close()
+			raise ValueError('Unsupported frame log version: {}'.format(header[4]))
+		self.num_pixels = unpack_from('<H', header, 6)[0]
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		"""
+		Return the next frame as (timestamp in ms, changed pixels) where the
+		changed pixels is a list of (address, r, g, b) tuples
+		"""
+		record = self.f.read(RECORD_HEADER_SIZE)
+		if len(record) != RECORD_HEADER_SIZE:
+			raise StopIteration
+		t_ms, num_changed = unpack_from('<IH', record, 0)
+		data = self.f.read(num_changed*PIXEL_SIZE)
+		if len(data) != num_changed*PIXEL_SIZE:
+			# Truncated log, e.g. the recording process was killed
+			raise StopIteration
+		pixels = []
+		for i in range(num_changed):
+			pixels.append(unpack_from('<HBBB', data, i*PIXEL_SIZE))
+		return (t_ms, pixels)
+
+	def close(self):
+		if self.f:
+			self.f.close()
+			self.f = None
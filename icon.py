@@ -1,24 +1,102 @@
+# Animated icons, see iconencoder.py for the file formats
+#
 try:
 	from ustruct import unpack_from
 except ImportError:
 	from struct import unpack_from
+from memmanager import manager as memory
+from iconcache import cache
+from iconatlas import open_icon
+
+FORMAT_V1 = 3
+FORMAT_V2 = 0x82
+KEY_FRAME = 0
+
+# Scaling tables by intensity, shared by all icons
+tables = {}
+has_translate = hasattr(b'', 'translate')
+
+
+def scale_table(intensity):
+	"""
+	Return a table for bytes.translate() scaling color values by
+	intensity/255
+	"""
+	table = tables.get(intensity)
+	if table is None:
+		table = tables[intensity] = bytes([(i * intensity + 127) // 255 for i in range(256)])
+	return table
+
+
+def scale(buf, table):
+	"""
+	Return the color values in buf scaled with table, leaving buf as is
+	"""
+	if has_translate:
+		return bytes(buf).translate(table)
+	# MicroPython lacks bytes.translate()
+	out = bytearray(len(buf))
+	for i in range(len(buf)):
+		out[i] = table[buf[i]]
+	return out
+
 
 class Icon:
-	def __init__(self, filename, intensity_bits=4):
-		self.f = open(filename, 'rb')
-		self.intensity_bits = intensity_bits
+	def __init__(self, filename, intensity=16):
+		# A filename or the name of an icon in the atlas
+		self.filename = filename
+		self.f = open_icon(filename)
+		self.intensity = None
+		self.table = None
 		self.frame = 0
 		chunk = bytearray(4)
 		self.f.readinto(chunk)
 		self.num_frames = chunk[0]
 		self.rows = chunk[1]
 		self.cols = chunk[2]
-		self.buf = bytearray(self.rows*self.cols*3)
+		self.format = chunk[3]
+		self.frame_size = self.rows*self.cols*3
+		# Positions in changed pixel lists are 16-bit for large icons
+		self.wide = self.rows*self.cols > 256
+		# Frames are read into a buffer shared by all icons
+		self.buf = memory.buffer('icon', self.frame_size)
 		self.delays = [0] * self.num_frames
 		chunk = self.f.read(self.num_frames*2)
 		for i in range(self.num_frames):
 			self.delays[i] = unpack_from('!h', chunk, i*2)[0]
+		if self.format == FORMAT_V2:
+			self.read_v2_header()
+		elif self.format != FORMAT_V1:
+			self.f.close()
+			raise ValueError('Unsupported icon format {} in {}'.format(self.format, filename))
 		self.frame_offset = self.f.tell()
+		# Index of the frame at the current file position
+		self.file_frame = 0
+		# Where and when the previous frame was drawn, for only drawing the
+		# pixels that changed when the next frame is drawn in the same place
+		self.last_frame = -1
+		self.last_x = -1
+		self.last_y = -1
+		self.last_generation = -1
+		# Scaled frames kept in RAM, None if the icon is too large for the
+		# cache
+		self.cached = None
+		self.set_intensity(intensity)
+
+	def read_v2_header(self):
+		"""
+		Read the palette and the frame index of a v2 icon
+		"""
+		f = self.f
+		chunk = f.read(2)
+		num_colors = chunk[0] or 256
+		self.keyframe_interval = chunk[1]
+		self.palette = f.read(num_colors*3)
+		self.scaled_palette = None
+		self.frame_index = f.read(self.num_frames*6)
+		# Palette indices of the most recently decoded frame
+		self.plane = bytearray(self.rows*self.cols)
+		self.plane_frame = -1
 
 	def frame_count(self):
 		return self.num_frames
@@ -31,37 +109,164 @@ class Icon:
 
 	def reset(self):
 		self.frame = 0
-		self.f.seek(self.frame_offset)
+		self.invalidate()
+
+	def invalidate(self):
+		"""
+		Draw the whole frame the next time, e.g. after the area covered by
+		the icon was drawn over
+		"""
+		self.last_frame = -1
 
 	def set_intensity(self, intensity):
-		if intensity >= 128:
-			self.intensity_bits = 7
-		elif intensity >= 64:
-			self.intensity_bits = 6
-		elif intensity >= 32:
-			self.intensity_bits = 5
-		elif intensity >= 16:
-			self.intensity_bits = 4
-		elif intensity >= 8:
-			self.intensity_bits = 3
-		elif intensity >= 4:
-			self.intensity_bits = 2
-		elif intensity >= 2:
-			self.intensity_bits = 1
+		"""
+		Set the intensity (0-255) frames are rendered with
+		"""
+		intensity = max(0, min(255, intensity))
+		if intensity == self.intensity:
+			return
+		self.intensity = intensity
+		self.table = scale_table(intensity)
+		if self.format == FORMAT_V2:
+			self.scaled_palette = scale(self.palette, self.table)
+		# Frames are cached as scaled for a given intensity
+		key = '{}@{}'.format(self.filename, intensity)
+		self.cached = cache.lookup(key, self.num_frames, self.frame_size)
+		self.invalidate()
 
-	def blit(self, display, x, y):
+	def open(self):
+		if not self.f:
+			# The file was closed when all frames had been cached
+			self.f = open_icon(self.filename)
+			self.file_frame = -1
+
+	def read_frame(self, index):
+		"""
+		Read a frame from a v1 icon file into the frame buffer
+		"""
+		self.open()
+		if self.file_frame != index:
+			self.f.seek(self.frame_offset + index*self.frame_size)
 		self.f.readinto(self.buf)
-		bits_to_drop = 8 - self.intensity_bits
+		self.file_frame = index + 1
+
+	def decode_frame(self, index):
+		"""
+		Decode a frame of a v2 icon into the index plane.  Returns the
+		positions that changed since the previous frame, or None if that
+		frame wasn't the one decoded last.
+		"""
+		if self.plane_frame == (index or self.num_frames) - 1:
+			return self.apply_record(index, bytearray())
+		# Roll forward from the nearest key frame
+		for i in range(index - index % self.keyframe_interval, index + 1):
+			self.apply_record(i, None)
+		return None
+
+	def apply_record(self, index, changed):
+		"""
+		Apply a frame record to the index plane and add the positions of
+		changed pixels to changed, unless it's None
+		"""
+		offset, length = unpack_from('!IH', self.frame_index, index*6)
+		self.open()
+		self.f.seek(self.frame_offset + offset)
+		self.file_frame = -1
+		record = self.f.read(length)
+		plane = self.plane
+		wide = self.wide
+		if record[0] == KEY_FRAME:
+			p = 0
+			for i in range(1, length, 2):
+				value = record[i+1]
+				for j in range(p, p + record[i]):
+					if changed is not None and plane[j] != value:
+						if wide:
+							changed.append(j >> 8)
+						changed.append(j & 0xff)
+					plane[j] = value
+				p += record[i]
+		else:
+			count = unpack_from('!H', record, 1)[0]
+			i = 3
+			for n in range(count):
+				if wide:
+					if changed is not None:
+						changed.append(record[i])
+					p = (record[i] << 8) | record[i+1]
+					i += 1
+				else:
+					p = record[i]
+				if changed is not None:
+					changed.append(record[i])
+				plane[p] = record[i+1]
+				i += 2
+		self.plane_frame = index
+		return changed
+
+	def render_plane(self):
+		"""
+		Turn the index plane into scaled RGB data
+		"""
 		buf = self.buf
-		for i in range(len(self.buf)):
-			buf[i] >>= bits_to_drop
-		display.render_block(self.buf, self.rows, self.cols, x, y)
+		plane = self.plane
+		palette = self.scaled_palette
+		for p in range(len(plane)):
+			i = plane[p]*3
+			j = p*3
+			buf[j] = palette[i]
+			buf[j+1] = palette[i+1]
+			buf[j+2] = palette[i+2]
+		return bytes(buf)
+
+	def load_frame(self, index):
+		"""
+		Return a frame as (scaled RGB data, positions of the pixels changed
+		since the previous frame or None)
+		"""
+		if self.format == FORMAT_V2:
+			changed = self.decode_frame(index)
+			if changed is not None:
+				changed = bytes(changed)
+			return (self.render_plane(), changed)
+		# Scale the frame once and keep it around for the next time
+		self.read_frame(index)
+		return (scale(self.buf, self.table), None)
+
+	def blit(self, display, x, y):
+		frame = None
+		if self.cached:
+			frame = cache.get(self.cached, self.frame)
+		if frame is None:
+			frame = self.load_frame(self.frame)
+			if self.cached:
+				size = len(frame[0])
+				if frame[1]:
+					size += len(frame[1])
+				cache.put(self.cached, self.frame, frame, self.num_frames, self.frame_size, size)
+				if cache.complete(self.cached) and self.f:
+					# Everything is in RAM, don't hold on to the file
+					self.f.close()
+					self.f = None
+		data, changed = frame
+		prev = (self.frame or self.num_frames) - 1
+		if changed is not None and self.last_frame == prev and self.last_x == x and self.last_y == y and self.last_generation == display.generation:
+			# Only draw the pixels that changed since the previous frame
+			display.render_block_changes(data, self.cols, x, y, changed, self.wide)
+		else:
+			display.render_block(data, self.rows, self.cols, x, y)
+		self.last_frame = self.frame
+		self.last_x = x
+		self.last_y = y
+		self.last_generation = display.generation
 		self.frame += 1
 		if self.frame == self.num_frames:
-			self.reset()
+			self.frame = 0
 
 	def close(self):
 		"""
 		MicroPython do not call __del__ so we need a manual destructor
 		"""
-		self.f.close()
+		if self.f:
+			self.f.close()
+			self.f = None
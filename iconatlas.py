@@ -0,0 +1,200 @@
+# Icon atlas: many icons bundled in a single file
+#
+# Rather than opening a file per icon, icons are read from one atlas file
+# created by scripts/pack-icons.py.  On the host computer the atlas is mapped
+# into memory with mmap, while MCUs share a single file handle among all
+# icons and seek to wherever the icon being read is stored.
+#
+# The atlas starts with a header and an index of the icons:
+#
+#   b'LMIA', version (uint8), reserved (uint8), number of icons (uint16 BE)
+#
+# ..followed by one index entry per icon:
+#
+#   name length (uint8), name (UTF-8)
+#   offset of the icon from the start of the atlas (uint32 BE)
+#   size of the icon (uint32 BE)
+#   number of frames (uint8), rows (uint8), columns (uint8), format (uint8)
+#   frame delays in ms (int16 BE, one per frame)
+#
+# The icons themselves are stored as they would be in separate files (see
+# iconencoder.py).  Icons are named after their files without the directory
+# and the .bin suffix, e.g. "game-tetris" or "sunny".
+#
+# Enable it by adding "iconAtlas": "icons.atlas" to the config file.
+#
+try:
+	from ustruct import unpack_from
+except ImportError:
+	from struct import unpack_from
+
+MAGIC = b'LMIA'
+VERSION = 1
+HEADER_SIZE = 8
+
+
+class AtlasEntry:
+	def __init__(self, offset, size, num_frames, rows, cols, fmt, delays):
+		self.offset = offset
+		self.size = size
+		self.num_frames = num_frames
+		self.rows = rows
+		self.cols = cols
+		self.format = fmt
+		self.delays = delays
+
+
+class AtlasIcon:
+	"""
+	File-like view of an icon in the atlas
+	"""
+
+	def __init__(self, atlas, entry):
+		self.atlas = atlas
+		self.entry = entry
+		self.pos = 0
+
+	def seek(self, pos, whence=0):
+		if whence == 1:
+			pos += self.pos
+		elif whence == 2:
+			pos += self.entry.size
+		self.pos = pos
+		return pos
+
+	def tell(self):
+		return self.pos
+
+	def read(self, n=-1):
+		if n < 0 or self.pos + n > self.entry.size:
+			n = max(0, self.entry.size - self.pos)
+		data = self.atlas.read_at(self.entry.offset + self.pos, n)
+		self.pos += len(data)
+		return data
+
+	def readinto(self, buf):
+		n = min(len(buf), self.entry.size - self.pos)
+		n = self.atlas.readinto_at(self.entry.offset + self.pos, buf, n)
+		self.pos += n
+		return n
+
+	def close(self):
+		pass
+
+
+class Atlas:
+	"""
+	Index of the icons in an atlas and access to their data
+	"""
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.f = open(filename, 'rb')
+		self.mmap = None
+		self.map = None
+		# Position of the shared file handle, to avoid needless seeks
+		self.pos = 0
+		self.entries = {}
+		header = self.f.read(HEADER_SIZE)
+		if len(header) != HEADER_SIZE or header[0:4] != MAGIC or header[4] != VERSION:
+			self.f.close()
+			raise ValueError('Not an icon atlas: {}'.format(filename))
+		count = unpack_from('!H', header, 6)[0]
+		for i in range(count):
+			name = self.f.read(self.f.read(1)[0]).decode()
+			chunk = self.f.read(12)
+			offset, size = unpack_from('!II', chunk, 0)
+			num_frames, rows, cols, fmt = chunk[8], chunk[9], chunk[10], chunk[11]
+			chunk = self.f.read(num_frames*2)
+			delays = [unpack_from('!h', chunk, j*2)[0] for j in range(num_frames)]
+			self.entries[name] = AtlasEntry(offset, size, num_frames, rows, cols, fmt, delays)
+		self.pos = self.f.tell()
+		try:
+			import mmap
+			self.mmap = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+			self.map = memoryview(self.mmap)
+		except (ImportError, AttributeError, OSError, ValueError):
+			# MicroPython, read through the shared file handle instead
+			self.map = None
+
+	def __contains__(self, name):
+		return name in self.entries
+
+	def names(self):
+		return list(self.entries.keys())
+
+	def open(self, name):
+		return AtlasIcon(self, self.entries[name])
+
+	def read_at(self, offset, n):
+		if self.map is not None:
+			return bytes(self.map[offset:offset+n])
+		if self.pos != offset:
+			self.f.seek(offset)
+		data = self.f.read(n)
+		self.pos = offset + len(data)
+		return data
+
+	def readinto_at(self, offset, buf, n):
+		if self.map is not None:
+			buf[0:n] = self.map[offset:offset+n]
+			return n
+		if self.pos != offset:
+			self.f.seek(offset)
+		if n != len(buf):
+			buf = memoryview(buf)[0:n]
+		n = self.f.readinto(buf)
+		self.pos = offset + n
+		return n
+
+	def close(self):
+		if self.map is not None:
+			self.map.release()
+			self.map = None
+			self.mmap.close()
+			self.mmap = None
+		self.f.close()
+
+
+# Atlas loaded by main.py, if any
+atlas = None
+
+
+def load(filename):
+	"""
+	Use the icons in the given atlas
+	"""
+	global atlas
+	try:
+		atlas = Atlas(filename)
+	except (OSError, ValueError) as e:
+		print('IconAtlas: failed to load {}: {}'.format(filename, e))
+		atlas = None
+	return atlas
+
+
+def icon_name(filename):
+	"""
+	Name of an icon in the atlas, e.g. "sunny" for "weather/sunny.bin"
+	"""
+	name = filename.split('/')[-1]
+	if name.endswith('.bin'):
+		name = name[:-4]
+	return name
+
+
+def open_icon(name):
+	"""
+	Open an icon by name, from the atlas if it's in there and otherwise
+	from a file.  Icons can be given by name (e.g. "game-tetris", read
+	from icons/game-tetris.bin without an atlas) or by filename.
+	"""
+	if atlas:
+		if name in atlas:
+			return atlas.open(name)
+		key = icon_name(name)
+		if key in atlas:
+			return atlas.open(key)
+	if not name.endswith('.bin') and '/' not in name:
+		name = 'icons/{}.bin'.format(name)
+	return open(name, 'rb')
@@ -0,0 +1,159 @@
+# In-memory cache of icon frames
+#
+# Animated icons are replayed over and over, and reading every frame from
+# flash (or disk) each time it's shown is slow.  This cache keeps frames read
+# by icon.py in RAM, up to a byte budget shared by all icons.  When the budget
+# is exceeded, the frames of the least recently used icons are dropped.
+#
+# Frames are cached under a key given by the icon, e.g. its file name and the
+# intensity the frames were scaled for.  An icon's entry is created when its
+# first frame is cached and deleted when it's evicted, so that keys which
+# are no longer used (e.g. after an intensity change) don't pile up.
+#
+# Icons larger than maxIconBytes are never cached and are streamed from their
+# files instead.  Configure it with an optional block in the config file:
+#
+#   "IconCache": {"budget": 16384, "maxIconBytes": 8192}
+#
+# A budget of 0 disables the cache.
+#
+from metrics import metrics
+
+
+class CachedIcon:
+	"""
+	Frames of an icon file, indexed by frame number
+	"""
+
+	def __init__(self, num_frames, frame_size):
+		self.frames = [None] * num_frames
+		self.frame_size = frame_size
+		# Number of frames in self.frames and their size in bytes
+		self.count = 0
+		self.size = 0
+		# For picking icons to evict, least recently used first
+		self.last_used = 0
+
+	def complete(self):
+		return self.count == len(self.frames)
+
+
+class IconCache:
+	"""
+	Byte-budget LRU cache of icon frames
+	"""
+
+	def __init__(self, budget=16384, max_icon_bytes=8192):
+		self.budget = budget
+		self.max_icon_bytes = max_icon_bytes
+		self.used = 0
+		self.icons = {}
+		self.ticks = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def configure(self, config):
+		"""
+		Apply settings from the "IconCache" block in the config file
+		"""
+		if not config:
+			return
+		if 'budget' in config:
+			self.budget = config['budget']
+		if 'maxIconBytes' in config:
+			self.max_icon_bytes = config['maxIconBytes']
+		self.max_icon_bytes = min(self.max_icon_bytes, self.budget)
+		self.evict(0)
+
+	def lookup(self, key, num_frames, frame_size):
+		"""
+		Return the key to cache an icon's frames under, or None if the icon
+		is too large to be cached
+		"""
+		if num_frames * frame_size > self.max_icon_bytes:
+			return None
+		entry = self.icons.get(key)
+		if entry and (entry.frame_size != frame_size or len(entry.frames) != num_frames):
+			# The file was replaced
+			self.drop(key)
+		return key
+
+	def get(self, key, index):
+		"""
+		Return a cached frame or None
+		"""
+		entry = self.icons.get(key)
+		frame = None
+		if entry:
+			frame = entry.frames[index]
+			self.ticks += 1
+			entry.last_used = self.ticks
+		if frame is None:
+			self.misses += 1
+			metrics.incr('icon_cache_misses')
+		else:
+			self.hits += 1
+			metrics.incr('icon_cache_hits')
+		return frame
+
+	def put(self, key, index, data, num_frames, frame_size, size=None):
+		"""
+		Add frame `index` of an icon with num_frames frames of frame_size
+		bytes, taking up size bytes (by default len(data)), to the cache,
+		evicting other icons as needed
+		"""
+		entry = self.icons.get(key)
+		if entry and entry.frames[index] is not None:
+			return
+		if size is None:
+			size = len(data)
+		self.evict(size, key)
+		if self.used + size > self.budget:
+			return
+		if entry is None:
+			entry = self.icons[key] = CachedIcon(num_frames, frame_size)
+		entry.frames[index] = data
+		entry.count += 1
+		entry.size += size
+		self.used += size
+
+	def complete(self, key):
+		"""
+		Return True if all frames of an icon are cached
+		"""
+		entry = self.icons.get(key)
+		return entry is not None and entry.complete()
+
+	def evict(self, size, keep=None):
+		"""
+		Drop least recently used icons until there's room for size more bytes.
+		The icon cached under `keep` is never evicted.
+		"""
+		while self.used + size > self.budget:
+			victim = None
+			for key in self.icons:
+				if key == keep:
+					continue
+				if victim is None or self.icons[key].last_used < self.icons[victim].last_used:
+					victim = key
+			if victim is None:
+				break
+			self.drop(victim)
+			self.evictions += 1
+			metrics.incr('icon_cache_evictions')
+
+	def drop(self, key):
+		"""
+		Free the cached frames of an icon and forget about it
+		"""
+		entry = self.icons.pop(key)
+		self.used -= entry.size
+
+	def clear(self):
+		self.icons = {}
+		self.used = 0
+
+
+# Shared instance, configured by main.py
+cache = IconCache()
@@ -0,0 +1,220 @@
+# Encoders for the icon formats read by icon.py (host computer only)
+#
+# Both formats start with a 4 byte header followed by the frame delays:
+#
+#   number of frames (uint8), rows (uint8), columns (uint8), format (uint8)
+#   frame delays in ms (int16 BE, one per frame)
+#
+# Format byte 3 (v1): every frame is stored as raw 8-bit RGB, rows*cols*3
+# bytes per frame.
+#
+# Format byte 0x82 (v2): colors are stored once in a palette and frames as
+# palette indices, either as run-length encoded key frames or as delta frames
+# with the pixels that changed since the previous frame:
+#
+#   palette size (uint8, 0 means 256)
+#   key frame interval (uint8), every n:th frame (starting with the first
+#     one) is a key frame
+#   palette, 3 bytes (RGB) per entry
+#   frame index, per frame: offset from the start of the frame data (uint32
+#     BE) and length (uint16 BE)
+#   frame data
+#
+# Each frame starts with its type (uint8):
+#
+#   0: key frame, (run length (uint8, 1-255), palette index (uint8)) pairs
+#      covering all rows*cols pixels, row by row
+#   1: delta frame, number of changed pixels (uint16 BE) followed by
+#      (position (uint8, or uint16 BE for icons with more than 256 pixels),
+#      palette index (uint8)) pairs
+#
+# Icons with more than 256 colors can only be stored in the v1 format.
+#
+# Icon atlases (see iconatlas.py) are also created here.
+#
+import json
+import struct
+
+FORMAT_V1 = 3
+FORMAT_V2 = 0x82
+KEY_FRAME = 0
+DELTA_FRAME = 1
+ATLAS_MAGIC = b'LMIA'
+ATLAS_VERSION = 1
+ATLAS_HEADER_SIZE = 8
+
+
+def header(num_frames, rows, cols, fmt, delays):
+	return struct.pack('BBBB', num_frames, rows, cols, fmt) + struct.pack('!{}h'.format(num_frames), *delays)
+
+
+def lametric_frames(text):
+	"""
+	Return (frames, rows, cols, delays) from a LaMetric icon (JSON)
+	"""
+	obj = json.loads(text)
+	obj = json.loads(obj['body'])
+	delays = obj['delays']
+	icons = obj['icons']
+	rows = len(icons[0])
+	cols = len(icons[0][0])
+	if min(len(icons[0][0][0]), 3) != 3:
+		raise ValueError('Number of colors must be 3')
+	frames = []
+	for icon in icons:
+		frames.append(bytes([int(255*column[color]) for row in icon for column in row for color in range(3)]))
+	return frames, rows, cols, delays
+
+
+def merge_frames(frames, delays):
+	"""
+	Merge identical consecutive frames into one, showing it for the sum of
+	their delays
+	"""
+	out_frames = []
+	out_delays = []
+	for i in range(len(frames)):
+		# Delays are stored as int16
+		if out_frames and frames[i] == out_frames[-1] and out_delays[-1] + delays[i] <= 32767:
+			out_delays[-1] += delays[i]
+		else:
+			out_frames.append(frames[i])
+			out_delays.append(delays[i])
+	return out_frames, out_delays
+
+
+def encode_v1(frames, rows, cols, delays):
+	"""
+	Encode frames of raw RGB data in the v1 format
+	"""
+	return header(len(frames), rows, cols, FORMAT_V1, delays) + b''.join(bytes(frame) for frame in frames)
+
+
+def palette_of(frames):
+	"""
+	Return the palette (list of RGB tuples) and the frames as index planes,
+	or None if there are more than 256 colors
+	"""
+	palette = []
+	lookup = {}
+	planes = []
+	for frame in frames:
+		plane = bytearray(len(frame) // 3)
+		for p in range(len(plane)):
+			color = (frame[p*3], frame[p*3+1], frame[p*3+2])
+			index = lookup.get(color)
+			if index is None:
+				if len(palette) == 256:
+					return None
+				index = lookup[color] = len(palette)
+				palette.append(color)
+			plane[p] = index
+		planes.append(plane)
+	return palette, planes
+
+
+def encode_key_frame(plane):
+	out = bytearray([KEY_FRAME])
+	p = 0
+	while p < len(plane):
+		index = plane[p]
+		run = 1
+		while p + run < len(plane) and run < 255 and plane[p + run] == index:
+			run += 1
+		out.append(run)
+		out.append(index)
+		p += run
+	return out
+
+
+def encode_delta_frame(plane, prev):
+	changed = [p for p in range(len(plane)) if plane[p] != prev[p]]
+	out = bytearray([DELTA_FRAME])
+	out += struct.pack('!H', len(changed))
+	wide = len(plane) > 256
+	for p in changed:
+		if wide:
+			out += struct.pack('!H', p)
+		else:
+			out.append(p)
+		out.append(plane[p])
+	return out
+
+
+def encode_v2(frames, rows, cols, delays, keyframe_interval=8):
+	"""
+	Encode frames of raw RGB data in the v2 format, or return None if they
+	have too many colors
+	"""
+	result = palette_of(frames)
+	if result is None:
+		return None
+	palette, planes = result
+	keyframe_interval = max(1, min(255, keyframe_interval))
+	records = []
+	for i in range(len(planes)):
+		key = encode_key_frame(planes[i])
+		if i % keyframe_interval:
+			delta = encode_delta_frame(planes[i], planes[i-1])
+			if len(delta) < len(key):
+				key = delta
+		records.append(key)
+
+	out = bytearray(header(len(frames), rows, cols, FORMAT_V2, delays))
+	out.append(len(palette) & 0xff)
+	out.append(keyframe_interval)
+	for color in palette:
+		out.extend(color)
+	offset = 0
+	for record in records:
+		out += struct.pack('!IH', offset, len(record))
+		offset += len(record)
+	for record in records:
+		out += record
+	return bytes(out)
+
+
+def decode_v1(data):
+	"""
+	Return (frames, rows, cols, delays) from a v1 icon
+	"""
+	num_frames, rows, cols, fmt = struct.unpack_from('BBBB', data, 0)
+	if fmt != FORMAT_V1:
+		raise ValueError('Not a v1 icon')
+	delays = list(struct.unpack_from('!{}h'.format(num_frames), data, 4))
+	offset = 4 + num_frames*2
+	size = rows*cols*3
+	frames = [data[offset + i*size:offset + (i+1)*size] for i in range(num_frames)]
+	return frames, rows, cols, delays
+
+
+def encode_atlas(icons):
+	"""
+	Encode (name, icon data) pairs as an atlas.  Identical icons are only
+	stored once, with their index entries pointing at the same data.
+	"""
+	# The index goes first, so its size is needed to know the icon offsets
+	index_size = 0
+	for name, data in icons:
+		index_size += 1 + len(name.encode('utf-8')) + 12 + data[0]*2
+	offset = ATLAS_HEADER_SIZE + index_size
+	offsets = {}
+	blobs = []
+	index = bytearray()
+	for name, data in icons:
+		data = bytes(data)
+		if data not in offsets:
+			offsets[data] = offset
+			blobs.append(data)
+			offset += len(data)
+		encoded = name.encode('utf-8')
+		index.append(len(encoded))
+		index += encoded
+		index += struct.pack('!II', offsets[data], len(data))
+		index += data[0:4 + data[0]*2]
+	out = bytearray(ATLAS_MAGIC)
+	out += struct.pack('!BBH', ATLAS_VERSION, 0, len(icons))
+	out += index
+	for data in blobs:
+		out += data
+	return bytes(out)
@@ -0,0 +1,66 @@
+# Background jobs stepped by the render loop in the time to spare
+#
+# On MCUs without threads, slow work such as fetching the weather forecast
+# is split into small steps by making it a generator.  The render loop runs
+# queued jobs while it waits for the next frame, within a per-frame budget,
+# so that they only use time the scenes don't need.  A job yields True when
+# it made progress and could take another step right away, and anything
+# else when it's waiting (e.g. for the network).
+#
+import time
+from ticks import ticks_diff
+
+
+class JobQueue:
+	"""
+	Generators stepped round-robin until they're exhausted
+	"""
+
+	def __init__(self):
+		self.jobs = []
+		self.next = 0
+
+	def add(self, job):
+		self.jobs.append(job)
+
+	def active(self, job):
+		return job in self.jobs
+
+	def remove(self, job):
+		if job in self.jobs:
+			self.jobs.remove(job)
+
+	def run(self, budget_us):
+		"""
+		Step jobs until they're all waiting or budget_us has passed.  Every
+		job is stepped at least once.  Returns True if jobs remain.
+		"""
+		jobs = self.jobs
+		t0 = time.ticks_us()
+		stepped = 0
+		idle = 0
+		while jobs and idle < len(jobs):
+			if self.next >= len(jobs):
+				self.next = 0
+			job = jobs[self.next]
+			try:
+				progress = next(job)
+				self.next += 1
+			except StopIteration:
+				jobs.pop(self.next)
+				continue
+			except Exception as e:
+				print('JobQueue: job failed: {}'.format(e))
+				jobs.pop(self.next)
+				continue
+			stepped += 1
+			if progress is True:
+				idle = 0
+			else:
+				idle += 1
+			if stepped >= len(jobs) and ticks_diff(time.ticks_us(), t0) >= budget_us:
+				break
+		return len(jobs) > 0
+
+
+jobs = JobQueue()
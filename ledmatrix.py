@@ -9,9 +9,12 @@
 # e.g. a driver that implements a serial protocol running on an MCU.
 #
 import time
-if not hasattr(time, 'ticks_ms'):
-	# Emulate https://docs.pycom.io/firmwareapi/micropython/utime.html
-	time.ticks_ms = lambda: int(time.time()*1000)
+from ticks import ticks_diff
+try:
+	from uarray import array
+except ImportError:
+	from array import array
+from metrics import metrics
 
 class LedMatrix:
 	def __init__(self, driver, config):
@@ -24,6 +27,9 @@ class LedMatrix:
 		self.fix_r = 0xff
 		self.fix_g = 0xff
 		self.fix_b = 0xc0
+		# Frame log to record rendered frames to, see framelog.py
+		self.record = None
+		self.record_max_bytes = 1<<20
 		if config:
 			if 'debug' in config:
 				self.debug = config['debug']
@@ -35,6 +41,10 @@ class LedMatrix:
 				self.rotation = (360 + config['rotation']) % 360
 			if 'fps' in config:
 				self.fps = config['fps']
+			if 'record' in config:
+				self.record = config['record']
+			if 'recordMaxBytes' in config:
+				self.record_max_bytes = config['recordMaxBytes']
 		self.num_pixels = self.stride * self.columns
 		# For avoiding multiplications and divisions
 		self.num_modified_pixels = self.num_pixels  # optimization: avoid rendering too many pixels
@@ -44,6 +54,23 @@ class LedMatrix:
 			bytearray(self.num_pixels*3),
 		]
 		self.fb_index = 0
+		# Bumped whenever the frame buffer is cleared or transitioned, which
+		# tells e.g. icons that they need to redraw all their pixels
+		self.generation = 0
+		# Addresses of the pixels changed in the frame being rendered
+		self.changed = array('H', [0] * self.num_pixels)
+		# Set when a pixel in the to-be-displayed frame buffer is changed
+		self.dirty = True
+		# Counters for frames pushed to and frames skipped by render() as well
+		# as the number of pixels handed to the driver
+		self.frames_rendered = 0
+		self.frames_skipped = 0
+		self.pixels_sent = 0
+		self.recorder = None
+		if self.record:
+			from framelog import FrameLogWriter
+			self.recorder = FrameLogWriter(self.record, self.num_pixels, self.record_max_bytes, True)
+			self.t_record = time.ticks_ms()
 		# Initialize display
 		self.driver.init_display(self.num_pixels)
 
@@ -105,9 +132,17 @@ class LedMatrix:
 			return
 		pixel = self.xy_to_phys(x, y)
 		offset = pixel*3
-		self.fb[self.fb_index][offset+0] = int(r)
-		self.fb[self.fb_index][offset+1] = int(g)
-		self.fb[self.fb_index][offset+2] = int(b)
+		fb = self.fb[self.fb_index]
+		r = int(r)
+		g = int(g)
+		b = int(b)
+		if fb[offset] == r and fb[offset+1] == g and fb[offset+2] == b:
+			# Optimization: don't mark the frame as modified if nothing changed
+			return
+		fb[offset] = r
+		fb[offset+1] = g
+		fb[offset+2] = b
+		self.dirty = True
 		# Optimization: keep track of last updated pixel
 		if pixel >= self.num_modified_pixels:
 			self.num_modified_pixels = pixel+1
@@ -120,6 +155,8 @@ class LedMatrix:
 		for i in range(self.num_pixels*3):
 			buf[i] = 0
 		self.num_modified_pixels = self.num_pixels
+		self.dirty = True
+		self.generation += 1
 
 	def render_block(self, data, rows, cols, x, y):
 		"""
@@ -133,11 +170,48 @@ class LedMatrix:
 				self.put_pixel(x+col, y+row, data[offset], data[offset+1], data[offset+2])
 				offset += 3
 
-	def render_text(self, font, text, x_off, y_off, intensity=32):
+	def render_block_changes(self, data, cols, x, y, changed, wide=False):
+		"""
+		Put the pixels at the given positions (row*cols+col, one byte each
+		or two bytes big endian with wide) of a block of data at (x,y)
+		"""
+		step = 2 if wide else 1
+		for i in range(0, len(changed), step):
+			if wide:
+				p = (changed[i] << 8) | changed[i+1]
+			else:
+				p = changed[i]
+			offset = p*3
+			self.put_pixel(x + p % cols, y + p // cols, data[offset], data[offset+1], data[offset+2])
+
+	def put_frame(self, data=None):
+		"""
+		Replace the to-be-displayed frame buffer with a whole frame laid out
+		in physical order (see xy_to_phys()).  Without data, the caller wrote
+		the frame into self.fb[self.fb_index] itself.
+		"""
+		if data is not None:
+			self.fb[self.fb_index][:] = data
+		self.num_modified_pixels = self.num_pixels
+		self.dirty = True
+		self.generation += 1
+
+	def text_shift(self, text, i):
+		"""
+		Return True if render_text() moves character i of text one column
+		left, as it does with punctuation and the character following it
+		"""
+		return text[i] in '.:-\' ' or (i and text[i-1] in '.: ')
+
+	def render_text(self, font, text, x_off, y_off, intensity=32, start=0, end=None):
 		"""
 		Render text with the pixel font
+
+		With start and end, only text[start:end] is drawn, at the columns it
+		has in the whole text
 		"""
-		put_pixel_fn = self.put_pixel
+		if end is None:
+			end = len(text)
 		w = font.width
 		h = font.height
 		alphabet = font.alphabet
@@ -148,10 +222,13 @@ class LedMatrix:
 		low_r = in_r >> 1
 		low_g = in_g >> 1
 		low_b = in_b >> 1
-		for i in range(len(text)):
+		for i in range(end):
 			digit = text[i]
-			if digit in '.:-\' ' or (i and text[i-1] in '.: '):
+			if self.text_shift(text, i):
 				x_off -= 1
+			if i < start:
+				x_off += w
+				continue
 			data_offset = alphabet.find(digit)
 			if data_offset < 0:
 				data_offset = 0
@@ -161,65 +238,116 @@ class LedMatrix:
 			for row in range(h):
 				for col in range(w):
 					if font_data[font_byte] & (1<<font_bit):
-						put_pixel_fn(x_off+col, y_off+row, in_r, in_g, in_b)
+						self.put_pixel(x_off+col, y_off+row, in_r, in_g, in_b)
 					else:
-						put_pixel_fn(x_off+col, y_off+row, 0, 0, 0)
+						self.put_pixel(x_off+col, y_off+row, 0, 0, 0)
 					font_bit += 1
 					if font_bit == 8:
 						font_byte += 1
 						font_bit = 0
 			if digit == 'm':
-				put_pixel_fn(x_off+1, y_off+1, low_r, low_g, low_b)
+				self.put_pixel(x_off+1, y_off+1, low_r, low_g, low_b)
 			elif digit == 'w':
-				put_pixel_fn(x_off+1, y_off+3, low_r, low_g, low_b)
+				self.put_pixel(x_off+1, y_off+3, low_r, low_g, low_b)
 			elif digit == 'n':
-				put_pixel_fn(x_off, y_off+3, low_r, low_g, low_b)
-				put_pixel_fn(x_off+2, y_off+1, low_r, low_g, low_b)
+				self.put_pixel(x_off, y_off+3, low_r, low_g, low_b)
+				self.put_pixel(x_off+2, y_off+1, low_r, low_g, low_b)
 			x_off += w
 
 	def render(self):
 		"""
 		Render the to-be-displayed frame buffer by making put_pixel() and
 		render() calls down to the HAL driver.
+
+		Nothing is sent to the driver if no pixel changed since the previous
+		frame.  Returns True if the frame was handed to the driver.
 		"""
-		# This takes 11ms
-		tX = t0 = time.ticks_ms()
+		if not self.dirty:
+			# Optimization: nothing was drawn since the previous frame
+			self.num_modified_pixels = 0
+			self.frames_skipped += 1
+			metrics.incr('display_frames_skipped')
+			return False
+		self.dirty = False
+
+		# Find the pixels that changed since the previous frame
+		t = metrics.start()
 		front = self.fb[self.fb_index]
 		back = self.fb[self.fb_index ^ 1]
-		put_pixel = self.driver.put_pixel
-		num_rendered = 0
+		changed = self.changed
+		num_changed = 0
 		for pixel in range(self.num_modified_pixels):
 			# This crap saves about 4ms
 			i = pixel*3
 			j = i+1
 			k = j+1
-			r = front[i]
-			g = front[j]
-			b = front[k]
-			if r != back[i] or g != back[j] or b != back[k]:
-				put_pixel(pixel, r, g, b)
-				num_rendered += 1
+			if front[i] != back[i] or front[j] != back[j] or front[k] != back[k]:
+				changed[num_changed] = pixel
+				num_changed += 1
+		metrics.stop('display_diff_us', t)
 
-		t1 = time.ticks_ms()
-		t0 = t1 - t0
+		if not num_changed:
+			# Pixels were drawn but ended up unchanged, don't latch the frame
+			self.num_modified_pixels = 0
+			self.frames_skipped += 1
+			metrics.incr('display_frames_skipped')
+			return False
+		self.frames_rendered += 1
+		self.pixels_sent += num_changed
+		metrics.incr('display_frames_rendered')
+		metrics.incr('display_pixels_sent', num_changed)
 
-		# This takes 52ms
+		# Hand the changed pixels to the driver and bring the back buffer up
+		# to date, it becomes the to-be-displayed frame buffer below
+		t = metrics.start()
+		driver = self.driver
+		for n in range(num_changed):
+			pixel = changed[n]
+			i = pixel*3
+			r = back[i] = front[i]
+			g = back[i+1] = front[i+1]
+			b = back[i+2] = front[i+2]
+			driver.put_pixel(pixel, r, g, b)
+		metrics.stop('driver_put_us', t)
+
+		# Latch the frame, this takes 52ms on the serial link
+		t = metrics.start()
 		self.driver.update_display(self.num_modified_pixels)
-		t2 = time.ticks_ms()
-		t1 = t2 - t1
+		metrics.stop('driver_latch_us', t)
+		if self.recorder:
+			self.record_frame(front, num_changed)
 
-		# This takes 0ms
+		# Only the changed pixels differed, so the buffers are equal again
 		self.fb_index ^= 1
-		self.fb[self.fb_index][:] = self.fb[self.fb_index^1]
 		# Optimization: keep track of last updated pixel
 		self.num_modified_pixels = 0
-		if self.debug:
-			print('LedMatrix render: {} driver.put_pixel() in {}ms, spent {}ms in driver.update_display(), total {}ms'.format(num_rendered, t0, t1, t2 - tX))
+		return True
+
+	def record_frame(self, front, num_changed):
+		"""
+		Append the pixels changed by the frame just rendered to the frame log
+		"""
+		recorder = self.recorder
+		changed = self.changed
+		for n in range(num_changed):
+			pixel = changed[n]
+			i = pixel*3
+			recorder.put_pixel(pixel, front[i], front[i+1], front[i+2])
+		recorder.end_frame(ticks_diff(time.ticks_ms(), self.t_record))
+
+	def close(self):
+		"""
+		Close the frame log, if any
+		"""
+		if self.recorder:
+			self.recorder.close()
+			self.recorder = None
 
 	def hscroll(self, distance=4):
 		"""
 		Scroll away pixels, left or right
 		"""
+		self.generation += 1
 		if distance > 0:
 			z_start, z_end, delta = 0, self.columns, -1
 		else:
@@ -246,12 +374,14 @@ class LedMatrix:
 						self.num_modified_pixels = dst+1
 					dst *= 3
 					fb_next[dst] = fb_next[dst+1] = fb_next[dst+2] = 0
+			self.dirty = True
 			self.render()
 
 	def vscroll(self, distance=2):
 		"""
 		Scroll away pixels, up or down
 		"""
+		self.generation += 1
 		if distance > 0:
 			z_start, z_end, delta = 0, self.stride, -1
 		else:
@@ -278,6 +408,7 @@ class LedMatrix:
 						self.num_modified_pixels = dst+1
 					dst *= 3
 					fb_next[dst] = fb_next[dst+1] = fb_next[dst+2] = 0
+			self.dirty = True
 			self.render()
 		return False
 
@@ -285,6 +416,7 @@ class LedMatrix:
 		"""
 		Scene transition effect: fade out active pixels
 		"""
+		self.generation += 1
 		while True:
 			light = 0
 			for i in range(self.num_pixels):
@@ -304,6 +436,7 @@ class LedMatrix:
 		"""
 		Scene transition effect: dissolve active pixels with LFSR
 		"""
+		self.generation += 1
 		active_pixels = 0
 		for y in range(self.stride):
 			for x in range(self.columns):
@@ -10,14 +10,23 @@ import sys
 import time
 import gc
 from math import ceil
-from ledmatrix import LedMatrix
+from memmanager import manager as memory
 # This is to make sure we have a large contiguous block of RAM on devices with
 # 520kB RAM after all modules and modules have been compiled and instantiated.
 #
 # In the weather scene, the ussl module needs a large chunk of around 1850
-# bytes, and without the dummy allocation below the heap will be too
+# bytes, and without reserving the arena below the heap will be too
 # fragmented after all the initial processing to find such a large chunk.
-large_temp_chunk = bytearray(3400)
+# The weather scene releases the arena right before it connects.
+memory.reserve('tls', 3400)
+# Shared frame buffer for icons, large enough for 16x16 icons
+memory.reserve('icon', 16*16*3)
+# Receive buffers for HTTP responses: the forecast being parsed (see
+# forecastscanner.py) and the data read by non-blocking requests (see
+# nbrequests.py)
+memory.reserve('http', 512)
+memory.reserve('recv', 512)
+from ledmatrix import LedMatrix
 
 pycom_board = False
 esp8266_board = False
@@ -47,7 +56,11 @@ else:
 	except:
 		# ...else assume that there's an MCU (driving the display) connected
 		# to a serial port
-		from arduinoserialhal import ArduinoSerialHAL as HAL
+		try:
+			from arduinoserialhal import ArduinoSerialHAL as HAL
+		except ImportError:
+			# ...else fall back to a virtual display (see virtualhal.py)
+			HAL = None
 
 gc.collect()
 from renderloop import RenderLoop
@@ -57,17 +70,42 @@ def sigint_handler(sig, frame):
 	"""
 	Clear display when the program is terminated by Ctrl-C or SIGTERM
 	"""
-	global driver
+	global driver, display
+	if 'display' in globals():
+		# Flush the frame log, if any
+		display.close()
 	driver.clear_display()
 	driver.set_auto_time(True)
 	sys.exit(0)
 
 
 if __name__ == '__main__':
-	f = open('config.json')
+	config_file = 'config.json'
+	if len(sys.argv) > 1:
+		# Allow for running with an alternative config, e.g. on a CI box
+		config_file = sys.argv[1]
+	f = open(config_file)
 	config = json.loads(f.read())
 	f.close()
 	del json
+	if 'Memory' in config:
+		memory.configure(config['Memory'])
+	if 'Metrics' in config:
+		from metrics import metrics
+		metrics.configure(config['Metrics'])
+	if 'IconCache' in config:
+		from iconcache import cache
+		cache.configure(config['IconCache'])
+	from timeservice import clock
+	if 'Time' in config:
+		clock.configure(config['Time'])
+	if 'iconAtlas' in config:
+		import iconatlas
+		iconatlas.load(config['iconAtlas'])
+
+	if not esp8266_board and not pycom_board and (HAL is None or 'Virtual' in config):
+		# Run without hardware, see virtualhal.py
+		from virtualhal import VirtualHAL as HAL
 
 	# Initialize HAL
 	driver = HAL(config)
@@ -85,6 +123,8 @@ if __name__ == '__main__':
 				break
 		# Disable automatic rendering of time
 		driver.set_auto_time(False)
+		# Periodically resynchronize the MCU's RTC, see timeservice.py
+		clock.attach_rtc(driver.set_rtc, config['tzOffsetSeconds'] if 'tzOffsetSeconds' in config else 0)
 		# Trap Ctrl-C and service termination
 		signal.signal(signal.SIGINT, sigint_handler)
 		signal.signal(signal.SIGTERM, sigint_handler)
@@ -124,8 +164,16 @@ if __name__ == '__main__':
 		else:
 			display.clear()
 			print('WLAN: Connected with IP: {}'.format(wlan.ifconfig()[0]))
-			# Initialize RTC now that we're connected
-			driver.set_rtc(scene)
+			# Set the RTC now that we're connected, showing "clock" until
+			# a server responded or all of them were tried
+			from jobqueue import jobs
+			clock.sync_ntp()
+			i = 1
+			while not clock.synced and jobs.active(clock.ntp_job):
+				scene.render(i, 0, 0)
+				jobs.run(20000)
+				time.sleep(0.2)
+				i += 1
 			scene.render(0,0,0)
 		scene = None
 		del BootScene
@@ -136,38 +184,16 @@ if __name__ == '__main__':
 	# This is where it all begins
 	r = RenderLoop(display, config)
 
-	if 'Clock' in config:
-		from clockscene import ClockScene
-		scene = ClockScene(display, config['Clock'])
-		r.add_scene(scene)
-		gc.collect()
-
-	if 'Demo' in config:
-		from demoscene import DemoScene
-		scene = DemoScene(display, config['Demo'])
-		r.add_scene(scene)
-		gc.collect()
-
-	if 'Weather' in config:
-		from weatherscene import WeatherScene
-		scene = WeatherScene(display, config['Weather'])
-		r.add_scene(scene)
-		gc.collect()
-
-	if 'Fire' in config:
-		from firescene import FireScene
-		scene = FireScene(display, config['Fire'])
-		r.add_scene(scene)
-		gc.collect()
-
-	if 'Animation' in config:
-		from animationscene import AnimationScene
-		scene = AnimationScene(display, config['Animation'])
+	# Scenes are loaded on first use, see sceneregistry.py
+	from sceneregistry import SceneRegistry
+	for scene in SceneRegistry(display, config).scenes:
 		r.add_scene(scene)
-		gc.collect()
+	gc.collect()
 
-	# Now that we're all setup, release the large chunk
-	large_temp_chunk = None
+	if not esp8266_board and not pycom_board and 'asyncio' in config and config['asyncio']:
+		# Render scenes forever on an asyncio event loop, see asyncloop.py
+		from asyncloop import AsyncRenderLoop
+		AsyncRenderLoop(r, driver, config, config_file).run()
 
 	# Render scenes forever
 	while True:
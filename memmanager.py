@@ -0,0 +1,176 @@
+# Heap management for MicroPython targets
+#
+# On MCUs with 520kB RAM the heap easily gets too fragmented to find large
+# contiguous chunks, e.g. for the ~1850 bytes ussl needs for a TLS
+# connection.  This module helps with that by:
+#
+# - reserving arenas for known large consumers up front, while the heap is
+#   still unfragmented, and handing them out as scratch buffers or releasing
+#   them right before the consumer allocates its own memory
+# - running gc.collect() when the render loop has time to spare before the
+#   next frame rather than whenever the heap runs full in the middle of one
+# - counting allocations per frame so that hot paths can be kept free of them
+#
+# The module also works on the host computer, where it is mostly a no-op.
+#
+import gc
+import sys
+import time
+from metrics import metrics
+from ticks import ticks_diff
+
+
+def allocated():
+	"""
+	Return a counter that increases with allocations: bytes allocated on
+	MicroPython, allocated blocks on CPython
+	"""
+	if hasattr(gc, 'mem_alloc'):
+		return gc.mem_alloc()
+	return sys.getallocatedblocks()
+
+
+class MemManager:
+	"""
+	Keep track of arenas and schedule garbage collection
+	"""
+
+	def __init__(self):
+		self.debug = False
+		self.arenas = {}
+		self.sizes = {}
+		# Estimated time a gc.collect() takes, updated as we go
+		self.gc_us = 5000
+		# Collect when this many bytes were allocated since the last
+		# collection, or when free heap drops below gc_free_threshold
+		self.gc_alloc_threshold = 8192
+		self.gc_free_threshold = 16384
+		self.alloc_at_gc = allocated()
+		self.alloc_at_frame_start = 0
+		# Allocations made by the most recent frame and the worst one so far
+		self.frame_allocs = 0
+		self.max_frame_allocs = 0
+		self.collections = 0
+
+	def configure(self, config):
+		"""
+		Apply settings from the "Memory" block in the config file
+		"""
+		if not config:
+			return
+		if 'debug' in config:
+			self.debug = config['debug']
+		if 'gcAllocThreshold' in config:
+			self.gc_alloc_threshold = config['gcAllocThreshold']
+		if 'gcFreeThreshold' in config:
+			self.gc_free_threshold = config['gcFreeThreshold']
+		if 'arenas' in config:
+			for name in config['arenas']:
+				self.reserve(name, config['arenas'][name])
+		if hasattr(gc, 'threshold') and hasattr(gc, 'mem_free'):
+			# Leave automatic collections as a last resort, most of them
+			# should happen in idle time
+			gc.threshold(gc.mem_free() // 2)
+
+	def reserve(self, name, size):
+		"""
+		Reserve an arena of `size` bytes
+		"""
+		if name in self.arenas and self.arenas[name] is not None and len(self.arenas[name]) >= size:
+			return self.arenas[name]
+		self.arenas[name] = None
+		self.sizes[name] = size
+		self.arenas[name] = bytearray(size)
+		return self.arenas[name]
+
+	def arena(self, name, size):
+		"""
+		Return the bytearray of an arena of at least `size` bytes, which is
+		grown if needed
+		"""
+		arena = self.arenas.get(name)
+		if arena is None or len(arena) < size:
+			arena = self.reserve(name, max(size, self.sizes.get(name, 0)))
+		return arena
+
+	def buffer(self, name, size):
+		"""
+		Return a scratch buffer of `size` bytes backed by an arena, which is
+		grown if needed.  The buffer is shared by every user of the arena so
+		it must not be held on to across frames.
+		"""
+		return memoryview(self.arena(name, size))[:size]
+
+	def release(self, name):
+		"""
+		Free an arena, e.g. right before a large allocation it was reserving
+		space for, such as a TLS handshake
+		"""
+		if self.arenas.get(name) is None:
+			return
+		self.arenas[name] = None
+		gc.collect()
+
+	def restore(self, name):
+		"""
+		Reserve a released arena again
+		"""
+		if name in self.sizes and self.arenas.get(name) is None:
+			gc.collect()
+			try:
+				self.reserve(name, self.sizes[name])
+			except MemoryError:
+				print('MemManager: heap too fragmented to reserve {} bytes for {}'.format(self.sizes[name], name))
+
+	def frame_start(self):
+		self.alloc_at_frame_start = allocated()
+
+	def frame_end(self):
+		"""
+		Count allocations made since frame_start()
+		"""
+		n = allocated() - self.alloc_at_frame_start
+		if n < 0:
+			# A collection ran during the frame, we can't tell
+			return
+		self.frame_allocs = n
+		if n > self.max_frame_allocs:
+			self.max_frame_allocs = n
+
+	def idle(self, slack_us):
+		"""
+		Called by the render loop when it has slack_us microseconds to spare
+		before the next frame.  Returns True if a collection was made.
+		"""
+		if slack_us < self.gc_us:
+			return False
+		if hasattr(gc, 'mem_free'):
+			if allocated() - self.alloc_at_gc < self.gc_alloc_threshold and gc.mem_free() > self.gc_free_threshold:
+				return False
+		elif allocated() - self.alloc_at_gc < self.gc_alloc_threshold:
+			return False
+		self.collect()
+		return True
+
+	def collect(self):
+		"""
+		Run a collection and update the estimate of how long it takes
+		"""
+		t = time.ticks_us()
+		gc.collect()
+		t = ticks_diff(time.ticks_us(), t)
+		# Moving average, weighted towards slower collections
+		if t > self.gc_us:
+			self.gc_us = t
+		else:
+			self.gc_us = (self.gc_us * 7 + t) >> 3
+		self.alloc_at_gc = allocated()
+		self.collections += 1
+		metrics.observe('gc_us', t)
+		metrics.observe('frame_allocs', self.frame_allocs)
+		if self.debug:
+			print('MemManager: collected in {}us, {} allocations in last frame, {} at most'.format(t, self.frame_allocs, self.max_frame_allocs))
+
+
+# Shared instance, configured by main.py
+manager = MemManager()
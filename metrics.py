@@ -0,0 +1,230 @@
+# Lightweight instrumentation: counters, histograms and spans
+#
+# Metrics are aggregated in memory, with histograms kept in fixed-size ring
+# buffers, and periodically written out in the Prometheus text format, either
+# to a file (e.g. for node_exporter's textfile collector) or to anyone
+# connecting to a UNIX socket (host computer only):
+#
+#   "Metrics": {
+#     "enabled": true,
+#     "file": "/var/lib/node_exporter/lamatrix.prom",
+#     "socket": "/run/lamatrix/metrics.sock",
+#     "interval": 10,    # seconds between writes to the file
+#     "samples": 256     # ring buffer size of each histogram
+#   }
+#
+# With metrics disabled (the default) every call returns right away, so
+# instrumented code looks like this:
+#
+#   from metrics import metrics
+#   t = metrics.start()
+#   ...
+#   metrics.stop('scene_render_us', t)
+#   metrics.incr('display_frames_rendered')
+#
+import time
+from ticks import ticks_diff
+try:
+	from uarray import array
+except ImportError:
+	from array import array
+
+# Prometheus metric names are prefixed with this
+PREFIX = 'lamatrix_'
+
+
+class Histogram:
+	"""
+	Keep the most recent samples of a value in a ring buffer, along with the
+	total sum and count of all samples
+	"""
+
+	def __init__(self, size=256):
+		self.samples = array('l', [0] * size)
+		self.size = size
+		self.index = 0
+		self.count = 0
+		self.sum = 0
+
+	def add(self, value):
+		self.samples[self.index] = value
+		self.index += 1
+		if self.index == self.size:
+			self.index = 0
+		self.count += 1
+		self.sum += value
+
+	def percentiles(self, points=(50, 90, 99, 100)):
+		"""
+		Return percentiles of the most recent samples
+		"""
+		n = min(self.count, self.size)
+		if not n:
+			return [0] * len(points)
+		values = sorted(self.samples[:n])
+		return [values[min(n-1, n * p // 100)] for p in points]
+
+
+class Metrics:
+	"""
+	Registry of counters and histograms
+	"""
+
+	def __init__(self):
+		self.enabled = False
+		self.filename = None
+		self.socket_path = None
+		self.interval_ms = 10000
+		self.size = 256
+		self.counters = {}
+		self.histograms = {}
+		self.t_dump = 0
+		self.sock = None
+
+	def configure(self, config):
+		"""
+		Apply settings from the "Metrics" block in the config file
+		"""
+		if not config:
+			return
+		if 'enabled' in config:
+			self.enabled = config['enabled']
+		if 'file' in config:
+			self.filename = config['file']
+		if 'socket' in config:
+			self.socket_path = config['socket']
+		if 'interval' in config:
+			self.interval_ms = int(config['interval'] * 1000)
+		if 'samples' in config:
+			self.size = config['samples']
+		self.t_dump = time.ticks_ms()
+		if self.enabled and self.socket_path and not self.sock:
+			self.listen()
+
+	def incr(self, name, n=1):
+		"""
+		Add n to a counter
+		"""
+		if not self.enabled:
+			return
+		self.counters[name] = self.counters.get(name, 0) + n
+
+	def observe(self, name, value):
+		"""
+		Add a sample to a histogram
+		"""
+		if not self.enabled:
+			return
+		h = self.histograms.get(name)
+		if h is None:
+			h = self.histograms[name] = Histogram(self.size)
+		h.add(value)
+
+	def start(self):
+		"""
+		Start a span, returns its start time for passing to stop()
+		"""
+		if not self.enabled:
+			return 0
+		return time.ticks_us()
+
+	def stop(self, name, t_start):
+		"""
+		End a span and add its duration in us to a histogram
+		"""
+		if not self.enabled:
+			return
+		self.observe(name, ticks_diff(time.ticks_us(), t_start))
+
+	def tick(self):
+		"""
+		Called once per frame by the render loop to serve the UNIX socket and
+		periodically write the metrics file
+		"""
+		if not self.enabled:
+			return
+		if self.sock:
+			self.serve()
+		if self.filename and ticks_diff(time.ticks_ms(), self.t_dump) >= self.interval_ms:
+			self.t_dump = time.ticks_ms()
+			self.dump()
+
+	def prometheus(self):
+		"""
+		Return the metrics in the Prometheus text exposition format
+		"""
+		lines = []
+		for name in sorted(self.counters):
+			lines.append('# TYPE {}{} counter'.format(PREFIX, name))
+			lines.append('{}{} {}'.format(PREFIX, name, self.counters[name]))
+		for name in sorted(self.histograms):
+			h = self.histograms[name]
+			p50, p90, p99, p100 = h.percentiles()
+			lines.append('# TYPE {}{} summary'.format(PREFIX, name))
+			lines.append('{}{}{{quantile="0.5"}} {}'.format(PREFIX, name, p50))
+			lines.append('{}{}{{quantile="0.9"}} {}'.format(PREFIX, name, p90))
+			lines.append('{}{}{{quantile="0.99"}} {}'.format(PREFIX, name, p99))
+			lines.append('{}{}{{quantile="1"}} {}'.format(PREFIX, name, p100))
+			lines.append('{}{}_sum {}'.format(PREFIX, name, h.sum))
+			lines.append('{}{}_count {}'.format(PREFIX, name, h.count))
+		lines.append('')
+		return '\n'.join(lines)
+
+	def dump(self):
+		"""
+		Write the metrics file, atomically so readers never see half of it
+		"""
+		tmp = self.filename + '.tmp'
+		try:
+			f = open(tmp, 'w')
+			f.write(self.prometheus())
+			f.close()
+			import os
+			os.rename(tmp, self.filename)
+		except OSError as e:
+			print('Metrics: failed to write {}: {}'.format(self.filename, e))
+			self.filename = None
+
+	def listen(self):
+		"""
+		Listen for connections on the UNIX socket
+		"""
+		try:
+			import os
+			import socket
+			try:
+				os.remove(self.socket_path)
+			except OSError:
+				pass
+			sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			sock.bind(self.socket_path)
+			sock.listen(2)
+			sock.setblocking(False)
+			self.sock = sock
+		except (ImportError, AttributeError, OSError) as e:
+			print('Metrics: cannot listen on {}: {}'.format(self.socket_path, e))
+
+	def serve(self):
+		"""
+		Send the metrics to a client connected to the UNIX socket, if any
+		"""
+		try:
+			conn, _ = self.sock.accept()
+		except OSError:
+			# Nobody waiting to be served
+			return
+		try:
+			conn.settimeout(1)
+			conn.sendall(self.prometheus().encode())
+		except OSError:
+			pass
+		conn.close()
+
+	def close(self):
+		if self.sock:
+			self.sock.close()
+			self.sock = None
+
+
+# Shared instance, configured by main.py
+metrics = Metrics()
@@ -0,0 +1,312 @@
+# Non-blocking HTTP requests for MCUs without threads
+#
+# A Request is a state machine (resolve, connect, TLS handshake, send,
+# receive headers, stream body) advanced by step(), which never waits for
+# the network.  The response body is handed to a callback a piece at a time
+# as it arrives, so that it can be parsed without buffering it.  Run it as a
+# background job (see jobqueue.py), e.g.:
+#
+#   req = Request(url, scanner.feed, headers)
+#   jobs.add(req.run())
+#
+# Name lookups go through the DNS cache in urequests.py and block on a cache
+# miss.  Ports lacking non-blocking TLS handshakes (ussl.wrap_socket()
+# without do_handshake) do the handshake in one blocking step.
+#
+import time
+from ticks import ticks_diff
+try:
+	import usocket as socket
+except ImportError:
+	import socket
+try:
+	import uselect as select
+except ImportError:
+	import select
+import urequests
+from memmanager import manager as memory
+
+RESOLVE = 0
+CONNECT = 1
+TLS = 2
+SEND = 3
+HEADERS = 4
+BODY = 5
+DONE = 6
+
+# EAGAIN, EINPROGRESS, and EINPROGRESS on some MicroPython ports
+WOULD_BLOCK = (11, 115, 119)
+# CPython raises these on non-blocking TLS sockets
+ssl_would_block = ()
+# MicroPython's bytearray may lack find()
+has_find = hasattr(bytearray, 'find')
+
+
+def would_block(e):
+	return isinstance(e, ssl_would_block) or (e.args and e.args[0] in WOULD_BLOCK)
+
+
+class Request:
+	"""
+	A request whose response body is passed to on_body(data), which returns
+	False to stop reading.  Check `state` for DONE, then `error`,
+	`status_code` and `headers`.
+	"""
+
+	def __init__(self, url, on_body, headers={}, method='GET', data=None, timeout=30, chunk_size=512):
+		self.proto, self.host, self.port, path = urequests._split_url(url)
+		self.on_body = on_body
+		self.method = method
+		self.req = memoryview(urequests._request_head(method, self.host, self.port, path, headers, data))
+		self.sent = 0
+		self.timeout = timeout
+		# Timed out on the monotonic clock, as the wall clock may be set
+		# by NTP while the request is in flight
+		self.t_start = time.ticks_ms()
+		self.state = RESOLVE
+		self.sock = None
+		self.poller = None
+		self.error = None
+		self.status_code = None
+		self.reason = None
+		self.headers = None
+		# Data is received into the 'recv' arena (see memmanager.py) and
+		# handed on before step() returns
+		self.chunk_size = chunk_size
+		# Response head received so far
+		self.head = bytearray()
+		# Body framing, see urequests.Body
+		self.left = None
+		self.chunked = False
+		# Reading a chunked body: 0 a chunk size, 1 chunk data, 2 the CRLF
+		# after it, 3 trailers
+		self.chunk_state = 0
+		self.line = bytearray()
+
+	def run(self):
+		"""
+		Generator stepping the request until it's done, yielding True while
+		it's making progress
+		"""
+		while self.state != DONE:
+			yield self.step()
+
+	def step(self):
+		"""
+		Do the next bit of work that doesn't need to wait for the network,
+		returns True if any progress was made
+		"""
+		if self.state == DONE:
+			return False
+		if ticks_diff(time.ticks_ms(), self.t_start) > self.timeout * 1000:
+			self.fail('timed out')
+			return False
+		try:
+			if self.state == RESOLVE:
+				return self.connect()
+			if self.state == CONNECT:
+				return self.check_connected()
+			if self.state == TLS:
+				return self.handshake()
+			if self.state == SEND:
+				return self.send()
+			return self.receive()
+		except OSError as e:
+			if would_block(e):
+				return False
+			self.fail(e)
+		except ValueError as e:
+			# Malformed response
+			self.fail(e)
+		return False
+
+	def fail(self, error):
+		self.error = error
+		self.close()
+
+	def close(self):
+		self.state = DONE
+		if self.sock:
+			self.sock.close()
+			self.sock = None
+
+	def connect(self):
+		ai = urequests._resolve(self.host, self.port)
+		s = socket.socket(ai[0], ai[1], ai[2])
+		self.sock = s
+		s.setblocking(False)
+		try:
+			s.connect(ai[-1])
+		except OSError as e:
+			if not would_block(e):
+				urequests._dns.pop((self.host, self.port), None)
+				raise
+		self.poller = select.poll()
+		self.poller.register(s, select.POLLOUT)
+		self.state = CONNECT
+		return True
+
+	def check_connected(self):
+		events = self.poller.poll(0)
+		if not events:
+			return False
+		self.poller.unregister(self.sock)
+		self.poller = None
+		if events[0][1] & (select.POLLERR | select.POLLHUP):
+			raise OSError('Failed to connect to {}'.format(self.host))
+		if self.proto == 'https:':
+			self.wrap()
+			self.state = TLS
+		else:
+			self.state = SEND
+		return True
+
+	def wrap(self):
+		global ssl_would_block
+		s = self.sock
+		try:
+			import ussl
+			try:
+				self.sock = ussl.wrap_socket(s, server_hostname=self.host, do_handshake=False)
+			except TypeError:
+				# Handshake right away, blocking
+				s.setblocking(True)
+				self.sock = ussl.wrap_socket(s, server_hostname=self.host)
+				self.sock.setblocking(False)
+		except ImportError:
+			import ssl
+			ssl_would_block = (ssl.SSLWantReadError, ssl.SSLWantWriteError)
+			self.sock = ssl.create_default_context().wrap_socket(s, server_hostname=self.host, do_handshake_on_connect=False)
+
+	def handshake(self):
+		if hasattr(self.sock, 'do_handshake'):
+			self.sock.do_handshake()
+		# Otherwise done as part of the first write
+		self.state = SEND
+		return True
+
+	def send(self):
+		s = self.sock
+		if hasattr(s, 'recv_into'):
+			n = s.send(self.req[self.sent:])
+		else:
+			n = s.write(self.req[self.sent:])
+		if not n:
+			return False
+		self.sent += n
+		if self.sent == len(self.req):
+			self.req = None
+			self.state = HEADERS
+		return True
+
+	def receive(self):
+		s = self.sock
+		buf = memory.buffer('recv', self.chunk_size)
+		if hasattr(s, 'recv_into'):
+			n = s.recv_into(buf)
+		else:
+			n = s.readinto(buf)
+		if n is None:
+			return False
+		if not n:
+			if self.state == BODY and self.left is None and not self.chunked:
+				# Body delimited by the end of the connection
+				self.close()
+				return True
+			raise OSError('Connection closed')
+		if self.state == HEADERS:
+			start = len(self.head)
+			self.head += buf[:n]
+			i = self.head_end(start)
+			if i < 0:
+				if len(self.head) > 4096:
+					raise ValueError('Response headers too long')
+				return True
+			rest = self.head[i+4:]
+			self.parse_head(self.head[:i])
+			self.head = None
+			if self.state == BODY and rest:
+				self.body(rest)
+			return True
+		self.body(buf[:n])
+		return True
+
+	def head_end(self, start):
+		"""
+		Return the position of the blank line ending the response head, or
+		-1.  Only what was received from start onwards is searched.
+		"""
+		head = self.head
+		start = max(0, start - 3)
+		if has_find:
+			return head.find(b'\r\n\r\n', start)
+		for i in range(start, len(head) - 3):
+			if head[i] == 0x0d and head[i+1] == 0x0a and head[i+2] == 0x0d and head[i+3] == 0x0a:
+				return i
+		return -1
+
+	def parse_head(self, head):
+		lines = bytes(head).split(b'\r\n')
+		l = lines[0].split(None, 2)
+		version = l[0]
+		self.status_code = int(l[1])
+		self.reason = ''
+		if len(l) > 2:
+			self.reason = l[2].decode()
+		headers = {}
+		for l in lines[1:]:
+			k, v = l.decode().split(':', 1)
+			headers[k.strip().lower()] = v.strip()
+		self.headers = headers
+		self.left, self.chunked, keep_alive = urequests._framing(self.method, version, self.status_code, headers)
+		if self.left == 0 or self.status_code != 200:
+			# Only bodies of successful responses are of interest
+			self.close()
+		else:
+			self.state = BODY
+
+	def body(self, data):
+		"""
+		Pass the body in data on to on_body(), decoding chunks
+		"""
+		if not self.chunked:
+			if self.left is not None:
+				data = data[:self.left]
+				self.left -= len(data)
+			if self.on_body(data) is False or self.left == 0:
+				self.close()
+			return
+		pos = 0
+		n = len(data)
+		while pos < n and self.state == BODY:
+			if self.chunk_state == 0 or self.chunk_state == 3:
+				i = pos
+				while i < n and data[i] != 0x0a:
+					i += 1
+				self.line += data[pos:i]
+				if i == n:
+					if len(self.line) > 1024:
+						raise ValueError('Chunk header too long')
+					break
+				pos = i + 1
+				line = bytes(self.line).strip()
+				self.line = bytearray()
+				if self.chunk_state == 3:
+					if not line:
+						self.close()
+				else:
+					self.left = int(line.split(b';', 1)[0], 16)
+					self.chunk_state = 1 if self.left else 3
+			elif self.chunk_state == 1:
+				count = min(self.left, n - pos)
+				self.left -= count
+				if self.on_body(data[pos:pos + count]) is False:
+					self.close()
+				pos += count
+				if not self.left:
+					self.chunk_state = 2
+			else:
+				# Skip the CRLF after the chunk
+				if data[pos] == 0x0a:
+					self.chunk_state = 0
+				pos += 1
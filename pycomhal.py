@@ -11,12 +11,13 @@
 # From https://raw.githubusercontent.com/Gadgetoid/wipy-WS2812/master/ws2812alt.py
 # ..via: https://forum.pycom.io/topic/2214/driving-ws2812-neopixel-led-strip/3
 from ws2812 import WS2812
-from machine import Pin, RTC, UART
+from machine import Pin, UART
 import utime
 import os
 import sys
 import pycom
 import gc
+from timeservice import clock
 
 class PycomHAL:
 	def __init__(self, config):
@@ -36,8 +37,6 @@ class PycomHAL:
 		print('PycomHAL: left button {}, right button {}'.format(self.left_button.value(), self.right_button.value()))
 		self.button_state = 0
 		self.button_down_t = 0
-		# Setup RTC
-		self.rtc = None
 		utime.timezone(config['tzOffsetSeconds'])
 		pycom.heartbeat(False)
 		# Free resources
@@ -264,18 +263,10 @@ class PycomHAL:
 		"""
 		self.chain.put_pixel(addr % self.num_pixels, r, g, b)
 
-	def set_rtc(self, scene):
-		# Resynchronize RTC
-		self.rtc = RTC()
-		self.rtc.ntp_sync('ntps1-1.eecsit.tu-berlin.de')
-		print('HAL: Waiting for NTP sync')
-		if type(scene) != int:
-			# Kludge: render RTC sync progress
-			frame = 0
-			while not self.rtc.synced():
-				scene.render(frame, 0, 0)
-				frame += 1
-		print('HAL: RTC synched')
+	def set_rtc(self, t):
+		# Resynchronize RTC with NTP in the background, see timeservice.py
+		clock.sync_ntp()
+		print('HAL: Started NTP sync')
 
 	def set_auto_time(self, enable=True):
 		"""
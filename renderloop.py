@@ -1,12 +1,85 @@
 # The game looop
 import time
-import gc
-from math import ceil
+from ticks import ticks_diff
+from memmanager import manager as memory
+from metrics import metrics
+from jobqueue import jobs
+from timeservice import clock
+try:
+	# Prepare scenes in a worker thread on the host computer...
+	import threading
+except ImportError:
+	# ...or incrementally across frames on MCUs
+	threading = None
+try:
+	from uarray import array
+except ImportError:
+	from array import array
 
-if not hasattr(time, 'sleep_ms') or not hasattr(time, 'ticks_ms'):
-	# Emulate https://docs.pycom.io/firmwareapi/micropython/utime.html
-	time.ticks_ms = lambda: int(time.time() * 1000)
-	time.sleep_ms = lambda x: time.sleep(x/1000.0)
+
+def scene_name(scene):
+	"""
+	Name of a scene for log messages
+	"""
+	name = getattr(scene, 'name', None)
+	if name:
+		return name
+	return scene.__class__.__name__
+
+
+class FrameStats:
+	"""
+	Keep track of how late frames are rendered compared to their deadlines
+	"""
+
+	def __init__(self, size=256):
+		# Ring buffer with the lateness of the most recent frames, in us
+		self.lateness = array('l', [0] * size)
+		self.size = size
+		self.index = 0
+		self.count = 0
+		self.frames = 0
+		self.dropped_frames = 0
+		self.skipped_frames = 0
+		self.switches = 0
+		self.switch_frames = 0
+		self.switch_us = 0
+
+	def add_frame(self, late_us):
+		"""
+		Record the lateness of a rendered frame
+		"""
+		self.lateness[self.index] = late_us
+		self.index += 1
+		if self.index == self.size:
+			self.index = 0
+		if self.count < self.size:
+			self.count += 1
+		self.frames += 1
+
+	def add_switch(self, t_us, skipped_frames):
+		"""
+		Record the time spent switching scenes and the frames it cost
+		"""
+		self.switches += 1
+		self.switch_us += t_us
+		self.switch_frames += skipped_frames
+
+	def percentiles(self, points=(50, 90, 99, 100)):
+		"""
+		Return lateness percentiles (in us) of the most recent frames
+		"""
+		if not self.count:
+			return [0] * len(points)
+		values = sorted(self.lateness[:self.count])
+		n = self.count
+		return [values[min(n-1, n * p // 100)] for p in points]
+
+	def report(self):
+		p50, p90, p99, p100 = self.percentiles()
+		return 'frames {}, dropped {}, unchanged {}, late p50 {}us p90 {}us p99 {}us max {}us, {} scene switches in {}ms costing {} frames'.format(
+			self.frames, self.dropped_frames, self.skipped_frames, p50, p90, p99, p100,
+			self.switches, self.switch_us // 1000, self.switch_frames)
 
 
 class RenderLoop:
@@ -14,21 +87,52 @@ class RenderLoop:
 		self.display = display
 		self.debug = False
 		self.fps = display.fps
+		self.frame_us = 1000000 // self.fps
 		self.t_next_frame = None
-		self.prev_frame = 0
+		self.dropped_frames = 0
 		self.frame = 1
-		self.t_init = time.ticks_ms()
+		self.stats = FrameStats()
 		self.scenes = []
 		self.scene_index = 0
 		self.scene_switch_effect = 0
-		self.scene_switch_countdown = self.fps * 40
+		self.scene_timeout_ms = 40000
+		self.t_scene_switch = None
+		# Longest time to sleep without checking for input
+		self.input_poll_us = 50000
+		# Scenes implementing prepare() are prepared this long before
+		# they're switched to
+		self.prepare_lead_ms = 10000
+		self.prepared = -1       # index of the scene prepared ahead of time
+		self.preparing = -1      # index of the scene being prepared
+		self.prepare_job = None  # generator being stepped across frames
+		# Set to (increment, button_state) while waiting for a scene to be
+		# prepared before switching to it
+		self.pending_switch = None
+		# Background jobs (see jobqueue.py) get up to this much time per
+		# frame, from what's left before the next frame's deadline less a
+		# safety margin, and are checked on this often while waiting
+		self.job_budget_us = 20000
+		self.job_margin_us = 2000
+		self.job_poll_us = 10000
+		self.job_us_left = self.job_budget_us
 		self.display.clear()
-		if not config:
-			return
+		if config:
+			self.reconfigure(config)
+
+	def reconfigure(self, config):
+		"""
+		Apply render loop settings from the config, e.g. after it was reloaded
+		"""
 		if 'debug' in config:
 			self.debug = config['debug']
 		if 'sceneTimeout' in config:
-			self.scene_switch_countdown = self.fps * config['sceneTimeout']
+			self.scene_timeout_ms = config['sceneTimeout'] * 1000
+		if 'inputPollMs' in config:
+			self.input_poll_us = config['inputPollMs'] * 1000
+		if 'scenePrepareLead' in config:
+			self.prepare_lead_ms = config['scenePrepareLead'] * 1000
+		if 'jobBudgetMs' in config:
+			self.job_budget_us = config['jobBudgetMs'] * 1000
 
 	def add_scene(self, scene):
 		"""
@@ -36,97 +140,317 @@ class RenderLoop:
 		Called by main.py.
 		"""
 		self.scenes.append(scene)
+		if len(self.scenes) == 1:
+			self.set_fps(scene)
+
+	def set_fps(self, scene):
+		"""
+		Switch to the frame rate requested by the scene, if any
+		"""
+		fps = getattr(scene, 'fps', None)
+		if not fps:
+			fps = self.display.fps
+		self.fps = fps
+		self.frame_us = 1000000 // fps
 
 	def next_frame(self, button_state=0):
 		"""
 		Display next frame, possibly after a delay to ensure we meet the FPS target
 		Called by main.py.
+
+		Returns early without rendering anything when input might need to be
+		processed before the next frame is due.
+		"""
+		button_state = self.handle_input(button_state)
+		if not self.wait_for_frame():
+			return
+		self.render_frame(button_state)
+
+	def handle_input(self, button_state):
 		"""
+		Let the current scene handle input and use long-pressed buttons to
+		change the intensity.  Returns the unhandled button state.
+		"""
+		if not button_state:
+			return 0
 
+		# Don't keep the user waiting on scenes with a low frame rate
+		self.t_next_frame = time.ticks_us()
 		scene = self.scenes[self.scene_index]
-		# Process input
-		if button_state:
-			# Let the scene handle input
-			handled_bit = scene.input(button_state)
-			button_state &= ~handled_bit
-			# Use long-pressed buttons to handle intensity changes
-			if button_state & 0x22:
-				clear = 0
-				for s in self.scenes:
-					if hasattr(s, 'set_intensity'):
-						i = s.set_intensity()
-						if button_state & 0x02:
-							i -= 2
-							clear = 0x02
-						elif button_state & 0x20:
-							i += 2
-							clear = 0x20
-						i = (i + 32) % 32
-						s.set_intensity(i)
-				button_state &= ~clear
-				if self.debug:
-					print('RenderLoop: updated intensity to {} on scenes, remaining state: {}'.format(i, button_state))
-
-		# Calculate how much we need to wait before rendering the next frame
-		t_now = time.ticks_ms() - self.t_init
-		if not self.t_next_frame:
+		# Let the scene handle input
+		handled_bit = scene.input(button_state)
+		button_state &= ~handled_bit
+		# Use long-pressed buttons to handle intensity changes
+		if button_state & 0x22:
+			clear = 0
+			for s in self.scenes:
+				if hasattr(s, 'set_intensity'):
+					i = s.set_intensity()
+					if button_state & 0x02:
+						i -= 2
+						clear = 0x02
+					elif button_state & 0x20:
+						i += 2
+						clear = 0x20
+					i = (i + 32) % 32
+					s.set_intensity(i)
+			button_state &= ~clear
+			if self.debug:
+				print('RenderLoop: updated intensity to {} on scenes, remaining state: {}'.format(i, button_state))
+		return button_state
+
+	def time_to_next_frame(self):
+		"""
+		Return the number of microseconds until the next frame is due
+		"""
+		if self.t_next_frame is None:
+			return 0
+		return ticks_diff(self.t_next_frame, time.ticks_us())
+
+	def wait_for_frame(self):
+		"""
+		Sleep until the next frame's deadline or until input might be
+		available.  Returns True if the next frame is due.
+		"""
+		self.run_jobs()
+		delay = self.time_to_next_frame()
+		if delay <= 0:
+			return True
+		if memory.idle(delay):
+			# Collected garbage in the time to spare
+			delay = self.time_to_next_frame()
+			if delay <= 0:
+				return True
+		poll_us = self.input_poll_us
+		stepping = jobs.jobs and self.job_us_left > 0
+		if stepping:
+			# Come back soon to step the jobs again
+			poll_us = min(poll_us, self.job_poll_us)
+		wait_input = getattr(self.display.driver, 'wait_input', None)
+		if wait_input:
+			# Let the HAL wake us up as soon as there is input
+			if stepping and delay > poll_us:
+				wait_input((poll_us + 999) // 1000)
+				return False
+			if wait_input((delay + 999) // 1000):
+				return False
+			return self.time_to_next_frame() <= 0
+		if delay > poll_us:
+			time.sleep_us(poll_us)
+			return False
+		time.sleep_us(delay)
+		return True
+
+	def run_jobs(self):
+		"""
+		Step background jobs in the time left before the next frame, within
+		the per-frame budget.  Jobs get a step per frame even when there's
+		no time left, so that they aren't starved by slow scenes.
+		"""
+		if not jobs.jobs or self.job_us_left <= 0:
+			return
+		budget = min(self.job_us_left, self.time_to_next_frame() - self.job_margin_us)
+		t = time.ticks_us()
+		jobs.run(budget)
+		t = ticks_diff(time.ticks_us(), t)
+		self.job_us_left -= max(t, 1)
+		metrics.observe('job_us', t)
+
+	def render_frame(self, button_state=0):
+		"""
+		Render the current scene's next frame and consider switching scenes.
+		Frames whose deadlines have already passed are dropped.
+		"""
+		metrics.tick()
+		# Keep the clock and the MCU's RTC in sync
+		clock.poll()
+		t_now = time.ticks_us()
+		if self.t_next_frame is None:
 			self.t_next_frame = t_now
+		if self.t_scene_switch is None:
+			self.reset_scene_switch_counter()
 
-		delay = self.t_next_frame - t_now
-		if delay >= 0:
-			# Wait until we can display next frame
-			time.sleep_ms(delay)
-		else:
-			# Resynchronize
-			num_dropped_frames = ceil(-delay*self.fps/1000)
-			if self.debug:
-				print('RenderLoop: FPS {} too high, should\'ve rendered frame {} at {}ms but was {}ms late and dropped {} frames'.format(self.fps, self.frame, self.t_next_frame, -delay, num_dropped_frames))
+		late = ticks_diff(t_now, self.t_next_frame)
+		if late >= self.frame_us:
+			# Resynchronize by skipping frames we're too late for while
+			# keeping the deadlines on the original schedule
+			num_dropped_frames = late // self.frame_us
 			self.frame += num_dropped_frames
-			self.t_next_frame += ceil(1000*num_dropped_frames/self.fps)
-			if self.debug:
-				print('RenderLoop: Updated frame counters to frame {} with current next at {}'.format(self.frame, self.t_next_frame))
+			self.dropped_frames += num_dropped_frames
+			self.stats.dropped_frames += num_dropped_frames
+			metrics.incr('frames_dropped', num_dropped_frames)
+			self.t_next_frame = time.ticks_add(self.t_next_frame, num_dropped_frames * self.frame_us)
+			late -= num_dropped_frames * self.frame_us
+		self.stats.add_frame(late)
+		metrics.observe('frame_late_us', late)
+		self.job_us_left = self.job_budget_us
 
 		# Let the scene render its frame
-		t = time.ticks_ms()
-		loop_again = scene.render(self.frame, self.frame - self.prev_frame - 1, self.fps)
-		t = time.ticks_ms() - t
-		if t > 1000/self.fps and self.debug:
-			print('RenderLoop: WARN: Spent {}ms rendering'.format(t))
-
+		scene = self.scenes[self.scene_index]
+		frames_skipped = self.display.frames_skipped
+		t = time.ticks_us()
+		memory.frame_start()
+		loop_again = scene.render(self.frame, self.dropped_frames, self.fps)
+		memory.frame_end()
+		t = ticks_diff(time.ticks_us(), t)
+		metrics.observe('scene_render_us', t)
+		if self.display.frames_skipped != frames_skipped:
+			# Nothing changed so nothing was sent to the display
+			self.stats.skipped_frames += 1
+		if t > self.frame_us and self.debug:
+			print('RenderLoop: WARN: Spent {}us rendering'.format(t))
+		self.dropped_frames = 0
 
 		# Consider switching scenes and update frame counters
-		self.scene_switch_countdown -= 1
+		t_until_switch = ticks_diff(self.t_scene_switch, time.ticks_ms())
+		switch_scene = t_until_switch <= 0
 		scene_increment = 1
-		if not loop_again:
-			self.scene_switch_countdown = 0
+		if self.pending_switch and not button_state:
+			# The current scene keeps being rendered until the one we're
+			# switching to has been prepared
+			switch_scene = True
+			scene_increment, button_state = self.pending_switch
+		elif not loop_again:
+			switch_scene = True
 		elif button_state:
-			self.scene_switch_countdown = 0
+			switch_scene = True
 			if button_state & 0x1:
 				scene_increment = -1
 
-		if not self.scene_switch_countdown:
-			self.reset_scene_switch_counter()
-			# Transition to next scene
-			self.next_scene(scene_increment, button_state)
-			# Account for time wasted above
-			t_new = time.ticks_ms() - self.t_init
-			t_diff = t_new - t_now
-			frames_wasted = ceil(t_diff*self.fps/1000.0)
-			if self.debug:
-				print('RenderLoop: setup: scene switch took {}ms, original t {}ms, new t {}ms, spent {} frames'.format(t_diff, t_now,t_new, self.fps*t_diff/1000.0))
-			self.frame += int(frames_wasted)
-			self.t_next_frame += int(1000.0 * frames_wasted / self.fps)
+		# Get the next scene ready ahead of the switch
+		if self.preparing < 0 and t_until_switch <= self.prepare_lead_ms:
+			i = (self.scene_index + 1) % len(self.scenes)
+			if self.prepared != i and i != self.scene_index:
+				self.start_prepare(i)
+		self.step_prepare()
 
-		self.prev_frame = self.frame
 		self.frame += 1
-		self.t_next_frame += int(1000/self.fps)
+		self.t_next_frame = time.ticks_add(self.t_next_frame, self.frame_us)
+		if not switch_scene and hasattr(scene, 'next_wakeup') and not self.prepare_job:
+			# Sleep through frames the scene doesn't need, but not past the
+			# next scene switch
+			idle_frames = scene.next_wakeup(self.frame, self.fps) - self.frame
+			max_idle_frames = ticks_diff(self.t_scene_switch, time.ticks_ms()) * 1000 // self.frame_us
+			if idle_frames > max_idle_frames:
+				idle_frames = max_idle_frames
+			if idle_frames > 0:
+				self.frame += idle_frames
+				self.t_next_frame = time.ticks_add(self.t_next_frame, idle_frames * self.frame_us)
+
+		if switch_scene:
+			self.switch_scene(scene_increment, button_state)
+
+	def switch_scene(self, increment, button_state):
+		"""
+		Transition to the next scene once it has been prepared
+		"""
+		num_scenes = len(self.scenes)
+		if num_scenes < 2:
+			self.reset_scene_switch_counter()
+			return
+		i = (num_scenes + self.scene_index + increment) % num_scenes
+		if not self.scene_is_ready(i):
+			if self.preparing < 0 and self.prepared != i:
+				self.start_prepare(i)
+			if not self.scene_is_ready(i):
+				# Keep ticking frames until it's ready
+				self.pending_switch = (increment, button_state)
+				return
+		self.pending_switch = None
+
+		# Transition to next scene
+		t_switch = time.ticks_us()
+		self.next_scene(increment, button_state)
+		self.reset_scene_switch_counter()
+		# Account for the frames whose deadlines passed during the switch
+		t_now = time.ticks_us()
+		t_switch = ticks_diff(t_now, t_switch)
+		skipped = ticks_diff(t_now, self.t_next_frame)
+		if skipped < 0:
+			skipped = 0
+		else:
+			skipped = skipped // self.frame_us + 1
+			self.frame += skipped
+			self.t_next_frame = time.ticks_add(self.t_next_frame, skipped * self.frame_us)
+		self.stats.add_switch(t_switch, skipped)
+		metrics.observe('scene_switch_us', t_switch)
+		metrics.incr('scene_switches')
+		if self.debug:
+			print('RenderLoop: scene switch took {}us, skipped {} frames'.format(t_switch, skipped))
+			print('RenderLoop: stats: {}, {} frames and {} pixels sent to the display'.format(self.stats.report(), self.display.frames_rendered, self.display.pixels_sent))
+
+	def scene_is_ready(self, i):
+		"""
+		Scenes without prepare() are always ready to be switched to
+		"""
+		return self.prepared == i or not hasattr(self.scenes[i], 'prepare')
+
+	def start_prepare(self, i):
+		"""
+		Start preparing a scene ahead of switching to it.  On the host this
+		happens in a worker thread.  On MCUs, prepare() may return a
+		generator which is then stepped once per frame.
+		"""
+		scene = self.scenes[i]
+		if not hasattr(scene, 'prepare'):
+			return
+		if self.debug:
+			print('RenderLoop: preparing {}'.format(scene_name(scene)))
+		self.prepared = -1
+		self.preparing = i
+		if threading:
+			t = threading.Thread(target=self.run_prepare, args=(scene, i))
+			t.daemon = True
+			t.start()
+			return
+		try:
+			job = scene.prepare()
+		except Exception as e:
+			print('RenderLoop: failed to prepare {}: {}'.format(scene_name(scene), e))
+			job = None
+		if job is not None and hasattr(job, 'send'):
+			self.prepare_job = job
+		else:
+			self.prepared = i
+			self.preparing = -1
+
+	def run_prepare(self, scene, i):
+		"""
+		Prepare a scene, called from a worker thread
+		"""
+		try:
+			job = scene.prepare()
+			if job is not None and hasattr(job, 'send'):
+				for _ in job:
+					pass
+		except Exception as e:
+			print('RenderLoop: failed to prepare {}: {}'.format(scene_name(scene), e))
+		self.prepared = i
+		self.preparing = -1
+
+	def step_prepare(self):
+		"""
+		Advance an incremental scene preparation by one step
+		"""
+		if not self.prepare_job:
+			return
+		try:
+			next(self.prepare_job)
+			return
+		except StopIteration:
+			pass
+		except Exception as e:
+			print('RenderLoop: failed to prepare {}: {}'.format(scene_name(self.scenes[self.preparing]), e))
+		self.prepare_job = None
+		self.prepared = self.preparing
+		self.preparing = -1
 
 	def reset_scene_switch_counter(self):
 		"""
-		Reset counter used to automatically switch scenes.
-		The counter is decreased in .next_frame()
+		Reset the deadline used to automatically switch scenes.
+		The deadline is checked in .render_frame()
 		"""
-		self.scene_switch_countdown = 45 * self.fps
+		self.t_scene_switch = time.ticks_add(time.ticks_ms(), self.scene_timeout_ms)
 
 	def next_scene(self, increment=1, button_state=0):
 		"""
@@ -137,7 +461,7 @@ class RenderLoop:
 
 		print('RenderLoop: next_scene: transitioning scene')
 		# Fade out current scene
-		t0 = time.ticks_ms()
+		t0 = time.ticks_us()
 		if button_state & 0x01:
 			self.display.hscroll(-4)
 			button_state &= ~0x01
@@ -156,18 +480,20 @@ class RenderLoop:
 			else:
 				self.display.dissolve()
 
-		t2 = time.ticks_ms()
-		t1 = t2 - t0
-		gc.collect()
-
-		t3 = time.ticks_ms()
-		t2 = t3 - t1
+		t2 = t1 = time.ticks_us()
 		num_scenes = len(self.scenes)
 		i = self.scene_index = (num_scenes + self.scene_index + increment) % num_scenes
-		# (Re-)initialize scene
-		self.scenes[i].reset()
-		t4 = time.ticks_ms()
-		t3 = t4 - t3
+		# (Re-)initialize scene, cheaply if it was prepared ahead of time
+		scene = self.scenes[i]
+		if self.prepared == i:
+			scene.activate()
+		else:
+			scene.reset()
+		self.prepared = -1
+		self.set_fps(scene)
+		t3 = time.ticks_us()
+		metrics.observe('transition_effect_us', ticks_diff(t1, t0))
+		metrics.observe('scene_activate_us', ticks_diff(t3, t2))
 		if self.debug:
-			print('RenderLoop: next_scene: selected {}, effect {}ms, gc {}ms, scene reset {}ms, total {}ms'.format(self.scenes[i].__class__.__name__, t1, t2, t3, t4-t0))
+			print('RenderLoop: next_scene: selected {}'.format(scene_name(self.scenes[i])))
 		return button_state
@@ -0,0 +1,220 @@
+# Registry of scenes configured in config.json
+#
+# Scenes are not imported nor constructed until they are first needed, which
+# keeps boot time and RAM usage down on MCUs.  When free heap drops below a
+# configurable threshold, scenes that aren't on display are unloaded again.
+#
+# By default the built-in scenes below are added, in that order, if they have
+# a block in the config file.  The order can be changed with a "scenes" list
+# in the config file, and additional scenes can be registered by adding
+# "module" and "class" settings to their config blocks:
+#
+#   "scenes": ["Clock", "Weather", "Mine"],
+#   "Mine": {"module": "minescene", "class": "MineScene"},
+#
+import sys
+import gc
+
+SCENES = [
+	('Clock', 'clockscene', 'ClockScene'),
+	('Demo', 'demoscene', 'DemoScene'),
+	('Weather', 'weatherscene', 'WeatherScene'),
+	('Fire', 'firescene', 'FireScene'),
+	('Animation', 'animationscene', 'AnimationScene'),
+	('Video', 'videoscene', 'VideoScene'),
+]
+
+
+def mem_free():
+	"""
+	Return free heap in bytes, or None when not running on MicroPython
+	"""
+	if hasattr(gc, 'mem_free'):
+		return gc.mem_free()
+	return None
+
+
+class LazyScene:
+	"""
+	Stand-in for a scene which is loaded on first use
+	"""
+
+	def __init__(self, registry, name, module, cls, config):
+		self.registry = registry
+		self.name = name
+		self.module = module
+		self.cls = cls
+		self.config = config
+		self.scene = None
+		# Heap used by the scene when it was loaded, in bytes
+		self.footprint = None
+		# For picking scenes to unload, least recently activated first
+		self.last_active = 0
+		# Intensity changes made while the scene wasn't loaded
+		self.intensity_steps = 0
+
+	def load(self):
+		"""
+		Import and construct the scene
+		"""
+		if self.scene:
+			return self.scene
+		gc.collect()
+		t_free = mem_free()
+		mod = __import__(self.module)
+		self.scene = getattr(mod, self.cls)(self.registry.display, self.config)
+		for i in range(self.intensity_steps):
+			self.scene.set_intensity(0)
+		self.intensity_steps = 0
+		gc.collect()
+		if t_free is not None:
+			self.footprint = t_free - mem_free()
+		if self.registry.debug:
+			print('SceneRegistry: loaded {}, footprint {} bytes, free {} bytes'.format(self.name, self.footprint, mem_free()))
+		self.registry.ensure_free(self)
+		return self.scene
+
+	def unload(self):
+		"""
+		Close and drop the scene, and its module unless it's shared
+		"""
+		if not self.scene:
+			return
+		if hasattr(self.scene, 'close'):
+			self.scene.close()
+		self.scene = None
+		if not self.registry.module_in_use(self.module) and self.module in sys.modules:
+			del sys.modules[self.module]
+		gc.collect()
+		if self.registry.debug:
+			print('SceneRegistry: unloaded {}, free {} bytes'.format(self.name, mem_free()))
+
+	@property
+	def fps(self):
+		"""
+		Frame rate the scene asks for, or None for the display's.  Scenes
+		take it from `fps` in their config, which is used until the scene
+		is loaded.
+		"""
+		if not self.scene:
+			if self.config and 'fps' in self.config:
+				return self.config['fps']
+			return None
+		return getattr(self.scene, 'fps', None)
+
+	def reset(self):
+		self.load().reset()
+		self.last_active = self.registry.tick()
+
+	def prepare(self):
+		"""
+		Load the scene as part of the preparations for switching to it
+		"""
+		scene = self.load()
+		if hasattr(scene, 'prepare'):
+			return scene.prepare()
+		return None
+
+	def activate(self):
+		scene = self.load()
+		if hasattr(scene, 'activate'):
+			scene.activate()
+		else:
+			scene.reset()
+		self.last_active = self.registry.tick()
+
+	def input(self, button_state):
+		return self.load().input(button_state)
+
+	def set_intensity(self, value=None):
+		if self.scene:
+			return self.scene.set_intensity(value)
+		# Replay the change when the scene is loaded
+		if value is not None:
+			self.intensity_steps += 1
+		intensity = 16
+		if self.config and 'intensity' in self.config:
+			intensity = int(round(self.config['intensity']*255))
+		return intensity
+
+	def render(self, frame, dropped_frames, fps):
+		if not self.scene:
+			# The first scene is rendered without being activated
+			self.last_active = self.registry.tick()
+		return self.load().render(frame, dropped_frames, fps)
+
+	def next_wakeup(self, frame, fps):
+		if self.scene and hasattr(self.scene, 'next_wakeup'):
+			return self.scene.next_wakeup(frame, fps)
+		return frame
+
+
+class SceneRegistry:
+	"""
+	Build the list of scenes from the config file
+	"""
+
+	def __init__(self, display, config):
+		self.display = display
+		self.debug = False
+		# Unload inactive scenes when free heap drops below this (MCUs only)
+		self.mem_free_threshold = 0
+		self.ticks = 0
+		self.scenes = []
+		if 'debug' in config:
+			self.debug = config['debug']
+		if 'memFreeThreshold' in config:
+			self.mem_free_threshold = config['memFreeThreshold']
+
+		builtin = {}
+		for name, module, cls in SCENES:
+			builtin[name] = (module, cls)
+		if 'scenes' in config:
+			names = config['scenes']
+		else:
+			names = [entry[0] for entry in SCENES if entry[0] in config]
+		for name in names:
+			conf = config[name] if name in config else {}
+			if conf and 'module' in conf and 'class' in conf:
+				module, cls = conf['module'], conf['class']
+			elif name in builtin:
+				module, cls = builtin[name]
+			else:
+				print('SceneRegistry: unknown scene {}, add "module" and "class" to its config'.format(name))
+				continue
+			self.scenes.append(LazyScene(self, name, module, cls, conf))
+
+	def tick(self):
+		self.ticks += 1
+		return self.ticks
+
+	def module_in_use(self, module):
+		for entry in self.scenes:
+			if entry.scene and entry.module == module:
+				return True
+		return False
+
+	def ensure_free(self, keep=None):
+		"""
+		Unload scenes, least recently activated first, until free heap is
+		above the configured threshold.  The most recently activated scene
+		(the one on display) and `keep` are never unloaded.
+		"""
+		if not self.mem_free_threshold or mem_free() is None:
+			return
+		while mem_free() < self.mem_free_threshold:
+			active = None
+			victim = None
+			for entry in self.scenes:
+				if not entry.scene:
+					continue
+				if active is None or entry.last_active > active.last_active:
+					active = entry
+			for entry in self.scenes:
+				if not entry.scene or entry is keep or entry is active:
+					continue
+				if victim is None or entry.last_active < victim.last_active:
+					victim = entry
+			if not victim:
+				break
+			victim.unload()
@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+#
+# Deterministic benchmark and golden frame check for the scenes.
+#
+# Each scene is run against a HAL that only keeps the LEDs in memory, with a
+# fake clock that advances exactly one frame per rendered frame, a seeded
+# random number generator and a fake network module for the boot scene.
+# Icons are generated on the fly, so no network access nor any files besides
+# the code are needed.
+#
+# For each scene the following is reported:
+#
+# - time spent in the scene's render() in microseconds per rendered frame
+# - calls into the driver per rendered frame
+# - bytes allocated per rendered frame (measured in a second, shorter run
+#   with tracemalloc, which slows things down too much for the timing run)
+# - pixels changed on the display per rendered frame
+#
+# The frames are hashed and compared against the golden hashes stored in
+# scripts/golden/<scene>.json, so that performance work can't silently
+# change what ends up on the display.  After an intended change to the
+# output, store new golden hashes with --update.  Scenes ending in -nt run
+# the animations without bytes.translate(), as on MicroPython, and are
+# compared against the same golden hashes.
+#
+# Run it from the top-level directory:
+#
+#   python scripts/bench-scenes.py [--frames N] [--update] [--no-alloc] [scene ...]
+#
+import os
+import sys
+import io
+import json
+import time
+import types
+import random
+import struct
+import hashlib
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+
+top_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, top_dir)
+golden_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+
+# All scenes render local time, make it the same everywhere
+os.environ['TZ'] = 'UTC'
+time.tzset()
+
+from virtualhal import VirtualHAL
+from ledmatrix import LedMatrix
+from iconcache import cache
+import iconencoder
+import icon
+
+# Sunday 2020-09-13 12:26:40 UTC
+T_START = 1600000000
+# Hash the frames seen so far every this many frames, which allows for
+# telling roughly where the output started to differ
+CHECKPOINT_INTERVAL = 100
+# Number of frames to run with tracemalloc enabled
+ALLOC_FRAMES = 300
+
+
+class FakeClock:
+	"""
+	Replace the functions in the time module used by the scenes with a clock
+	which only moves when told to
+	"""
+
+	def __init__(self, t=T_START):
+		self.t_us = t * 1000000
+		self.saved = {}
+
+	def install(self):
+		for name in ('time', 'localtime', 'gmtime', 'ticks_us', 'ticks_ms', 'sleep', 'sleep_us', 'sleep_ms'):
+			self.saved[name] = getattr(time, name)
+		real_localtime = self.saved['localtime']
+		real_gmtime = self.saved['gmtime']
+		time.time = lambda: self.t_us / 1000000.0
+		time.localtime = lambda t=None: real_localtime(self.t_us // 1000000 if t is None else t)
+		time.gmtime = lambda t=None: real_gmtime(self.t_us // 1000000 if t is None else t)
+		time.ticks_us = lambda: self.t_us
+		time.ticks_ms = lambda: self.t_us // 1000
+		time.sleep = lambda s: self.advance(int(s * 1000000))
+		time.sleep_us = lambda us: self.advance(us)
+		time.sleep_ms = lambda ms: self.advance(ms * 1000)
+
+	def uninstall(self):
+		for name in self.saved:
+			setattr(time, name, self.saved[name])
+
+	def advance(self, us):
+		self.t_us += us
+
+
+class BenchHAL(VirtualHAL):
+	"""
+	In-memory HAL counting calls and changed pixels and hashing frames
+	"""
+
+	def __init__(self, config):
+		self.calls = 0
+		self.changed = 0
+		self.hash = hashlib.sha1()
+		self.checkpoints = []
+		VirtualHAL.__init__(self, {'LedMatrix': config})
+
+	def put_pixel(self, addr, r, g, b):
+		self.calls += 1
+		offset = (addr % self.num_pixels)*3
+		leds = self.leds
+		if leds[offset] != r or leds[offset+1] != g or leds[offset+2] != b:
+			self.changed += 1
+		VirtualHAL.put_pixel(self, addr, r, g, b)
+
+	def update_display(self, num_modified_pixels=None):
+		self.calls += 1
+		VirtualHAL.update_display(self, num_modified_pixels)
+
+	def end_frame(self, frame):
+		"""
+		Fold the current display contents into the hash of all frames
+		"""
+		self.hash.update(self.leds)
+		if not (frame + 1) % CHECKPOINT_INTERVAL:
+			self.checkpoints.append(self.hash.hexdigest())
+
+	def digest(self):
+		return self.hash.hexdigest()
+
+
+def install_fake_modules():
+	"""
+	Provide the Pycom specific modules needed by the boot scene.  WiFi comes
+	up after 20 queries and the clock is synced after another 20.
+	"""
+	from timeservice import clock
+	state = {'queries': 0}
+
+	class WLAN:
+		def isconnected(self):
+			state['queries'] += 1
+			clock.synced = state['queries'] > 40
+			return state['queries'] > 20
+
+	network = types.ModuleType('network')
+	network.WLAN = WLAN
+	sys.modules['network'] = network
+
+
+def write_icon(filename, seed, num_frames=4, rows=8, cols=8, fmt=1):
+	"""
+	Write an animated icon in the given format with pseudo-random contents
+	and frame delays.  Like real icons, the frames use a handful of colors,
+	are mostly black and differ from each other by a few pixels.
+	"""
+	rng = random.Random(seed)
+	palette = [(0, 0, 0)] * 4 + [(rng.getrandbits(8), rng.getrandbits(8), rng.getrandbits(8)) for i in range(5)]
+	plane = [rng.choice(palette) for i in range(rows*cols)]
+	frames = []
+	delays = []
+	for i in range(num_frames):
+		for j in range(rows*cols // 8):
+			plane[rng.randrange(rows*cols)] = rng.choice(palette)
+		frames.append(bytes([c for color in plane for c in color]))
+		delays.append(rng.choice((100, 200, 500)))
+	if fmt == 2:
+		data = iconencoder.encode_v2(frames, rows, cols, delays, 4)
+	else:
+		data = iconencoder.encode_v1(frames, rows, cols, delays)
+	f = open(filename, 'wb')
+	f.write(data)
+	f.close()
+
+
+def weather_scene(display, icon_dir):
+	try:
+		import urequests
+	except ImportError:
+		try:
+			import requests
+		except ImportError:
+			# Not needed as the scene never touches the network here
+			sys.modules['requests'] = types.ModuleType('requests')
+	import weatherscene
+	import forecastscanner
+	weatherscene.WeatherScene.dir_prefix = icon_dir + '/'
+	scene = weatherscene.WeatherScene(display, {'intensity': 0.1, 'cacheFile': os.path.join(icon_dir, 'forecast.json')})
+	for entry in scene.symbol_to_icon:
+		if not entry:
+			continue
+		if type(entry) != list:
+			entry = [entry]
+		for filename in entry:
+			path = os.path.join(icon_dir, filename)
+			if not os.path.exists(path):
+				write_icon(path, filename)
+	# Never touch the network, hand the scene a forecast instead
+	scene.refresh = lambda: False
+
+	def restart():
+		t = int(time.time())
+		timeline = forecastscanner.Timeline(1)
+		timeline.clear(t)
+		timeline.append(t - t % 3600 + 3600, 12.5, 3.5, 3)
+		scene.forecast = timeline
+		scene.activate()
+	return scene, restart
+
+
+def animation_scene(display, icon_dir, fmt=1):
+	import animationscene
+	filenames = []
+	for i in range(4):
+		path = os.path.join(icon_dir, 'animation-{}-v{}.bin'.format(i, fmt))
+		write_icon(path, 'animation-{}'.format(i), 3 + i*3, fmt=fmt)
+		filenames.append(path)
+	scene = animationscene.AnimationScene(display, {'intensity': 0.1, 'icons': filenames})
+	return scene, scene.reset
+
+
+def animation_v2_scene(display, icon_dir):
+	# Same icons as above in the v2 format, should render the same frames
+	return animation_scene(display, icon_dir, 2)
+
+
+def no_translate(factory):
+	"""
+	Wrap a scene factory to scale icons the way it's done on MicroPython,
+	which lacks bytes.translate()
+	"""
+	def wrapper(display, icon_dir):
+		icon.has_translate = False
+		return factory(display, icon_dir)
+	return wrapper
+
+
+def animation_atlas_scene(display, icon_dir):
+	# Same icons again, from an atlas and configured by name
+	import importlib.util
+	import animationscene
+	import iconatlas
+	spec = importlib.util.spec_from_file_location('pack_icons', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pack-icons.py'))
+	pack_icons = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(pack_icons)
+	filenames = []
+	names = []
+	for i in range(4):
+		path = os.path.join(icon_dir, 'atlas-{}.bin'.format(i))
+		write_icon(path, 'animation-{}'.format(i), 3 + i*3, fmt=2)
+		filenames.append(path)
+		names.append('atlas-{}'.format(i))
+	atlas_filename = os.path.join(icon_dir, 'icons.atlas')
+	pack_icons.pack(filenames, atlas_filename)
+	if iconatlas.atlas:
+		iconatlas.atlas.close()
+	iconatlas.load(atlas_filename)
+	for filename in filenames:
+		# Make sure nothing is read from the icon files
+		os.unlink(filename)
+	scene = animationscene.AnimationScene(display, {'intensity': 0.1, 'icons': names})
+	return scene, scene.reset
+
+
+def video_scene(display, icon_dir):
+	# A clip of moving gradients with uneven frame delays, read without a
+	# thread so that the frames don't depend on scheduling
+	import importlib.util
+	import videoscene
+	spec = importlib.util.spec_from_file_location('convert_video', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'convert-video.py'))
+	convert_video = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(convert_video)
+	rng = random.Random('video')
+	frames = []
+	for i in range(120):
+		data = bytearray()
+		for y in range(display.stride):
+			for x in range(display.columns):
+				data += bytes([(x*8 + i*4) & 0x3f, (y*8 + i) & 0x3f, (x + y + i) & 0x1f])
+		frames.append((bytes(data), rng.choice((50, 100, 130, 270))))
+	filename = os.path.join(icon_dir, 'clip.lmv')
+	f = open(filename, 'wb')
+	f.write(convert_video.encode(frames, convert_video.Layout(display.columns, display.stride, display.rotation)))
+	f.close()
+	scene = videoscene.VideoScene(display, {'clips': [filename], 'loops': 2, 'readahead': 4, 'threaded': False})
+	return scene, scene.reset
+
+
+def fire_scene(display, icon_dir):
+	import firescene
+	rng = random.Random(1)
+	firescene.urandom = lambda n: bytes([rng.getrandbits(8) for i in range(n)])
+	scene = firescene.FireScene(display, {'intensity': 0.1})
+	return scene, scene.reset
+
+
+def clock_scene(display, icon_dir):
+	import clockscene
+	scene = clockscene.ClockScene(display, {'intensity': 0.1})
+	return scene, scene.reset
+
+
+def demo_scene(display, icon_dir):
+	import demoscene
+	scene = demoscene.DemoScene(display, {'intensity': 0.1})
+	return scene, scene.reset
+
+
+def boot_scene(display, icon_dir):
+	install_fake_modules()
+	import bootscene
+	scene = bootscene.BootScene(display, {'intensity': 0.1})
+	return scene, scene.reset
+
+
+SCENES = [
+	('Clock', clock_scene),
+	('Demo', demo_scene),
+	('Fire', fire_scene),
+	('Weather', weather_scene),
+	('Animation', animation_scene),
+	('AnimationV2', animation_v2_scene),
+	('Animation-nt', no_translate(animation_scene)),
+	('AnimationV2-nt', no_translate(animation_v2_scene)),
+	('AnimationAtlas', animation_atlas_scene),
+	('Video', video_scene),
+	('Boot', boot_scene),
+]
+
+
+def run_scene(factory, frames, icon_dir, trace_alloc=False):
+	"""
+	Fast-forward a scene through the given number of frames and return
+	statistics and the display HAL with the frame hashes
+	"""
+	config = {'columns': 32, 'stride': 8, 'fps': 10}
+	# Start every run with a cold icon cache
+	cache.clear()
+	clock = FakeClock()
+	clock.install()
+	try:
+		with redirect_stdout(io.StringIO()):
+			driver = BenchHAL(config)
+			display = LedMatrix(driver, config)
+			scene, restart = factory(display, icon_dir)
+			restart()
+		fps = getattr(scene, 'fps', None) or display.fps
+		frame_us = 1000000 // fps
+		driver.calls = 0
+		driver.changed = 0
+		rendered = 0
+		t_render = 0
+		allocated = 0
+		if trace_alloc:
+			tracemalloc.start()
+		with redirect_stdout(io.StringIO()):
+			for frame in range(frames):
+				if not hasattr(scene, 'next_wakeup') or scene.next_wakeup(frame, fps) <= frame:
+					if trace_alloc:
+						tracemalloc.reset_peak()
+						before = tracemalloc.get_traced_memory()[0]
+					t = time.perf_counter()
+					loop_again = scene.render(frame, 0, fps)
+					t_render += time.perf_counter() - t
+					if trace_alloc:
+						allocated += tracemalloc.get_traced_memory()[1] - before
+					rendered += 1
+					if not loop_again:
+						restart()
+				driver.end_frame(frame)
+				clock.advance(frame_us)
+		if trace_alloc:
+			tracemalloc.stop()
+	finally:
+		clock.uninstall()
+		icon.has_translate = hasattr(b'', 'translate')
+	rendered = max(rendered, 1)
+	stats = {
+		'rendered': rendered,
+		'us': t_render * 1000000 / rendered,
+		'calls': driver.calls / rendered,
+		'changed': driver.changed / rendered,
+		'bytes': allocated // rendered,
+	}
+	return stats, driver
+
+
+def check_golden(name, frames, driver, update):
+	"""
+	Compare frame hashes with the golden ones, or store them with update
+	"""
+	# Variants of a scene share its golden hashes
+	filename = os.path.join(golden_dir, '{}.json'.format(name.split('-')[0].lower()))
+	current = {
+		'frames': frames,
+		'checkpoint_interval': CHECKPOINT_INTERVAL,
+		'checkpoints': driver.checkpoints,
+		'digest': driver.digest(),
+	}
+	if update:
+		if not os.path.isdir(golden_dir):
+			os.makedirs(golden_dir)
+		f = open(filename, 'w')
+		f.write(json.dumps(current, indent=2) + '\n')
+		f.close()
+		return 'updated'
+	if not os.path.exists(filename):
+		return 'no golden'
+	f = open(filename)
+	golden = json.loads(f.read())
+	f.close()
+	n = min(len(golden['checkpoints']), len(current['checkpoints']))
+	for i in range(n):
+		if golden['checkpoints'][i] != current['checkpoints'][i]:
+			return 'DIFFERS before frame {}'.format((i + 1) * CHECKPOINT_INTERVAL)
+	if golden['frames'] != frames:
+		return 'ok ({} frames compared)'.format(n * CHECKPOINT_INTERVAL)
+	if golden['digest'] != current['digest']:
+		return 'DIFFERS after frame {}'.format(n * CHECKPOINT_INTERVAL)
+	return 'ok'
+
+
+def main():
+	frames = 3000
+	update = False
+	trace_alloc = True
+	names = []
+	args = sys.argv[1:]
+	while args:
+		arg = args.pop(0)
+		if arg == '--frames':
+			frames = int(args.pop(0))
+		elif arg == '--update':
+			update = True
+		elif arg == '--no-alloc':
+			trace_alloc = False
+		elif arg.startswith('-'):
+			print('Usage: {} [--frames N] [--update] [--no-alloc] [scene ...]'.format(sys.argv[0]))
+			sys.exit(1)
+		else:
+			names.append(arg.lower())
+
+	icon_dir = tempfile.mkdtemp()
+	failed = False
+	print('{:<14} {:>8} {:>10} {:>12} {:>12} {:>14}  {}'.format('scene', 'frames', 'us/frame', 'calls/frame', 'bytes/frame', 'pixels/frame', 'golden'))
+	for name, factory in SCENES:
+		if names and name.lower() not in names:
+			continue
+		stats, driver = run_scene(factory, frames, icon_dir)
+		if trace_alloc:
+			alloc_stats, _ = run_scene(factory, min(frames, ALLOC_FRAMES), icon_dir, True)
+			stats['bytes'] = alloc_stats['bytes']
+		result = check_golden(name, frames, driver, update)
+		if result.startswith('DIFFERS'):
+			failed = True
+		print('{:<14} {:>8} {:>10.1f} {:>12.1f} {:>12} {:>14.1f}  {}'.format(name, stats['rendered'], stats['us'], stats['calls'], stats['bytes'] if trace_alloc else '-', stats['changed'], result))
+
+	for filename in os.listdir(icon_dir):
+		os.unlink(os.path.join(icon_dir, filename))
+	os.rmdir(icon_dir)
+	if failed:
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#
+# Exercise urequests.py against a local HTTP/1.1 server: keep-alive,
+# chunked responses, redirects and conditional requests.  The non-blocking
+# requests in nbrequests.py, which the weather scene uses on MCUs, are
+# checked against the same server, including with the fallback for ports
+# where bytearray lacks find().
+#
+# Run it from the top-level directory:
+#
+#   python scripts/bench-urequests.py [--requests N] [--size N]
+#
+# N requests are made for a response of the given size with and without
+# connection reuse, and the number of connections the server saw is
+# reported along with the time per request.  The script exits with status 1
+# if any of the checks fail.
+#
+import os
+import sys
+import time
+import socket
+import threading
+import http.server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import urequests
+import nbrequests
+
+ETAG = '"lamatrix-1"'
+LAST_MODIFIED = 'Mon, 01 Jan 2024 12:00:00 GMT'
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	body = b''
+	connections = 0
+
+	def setup(self):
+		Handler.connections += 1
+		# Don't hold back the end of a response until the client has
+		# acknowledged the rest (Nagle's algorithm), as a server with a
+		# keep-alive connection would otherwise be 40 ms slower per request
+		self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		http.server.BaseHTTPRequestHandler.setup(self)
+
+	def do_GET(self):
+		if self.path == '/data.json':
+			if self.headers.get('If-None-Match') == ETAG or self.headers.get('If-Modified-Since') == LAST_MODIFIED:
+				self.send_response(304)
+				self.send_header('ETag', ETAG)
+				self.end_headers()
+				return
+			self.send_response(200)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(self.body)))
+			self.send_header('ETag', ETAG)
+			self.send_header('Last-Modified', LAST_MODIFIED)
+			self.end_headers()
+			self.wfile.write(self.body)
+		elif self.path == '/chunked':
+			self.send_response(200)
+			self.send_header('Transfer-Encoding', 'chunked')
+			self.end_headers()
+			for i in range(0, len(self.body), 1000):
+				chunk = self.body[i:i+1000]
+				self.wfile.write(b'%x;ext=1\r\n' % len(chunk) + chunk + b'\r\n')
+			self.wfile.write(b'0\r\nX-Trailer: 1\r\n\r\n')
+		elif self.path == '/redirect':
+			self.send_response(302)
+			self.send_header('Location', '/data.json')
+			self.send_header('Content-Length', '3')
+			self.end_headers()
+			self.wfile.write(b'...')
+		elif self.path == '/loop':
+			self.send_response(301)
+			self.send_header('Location', '/loop')
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+		else:
+			self.send_error(404)
+
+	def log_message(self, *args):
+		pass
+
+
+class Server(http.server.ThreadingHTTPServer):
+
+	def handle_error(self, request, client_address):
+		# Clients closing connections early is expected here
+		pass
+
+
+def fetch_nonblocking(url, headers={}, chunk_size=512):
+	"""
+	Step an nbrequests.Request until it's done, the way the render loop's
+	job queue would, returns (request, body)
+	"""
+	body = bytearray()
+
+	def on_body(data):
+		body.extend(data)
+
+	req = nbrequests.Request(url, on_body, headers, chunk_size=chunk_size)
+	t = time.time()
+	while req.state != nbrequests.DONE and time.time() - t < 10:
+		if not req.step():
+			time.sleep(0.001)
+	req.close()
+	return req, bytes(body)
+
+
+def check_nonblocking(base, check):
+	req, body = fetch_nonblocking(base + '/data.json')
+	check('nbrequests: plain response', req.error is None and req.status_code == 200 and body == Handler.body)
+	req, body = fetch_nonblocking(base + '/chunked', chunk_size=7)
+	check('nbrequests: chunked response', req.error is None and body == Handler.body)
+	has_find = nbrequests.has_find
+	nbrequests.has_find = False
+	# Small reads split the end of the headers across them
+	req, body = fetch_nonblocking(base + '/data.json', chunk_size=5)
+	check('nbrequests: bytearray without find()', req.error is None and req.status_code == 200 and body == Handler.body)
+	nbrequests.has_find = has_find
+	req, body = fetch_nonblocking(base + '/data.json', {'If-None-Match': ETAG})
+	check('nbrequests: If-None-Match', req.error is None and req.status_code == 304 and body == b'')
+	req, body = fetch_nonblocking(base + '/redirect')
+	check('nbrequests: redirect not followed', req.status_code == 302 and body == b'')
+	s = socket.socket()
+	s.bind(('127.0.0.1', 0))
+	port = s.getsockname()[1]
+	s.close()
+	req, body = fetch_nonblocking('http://127.0.0.1:{}/'.format(port))
+	check('nbrequests: connection refused', req.error is not None and req.status_code is None)
+
+
+def bench(url, n, reuse):
+	"""
+	Make n requests, returns (ms per request, connections made)
+	"""
+	pool_size = urequests.pool_size
+	if not reuse:
+		urequests.pool_size = 0
+	urequests.close_all()
+	connections = Handler.connections
+	t = time.perf_counter()
+	for i in range(n):
+		r = urequests.get(url)
+		r.content
+	ms = (time.perf_counter() - t) * 1000 / n
+	urequests.pool_size = pool_size
+	return (ms, Handler.connections - connections)
+
+
+def main():
+	args = sys.argv[1:]
+	n = 200
+	size = 16384
+	while args:
+		arg = args.pop(0)
+		if arg == '--requests' and args:
+			n = int(args.pop(0))
+		elif arg == '--size' and args:
+			size = int(args.pop(0))
+		else:
+			print('Usage: {} [--requests N] [--size N]'.format(sys.argv[0]))
+			sys.exit(1)
+
+	Handler.body = bytes(i & 0xff for i in range(size))
+	server = Server(('127.0.0.1', 0), Handler)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+	failed = []
+
+	def check(name, ok):
+		print('{:<40} {}'.format(name, 'ok' if ok else 'FAILED'))
+		if not ok:
+			failed.append(name)
+
+	r = urequests.get(base + '/data.json')
+	check('plain response', r.status_code == 200 and r.content == Handler.body)
+	r = urequests.get(base + '/chunked')
+	check('chunked response', r.status_code == 200 and r.content == Handler.body)
+	r = urequests.get(base + '/chunked')
+	buf = bytearray(300)
+	data = bytearray()
+	while True:
+		count = r.raw.readinto(buf)
+		if not count:
+			break
+		data += buf[:count]
+	r.close()
+	check('chunked response, readinto()', bytes(data) == Handler.body)
+	r = urequests.get(base + '/redirect')
+	check('redirect', r.status_code == 200 and r.content == Handler.body)
+	try:
+		urequests.get(base + '/loop')
+		check('redirect loop', False)
+	except OSError:
+		check('redirect loop', True)
+	r = urequests.get(base + '/data.json')
+	etag = r.headers.get('etag')
+	last_modified = r.headers.get('last-modified')
+	r.close()
+	r = urequests.get(base + '/data.json', headers={'If-None-Match': etag})
+	check('If-None-Match', r.status_code == 304 and r.content == b'')
+	r = urequests.get(base + '/data.json', headers={'If-Modified-Since': last_modified})
+	check('If-Modified-Since', r.status_code == 304 and r.content == b'')
+	# A partly read response can't be reused
+	connections = Handler.connections
+	r = urequests.get(base + '/data.json')
+	r.raw.read(10)
+	r.close()
+	r = urequests.get(base + '/data.json')
+	check('new connection after a partial read', r.content == Handler.body and Handler.connections == connections + 1)
+	# Idle connections closed by the server are replaced
+	urequests.close_all()
+	r = urequests.get(base + '/data.json')
+	r.content
+	conn = urequests._pool[('http:', '127.0.0.1', server.server_address[1])][0]
+	conn.sock.shutdown(2)
+	r = urequests.get(base + '/data.json')
+	check('retry on a closed idle connection', r.content == Handler.body)
+	check_nonblocking(base, check)
+
+	print()
+	print('{} requests for {} bytes'.format(n, size))
+	print('{:<20} {:>10} {:>12}'.format('', 'ms/request', 'connections'))
+	for name, reuse in (('new connections', False), ('keep-alive', True)):
+		ms, connections = bench(base + '/data.json', n, reuse)
+		print('{:<20} {:>10.3f} {:>12}'.format(name, ms, connections))
+		if reuse and connections != 1:
+			failed.append('keep-alive')
+	urequests.close_all()
+	server.shutdown()
+	if failed:
+		print('Failed: {}'.format(', '.join(failed)))
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+#
+# Benchmark the SMHI forecast parser in forecastscanner.py against the byte at a
+# time parser it replaced.  A forecast is served by a local HTTP server and
+# fetched with http.client, so that the parsers read from a real socket.
+#
+# Run it from the top-level directory:
+#
+#   python scripts/bench-weather.py [--fixture forecast.json]
+#       [--valid-time 2024-01-01T12] [--iterations N] [--no-find]
+#
+# Without --fixture, a synthetic forecast shaped like SMHI's (ten days of
+# hourly and then six-hourly entries with 19 parameters each) is generated.
+# A recorded forecast can be used instead, e.g.:
+#
+#   curl -o forecast.json https://opendata-download-metfcst.smhi.se/api/category/pmp3g/version/2/geotype/point/lon/18.0686/lat/59.3293/data.json
+#
+# Each parser looks up the second entry (the next hour) and the last one
+# (worst case).  The scanner is also run for a 24 hour timeline, which is
+# what the scene asks for.  Reads are counted as calls to read() and
+# readinto() on the response.  With --no-find, the scanner searches its
+# buffer the way it does on MicroPython ports where bytearray lacks find().
+#
+import os
+import sys
+import json
+import time
+import random
+import threading
+import http.client
+import http.server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import forecastscanner
+from forecastscanner import ForecastScanner, Timeline, parse_time
+
+PARAMETERS = [
+	('spp', 'percent'), ('pcat', 'category'), ('pmin', 'kg/m2/h'), ('pmean', 'kg/m2/h'),
+	('pmax', 'kg/m2/h'), ('pmedian', 'kg/m2/h'), ('tcc_mean', 'octas'), ('lcc_mean', 'octas'),
+	('mcc_mean', 'octas'), ('hcc_mean', 'octas'), ('t', 'Cel'), ('msl', 'hPa'), ('vis', 'km'),
+	('wd', 'degree'), ('ws', 'm/s'), ('r', 'percent'), ('tstm', 'percent'), ('gust', 'm/s'),
+	('Wsymb2', 'category'),
+]
+
+
+def synthetic_forecast():
+	"""
+	A forecast with the structure and size of a real SMHI response
+	"""
+	rng = random.Random(1)
+	t0 = 1700000000 - 1700000000 % 3600
+	entries = []
+	hours = list(range(0, 72)) + list(range(72, 240, 6))
+	for h in hours:
+		params = []
+		for name, unit in PARAMETERS:
+			if name == 't':
+				value = round(rng.uniform(-10, 25), 1)
+			elif name in ('ws', 'gust', 'vis'):
+				value = round(rng.uniform(0, 20), 1)
+			elif name in ('msl', ):
+				value = round(rng.uniform(980, 1030), 1)
+			else:
+				value = rng.randrange(0, 27)
+			level_type = 'hmsl' if name in ('msl', 'vis', 'wd', 'ws', 'r', 'tstm', 'gust', 't') else 'hl'
+			level = 2 if name in ('t', 'vis', 'r') else 10 if name in ('wd', 'ws', 'gust') else 0
+			params.append({'name': name, 'levelType': level_type, 'level': level, 'unit': unit, 'values': [value]})
+		valid = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t0 + h*3600))
+		entries.append({'validTime': valid, 'parameters': params})
+	obj = {
+		'approvedTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t0)),
+		'referenceTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t0)),
+		'geometry': {'type': 'Point', 'coordinates': [[18.0686, 59.3293]]},
+		'timeSeries': entries,
+	}
+	return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def expected_values(body, valid_time):
+	obj = json.loads(body.decode())
+	for entry in obj['timeSeries']:
+		if entry['validTime'].startswith(valid_time):
+			values = {}
+			for param in entry['parameters']:
+				values[param['name']] = param['values'][0]
+			return (values['t'], values['ws'], values['Wsymb2'])
+	return None
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+	body = b''
+
+	def do_GET(self):
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(self.body)))
+		self.end_headers()
+		try:
+			self.wfile.write(self.body)
+		except (BrokenPipeError, ConnectionResetError):
+			# The parser stopped reading early
+			pass
+
+	def log_message(self, *args):
+		pass
+
+
+class CountingReader:
+	"""
+	Count the reads made on a response
+	"""
+
+	def __init__(self, f):
+		self.f = f
+		self.reads = 0
+		self.bytes_read = 0
+
+	def read(self, n=-1):
+		self.reads += 1
+		data = self.f.read(n)
+		self.bytes_read += len(data)
+		return data
+
+	def readinto(self, buf):
+		self.reads += 1
+		n = self.f.readinto(buf)
+		self.bytes_read += n
+		return n
+
+
+def legacy_parse(f, valid_time):
+	"""
+	The parser the scanner replaced, reading one byte at a time
+	"""
+	def next_string(start_at=0):
+		if start_at:
+			f.read(start_at)
+		stash = bytearray()
+		while True:
+			c = f.read(1)
+			if c == b'"' or not c:
+				break
+			stash.append(c[0])
+		return bytes(stash)
+
+	def next_array_entry():
+		in_array = False
+		stash = bytearray()
+		while True:
+			c = f.read(1)
+			if not c:
+				break
+			if not in_array:
+				if c == b'[':
+					in_array = True
+				continue
+			if c == b']' or c == b' ' or c == b',':
+				break
+			stash.append(c[0])
+		return bytes(stash)
+
+	time_str = temp = ws = symb = None
+	while True:
+		v = f.read(1)
+		if not v:
+			break
+		if v != b'"':
+			continue
+		s = next_string()
+		if not time_str:
+			if not s.startswith(b'validTime'):
+				continue
+			time_str = next_string(2)
+			if not time_str.startswith(valid_time):
+				time_str = None
+			continue
+		if not temp and s == b't':
+			temp = next_array_entry()
+		elif not ws and s == b'ws':
+			ws = next_array_entry()
+		elif not symb and s == b'Wsymb2':
+			symb = next_array_entry()
+		if temp and ws and symb:
+			break
+	if temp is None or ws is None or symb is None:
+		return None
+	return (temp, ws, symb)
+
+
+def scanner_parse(size, hours=0):
+	"""
+	Parse with the scanner into a timeline starting at the valid time and
+	covering `hours` more hours
+	"""
+	scanner = ForecastScanner(size)
+	timeline = Timeline(hours + 1)
+
+	def parse(f, valid_time):
+		for step in scanner.scan(f, timeline, parse_time(valid_time)):
+			pass
+		if not timeline.size:
+			return None
+		temperature, wind_speed, symbol, t = timeline.values(0)
+		return (str(temperature).encode(), str(wind_speed).encode(), str(symbol).encode())
+	return parse
+
+
+def run(port, parse, valid_time, iterations):
+	"""
+	Fetch and parse the forecast, returns (ms per fetch, reads, bytes read,
+	result)
+	"""
+	t_total = 0
+	for i in range(iterations):
+		conn = http.client.HTTPConnection('127.0.0.1', port)
+		conn.request('GET', '/data.json')
+		resp = conn.getresponse()
+		f = CountingReader(resp)
+		t = time.perf_counter()
+		result = parse(f, valid_time)
+		t_total += time.perf_counter() - t
+		conn.close()
+	return (t_total * 1000 / iterations, f.reads, f.bytes_read, result)
+
+
+def main():
+	args = sys.argv[1:]
+	fixture = None
+	valid_times = None
+	iterations = 20
+	while args:
+		arg = args.pop(0)
+		if arg == '--fixture' and args:
+			fixture = args.pop(0)
+		elif arg == '--valid-time' and args:
+			valid_times = [args.pop(0)]
+		elif arg == '--iterations' and args:
+			iterations = int(args.pop(0))
+		elif arg == '--no-find':
+			forecastscanner.has_find = False
+		else:
+			print('Usage: {} [--fixture forecast.json] [--valid-time 2024-01-01T12] [--iterations N] [--no-find]'.format(sys.argv[0]))
+			sys.exit(1)
+	if fixture:
+		f = open(fixture, 'rb')
+		body = f.read()
+		f.close()
+	else:
+		body = synthetic_forecast()
+	if not valid_times:
+		series = json.loads(body.decode())['timeSeries']
+		valid_times = [series[1]['validTime'][:13], series[-1]['validTime'][:13]]
+
+	Handler.body = body
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	port = server.server_address[1]
+
+	parsers = [
+		('byte at a time', legacy_parse),
+		('scanner 256', scanner_parse(256)),
+		('scanner 512', scanner_parse(512)),
+		('scanner 1024', scanner_parse(1024)),
+		('timeline 24h', scanner_parse(512, 24)),
+	]
+	failed = False
+	print('Forecast of {} bytes, {} iterations'.format(len(body), iterations))
+	print('{:<16} {:<14} {:>10} {:>8} {:>10}  {}'.format('parser', 'valid time', 'ms/fetch', 'reads', 'bytes', 'result'))
+	for valid_time in valid_times:
+		expected = expected_values(body, valid_time)
+		for name, parse in parsers:
+			ms, reads, bytes_read, result = run(port, parse, valid_time.encode(), iterations)
+			ok = result is not None and expected is not None and (float(result[0]), float(result[1]), int(result[2])) == (expected[0], expected[1], expected[2])
+			if not ok:
+				failed = True
+			print('{:<16} {:<14} {:>10.2f} {:>8} {:>10}  {}'.format(name, valid_time, ms, reads, bytes_read, 'ok' if ok else 'WRONG {} != {}'.format(result, expected)))
+	server.shutdown()
+	if failed:
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#
+# Build icons from LaMetric icons (JSON), see icons/README.md and
+# weather/README.md for how to download them.
+#
+# Run it from the top-level directory:
+#
+#   python scripts/build-icons.py [-j N] [--v1] [--keyframe-interval N]
+#     [--force] [--atlas icons.atlas] [input.json ...]
+#
+# Without any inputs given, icons/*.json and weather/*.json are built.  Each
+# input is written next to itself as a .bin file, in the v2 format unless
+# --v1 is given or the icon has more than 256 colors.  Identical consecutive
+# frames are merged into one frame shown for the sum of their delays.
+#
+# Inputs are converted in parallel by a pool of processes.  A hash of each
+# input (and of the settings and the encoder) is kept in .build-icons.json,
+# and inputs that haven't changed since their .bin file was built are
+# skipped.  With --atlas, all icons in icons/ and weather/ are packed into an
+# atlas (see iconatlas.py) afterwards.
+#
+import os
+import sys
+import glob
+import json
+import struct
+import hashlib
+import importlib.util
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import iconencoder
+
+CACHE_FILENAME = '.build-icons.json'
+
+
+def encoder_hash():
+	"""
+	Hash of the encoder, so that icons are rebuilt when it changes
+	"""
+	f = open(iconencoder.__file__.replace('.pyc', '.py'), 'rb')
+	digest = hashlib.sha1(f.read()).hexdigest()
+	f.close()
+	return digest
+
+
+def build(job):
+	"""
+	Convert one LaMetric icon, returns (filename, icon data, message)
+	"""
+	filename, v2, keyframe_interval = job
+	try:
+		f = open(filename)
+		frames, rows, cols, delays = iconencoder.lametric_frames(f.read())
+		f.close()
+	except (OSError, ValueError, KeyError, IndexError, TypeError) as e:
+		return (filename, None, 'failed: {}'.format(e))
+	num_frames = len(frames)
+	frames, delays = iconencoder.merge_frames(frames, delays)
+	message = '{}x{}, {} frames'.format(cols, rows, len(frames))
+	if len(frames) != num_frames:
+		message += ' (merged from {})'.format(num_frames)
+	data = None
+	try:
+		if v2:
+			data = iconencoder.encode_v2(frames, rows, cols, delays, keyframe_interval)
+			if data is None:
+				message += ', more than 256 colors, keeping the v1 format'
+		if data is None:
+			data = iconencoder.encode_v1(frames, rows, cols, delays)
+	except struct.error as e:
+		# E.g. more than 255 frames or a delay beyond 32767 ms, which the
+		# header can't hold
+		return (filename, None, 'failed: {}, {}'.format(message, e))
+	return (filename, data, message)
+
+
+def out_filename(filename):
+	return '.'.join(filename.split('.')[:-1]) + '.bin'
+
+
+def load_cache():
+	try:
+		f = open(CACHE_FILENAME)
+		cache = json.loads(f.read())
+		f.close()
+		return cache
+	except (OSError, ValueError):
+		return {}
+
+
+def save_cache(cache):
+	f = open(CACHE_FILENAME, 'w')
+	f.write(json.dumps(cache, indent=2, sort_keys=True))
+	f.close()
+
+
+def main():
+	args = sys.argv[1:]
+	jobs = None
+	v2 = True
+	keyframe_interval = 8
+	force = False
+	atlas_filename = None
+	filenames = []
+	while args:
+		arg = args.pop(0)
+		if arg == '-j' and args:
+			jobs = int(args.pop(0))
+		elif arg == '--v1':
+			v2 = False
+		elif arg == '--keyframe-interval' and args:
+			keyframe_interval = int(args.pop(0))
+		elif arg == '--force':
+			force = True
+		elif arg == '--atlas' and args:
+			atlas_filename = args.pop(0)
+		elif arg.startswith('-'):
+			print('Usage: {} [-j N] [--v1] [--keyframe-interval N] [--force] [--atlas icons.atlas] [input.json ...]'.format(sys.argv[0]))
+			sys.exit(1)
+		else:
+			filenames.append(arg)
+	if not filenames:
+		filenames = sorted(glob.glob('icons/*.json')) + sorted(glob.glob('weather/*.json'))
+
+	# Settings that change the output go into the hash as well
+	settings = '{} {} {}'.format(v2, keyframe_interval, encoder_hash())
+	cache = load_cache()
+	todo = []
+	hashes = {}
+	for filename in filenames:
+		f = open(filename, 'rb')
+		digest = hashlib.sha1(f.read() + settings.encode()).hexdigest()
+		f.close()
+		hashes[filename] = digest
+		if not force and cache.get(filename) == digest and os.path.exists(out_filename(filename)):
+			continue
+		todo.append((filename, v2, keyframe_interval))
+	print('Building {} of {} icons'.format(len(todo), len(filenames)))
+
+	failed = 0
+	if todo:
+		pool = multiprocessing.Pool(jobs)
+		try:
+			for filename, data, message in pool.imap_unordered(build, todo):
+				if data is None:
+					print('{}: {}'.format(filename, message))
+					cache.pop(filename, None)
+					failed += 1
+					continue
+				f = open(out_filename(filename), 'wb')
+				f.write(data)
+				f.close()
+				cache[filename] = hashes[filename]
+				print('Created {} from {}: {}'.format(out_filename(filename), filename, message))
+		finally:
+			pool.close()
+			pool.join()
+		save_cache(cache)
+
+	if atlas_filename:
+		spec = importlib.util.spec_from_file_location('pack_icons', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pack-icons.py'))
+		pack_icons = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(pack_icons)
+		pack_icons.pack(sorted(glob.glob('icons/*.bin')) + sorted(glob.glob('weather/*.bin')), atlas_filename)
+
+	if failed:
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# Measure heap allocations made by the hot paths of the render loop once they
+# have reached a steady state.  On MicroPython every allocation eventually has
+# to be paid for with a garbage collection, so these should stay at or close
+# to zero.
+#
+# The hot paths allocate nothing on MicroPython, but they don't get to zero
+# on CPython: every for-loop over range() allocates an iterator (48 bytes
+# per level of nesting) and ints above 256 are objects of their own (e.g.
+# buffer offsets), neither of which is the case on MicroPython.  Each path
+# has a budget covering just that, so that anything else, e.g. a bound
+# method, a slice or a bytes copy, makes the check fail.
+#
+# Run it from the top-level directory:
+#
+#   python scripts/check-allocations.py [--frames N] [--max-bytes N]
+#
+# The exit status is 1 if any of the paths allocates more than its budget,
+# or more than --max-bytes if given, per call on average.
+#
+import os
+import sys
+import struct
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from virtualhal import VirtualHAL
+from ledmatrix import LedMatrix
+from pixelfont import PixelFont
+from icon import Icon
+
+
+def write_icon(filename, num_frames=4, rows=8, cols=8):
+	"""
+	Write a small animated icon in the format read by icon.py
+	"""
+	f = open(filename, 'wb')
+	f.write(bytes([num_frames, rows, cols, 3]))
+	for i in range(num_frames):
+		f.write(struct.pack('!h', 100))
+	for i in range(num_frames):
+		f.write(bytes([(i*16 + j) & 0xff for j in range(rows*cols*3)]))
+	f.close()
+
+
+# Bytes per call allowed on CPython, see above
+BUDGETS = {
+	# Up to two ints for the pixel offset
+	'put_pixel': 64,
+	# Three nested loops plus put_pixel()
+	'render_text': 256,
+	# Two nested loops plus put_pixel()
+	'blit': 160,
+	# Two loops plus ints for the offsets of changed pixels
+	'render': 192,
+}
+
+
+def measure(name, func, calls, budget):
+	"""
+	Return the average number of bytes allocated by each call to func, not
+	counting memory that was freed again before the call returned
+	"""
+	# Warm up caches, lazily allocated buffers and the like
+	for i in range(10):
+		func(i)
+	tracemalloc.start()
+	peak = 0
+	for i in range(calls):
+		tracemalloc.reset_peak()
+		before = tracemalloc.get_traced_memory()[0]
+		func(i)
+		peak += tracemalloc.get_traced_memory()[1] - before
+	tracemalloc.stop()
+	avg = peak // calls
+	print('{:<16} {:>8} bytes/call {:>8} budget  {}'.format(name, avg, budget, 'ok' if avg <= budget else 'OVER'))
+	return avg <= budget
+
+
+def main():
+	frames = 200
+	max_bytes = None
+	args = sys.argv[1:]
+	while args:
+		arg = args.pop(0)
+		if arg == '--frames':
+			frames = int(args.pop(0))
+		elif arg == '--max-bytes':
+			max_bytes = int(args.pop(0))
+		else:
+			print('Usage: {} [--frames N] [--max-bytes N]'.format(sys.argv[0]))
+			sys.exit(1)
+
+	config = {'LedMatrix': {'columns': 32, 'stride': 8}}
+	driver = VirtualHAL(config)
+	display = LedMatrix(driver, config['LedMatrix'])
+	font = PixelFont()
+
+	tmpdir = tempfile.mkdtemp()
+	filename = os.path.join(tmpdir, 'icon.bin')
+	write_icon(filename)
+	icon = Icon(filename)
+
+	def put_pixel(i):
+		display.put_pixel(i & 31, i & 7, i & 0xff, 0, 0)
+
+	# Format the strings up front, only render_text() is to be measured
+	texts = ['{:02d}:{:02d}'.format(i % 24, i % 60) for i in range(60)]
+
+	def render_text(i):
+		display.render_text(font, texts[i % 60], 2, 1, 32)
+
+	def blit(i):
+		if not i % icon.frame_count():
+			icon.reset()
+		icon.blit(display, 0, 0)
+
+	def render(i):
+		display.put_pixel(i & 31, 0, i & 0xff, 0, 0)
+		display.render()
+
+	paths = [
+		('put_pixel', put_pixel),
+		('render_text', render_text),
+		('blit', blit),
+		('render', render),
+	]
+	ok = True
+	for name, func in paths:
+		budget = BUDGETS[name] if max_bytes is None else max_bytes
+		if not measure(name, func, frames, budget):
+			ok = False
+
+	os.unlink(filename)
+	os.rmdir(tmpdir)
+	if not ok:
+		print('Allocations exceed the budget')
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
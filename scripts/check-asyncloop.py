@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+# Run the asyncio main loop (see asyncloop.py) on the scene list built by
+# sceneregistry.py, the way main.py does, and check that scenes implementing
+# refresh() get their data fetched in the background (and retried on their
+# own schedule), that scenes with coroutine methods are rendered through
+# AsyncSceneAdapter and that background jobs are stepped on the frame thread.
+#
+# Run it from the top-level directory:
+#
+#   python scripts/check-asyncloop.py [--frames N]
+#
+# The exit status is 1 if any of the checks fail.
+#
+import os
+import sys
+import time
+import types
+import asyncio
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from virtualhal import VirtualHAL
+from ledmatrix import LedMatrix
+from renderloop import RenderLoop
+from sceneregistry import SceneRegistry
+from asyncloop import AsyncRenderLoop, AsyncSceneAdapter
+from jobqueue import jobs
+
+
+class CheckScene:
+	"""
+	Scene with coroutine methods and a refresh() coroutine, drawing a
+	moving pixel so that every frame is handed to the driver
+	"""
+	instances = []
+
+	def __init__(self, display, config):
+		self.display = display
+		self.refreshes = 0
+		self.renders = 0
+		self.background_refresh = False
+		# Asks to be refreshed again a second later, like a failed fetch
+		self.next_attempt = 0
+		self.frame_thread = None
+		CheckScene.instances.append(self)
+
+	async def reset(self):
+		pass
+
+	async def input(self, button_state):
+		return 0
+
+	def set_intensity(self, value=None):
+		return 16
+
+	async def refresh(self):
+		self.refreshes += 1
+		self.next_attempt = time.time() + 1
+
+	async def render(self, frame, dropped_frames, fps):
+		await asyncio.sleep(0)
+		self.renders += 1
+		display = self.display
+		display.clear()
+		display.put_pixel(frame % display.columns, 0, 32, 32, 32)
+		display.render()
+		return True
+
+	def next_wakeup(self, frame, fps):
+		# Called by RenderLoop on the frame thread, every frame is due
+		self.frame_thread = threading.current_thread()
+		return frame
+
+
+class CheckJob:
+	"""
+	Background job waiting for a few steps before it's done
+	"""
+
+	def __init__(self, steps):
+		self.steps = steps
+		self.threads = set()
+		self.done = False
+
+	def run(self):
+		for i in range(self.steps):
+			self.threads.add(threading.current_thread())
+			yield False
+		self.done = True
+
+
+def main():
+	frames = 50
+	args = sys.argv[1:]
+	while args:
+		arg = args.pop(0)
+		if arg == '--frames' and args:
+			frames = int(args.pop(0))
+		else:
+			print('Usage: {} [--frames N]'.format(sys.argv[0]))
+			sys.exit(1)
+
+	# Registered like any third-party scene, through "module" and "class"
+	module = types.ModuleType('checkscene')
+	module.CheckScene = CheckScene
+	sys.modules['checkscene'] = module
+
+	config = {
+		'LedMatrix': {'columns': 32, 'stride': 8, 'fps': 20},
+		'Virtual': {'maxFrames': frames},
+		'scenes': ['Check'],
+		'Check': {'module': 'checkscene', 'class': 'CheckScene'},
+		'sceneTimeout': 60,
+		'asyncio': True,
+	}
+	driver = VirtualHAL(config)
+	display = LedMatrix(driver, config['LedMatrix'])
+	r = RenderLoop(display, config)
+	for scene in SceneRegistry(display, config).scenes:
+		r.add_scene(scene)
+
+	job = CheckJob(5)
+	jobs.add(job.run())
+
+	loop = AsyncRenderLoop(r, driver, config)
+	exit_code = None
+	try:
+		loop.run()
+	except SystemExit as e:
+		exit_code = e.code
+
+	failed = []
+
+	def check(name, ok):
+		print('{:<40} {}'.format(name, 'ok' if ok else 'FAILED'))
+		if not ok:
+			failed.append(name)
+
+	scene = CheckScene.instances[0] if CheckScene.instances else None
+	check('ran until maxFrames', exit_code == 0 and driver.frame >= frames)
+	check('scene loaded once', len(CheckScene.instances) == 1)
+	check('wrapped in AsyncSceneAdapter', isinstance(r.scenes[0], AsyncSceneAdapter))
+	check('refreshed in the background', scene is not None and scene.background_refresh and scene.refreshes > 0)
+	check('render() coroutine awaited', scene is not None and scene.renders > 0)
+	check('refresh retried on schedule', scene is not None and scene.refreshes > 1)
+	check('job stepped to the end', job.done)
+	check('job stepped on the frame thread', scene is not None and job.threads == set([scene.frame_thread]))
+	if failed:
+		print('Failed: {}'.format(', '.join(failed)))
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
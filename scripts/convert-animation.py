@@ -1,48 +1,56 @@
 #!/usr/bin/env python
+#
+# Convert LaMetric icons (JSON) to the icon format read by icon.py.  With
+# --v2, icons are written in the compressed v2 format (see iconencoder.py),
+# and existing v1 .bin files given as input are converted in place.
+#
 
+import os
 import sys
-import json
-import struct
 
-if len(sys.argv) < 2:
-	print('Usage: {} <input.json>'.format(sys.argv[0]))
-	sys.exit(0)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
-for filename in sys.argv[1:]:
-	f = open(filename)
-	obj = json.loads(f.read())
-	f.close()
-	obj = json.loads(obj['body'])
+import iconencoder
 
-	out_filename = '.'.join(filename.split('.')[:-1]) + '.bin'
-	f = open(out_filename, 'wb')
-	delays = obj['delays']
-	icons = obj['icons']
+args = sys.argv[1:]
+v2 = False
+keyframe_interval = 8
+while args and args[0].startswith('--'):
+	arg = args.pop(0)
+	if arg == '--v2':
+		v2 = True
+	elif arg == '--keyframe-interval' and args:
+		keyframe_interval = int(args.pop(0))
+	else:
+		args = []
 
-	num_frames = len(icons)
-	rows = len(icons[0])
-	cols = len(icons[0][0])
-	colors = min(len(icons[0][0][0]), 3)
-	assert colors == 3, "Number of colors must be 3"
+if not args:
+	print('Usage: {} [--v2] [--keyframe-interval N] <input.json|input.bin> [...]'.format(sys.argv[0]))
+	sys.exit(0)
 
-	header = bytearray(4)
-	header[0] = num_frames
-	header[1] = rows
-	header[2] = cols
-	header[3] = 3
-	f.write(header)
-	chunk = bytearray(num_frames * 2)
-	for i in range(num_frames):
-		struct.pack_into('!h', chunk, i*2, delays[i])
-	f.write(chunk)
+for filename in args:
+	out_filename = '.'.join(filename.split('.')[:-1]) + '.bin'
+	if filename.endswith('.bin'):
+		f = open(filename, 'rb')
+		data = f.read()
+		f.close()
+		if data[3] != iconencoder.FORMAT_V1:
+			print('Skipping {}, not a v1 icon'.format(filename))
+			continue
+		frames, rows, cols, delays = iconencoder.decode_v1(data)
+	else:
+		f = open(filename)
+		frames, rows, cols, delays = iconencoder.lametric_frames(f.read())
+		f.close()
 
-	for i in range(len(icons)):
-		icon = icons[i]
-		for y in range(len(icon)):
-			row = icon[y]
-			for x in range(len(row)):
-				column = row[x]
-				for color in range(min(len(column), 3)):
-					f.write(struct.pack('B', int(255*column[color])))
+	data = None
+	if v2:
+		data = iconencoder.encode_v2(frames, rows, cols, delays, keyframe_interval)
+		if data is None:
+			print('{} has more than 256 colors, keeping the v1 format'.format(filename))
+	if data is None:
+		data = iconencoder.encode_v1(frames, rows, cols, delays)
+	f = open(out_filename, 'wb')
+	f.write(data)
 	f.close()
 	print('Created {} from {}'.format(out_filename, filename))
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# Convert GIFs and videos into clips for the video scene (see videoscene.py
+# for the container format).
+#
+# Run it from the top-level directory:
+#
+#   python scripts/convert-video.py [--config config.json] [--columns N]
+#       [--stride N] [--rotation N] [--fps N] <input.gif|input.mp4> [...]
+#
+# Frames are scaled to the size of the display and laid out in physical
+# order for its rotation, taken from the LedMatrix block in the config file
+# unless given on the command line.  Clips are written next to their inputs
+# with a .lmv suffix.
+#
+# GIFs are read with Pillow (pip install Pillow) and keep their frame
+# delays.  Anything else is decoded by ffmpeg, which must be in the PATH, at
+# --fps frames per second (10 by default).  Identical consecutive frames are
+# stored once.
+#
+import os
+import sys
+import json
+import struct
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ledmatrix import LedMatrix
+from videoscene import MAGIC, VERSION, HEADER_SIZE, INDEX_ENTRY_SIZE
+
+
+class Layout:
+	"""
+	Display geometry for LedMatrix.xy_to_phys()
+	"""
+
+	def __init__(self, columns, stride, rotation):
+		self.columns = columns
+		self.stride = stride
+		self.rotation = rotation
+
+
+def usage():
+	print('Usage: {} [--config config.json] [--columns N] [--stride N] [--rotation N] [--fps N] <input.gif|input.mp4> [...]'.format(sys.argv[0]))
+	sys.exit(1)
+
+
+def gif_frames(filename, columns, stride):
+	"""
+	Return a list of (RGB data row by row, delay in ms) from a GIF
+	"""
+	try:
+		from PIL import Image, ImageSequence
+	except ImportError:
+		print('Pillow is needed for converting GIFs, try: pip install Pillow')
+		sys.exit(1)
+	frames = []
+	im = Image.open(filename)
+	for frame in ImageSequence.Iterator(im):
+		delay = frame.info.get('duration', 100) or 100
+		data = frame.convert('RGB').resize((columns, stride), Image.LANCZOS).tobytes()
+		frames.append((data, delay))
+	return frames
+
+
+def ffmpeg_frames(filename, columns, stride, fps):
+	"""
+	Return a list of (RGB data row by row, delay in ms) from a video
+	"""
+	cmd = ['ffmpeg', '-loglevel', 'error', '-i', filename, '-vf', 'fps={},scale={}:{}'.format(fps, columns, stride), '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-']
+	try:
+		data = subprocess.check_output(cmd)
+	except OSError:
+		print('ffmpeg is needed for converting videos')
+		sys.exit(1)
+	size = columns*stride*3
+	delay = 1000 // fps
+	return [(data[i:i+size], delay) for i in range(0, len(data) - size + 1, size)]
+
+
+def encode(frames, layout):
+	"""
+	Encode (RGB data row by row, delay in ms) frames as a clip
+	"""
+	columns = layout.columns
+	stride = layout.stride
+	# Physical address of each pixel, row by row
+	phys = [0] * (columns*stride)
+	for y in range(stride):
+		for x in range(columns):
+			phys[y*columns + x] = LedMatrix.xy_to_phys(layout, x, y)
+
+	timestamps = []
+	blobs = []
+	t = 0
+	prev = None
+	for data, delay in frames:
+		out = bytearray(len(data))
+		for p in range(len(phys)):
+			i = phys[p]*3
+			out[i:i+3] = data[p*3:p*3+3]
+		if out != prev:
+			timestamps.append(t)
+			blobs.append(bytes(out))
+			prev = out
+		t += delay
+
+	offset = HEADER_SIZE + len(blobs)*INDEX_ENTRY_SIZE
+	out = bytearray(MAGIC)
+	out += struct.pack('!BBHHHII', VERSION, 0, columns, stride, layout.rotation, len(blobs), t)
+	for i in range(len(blobs)):
+		out += struct.pack('!II', timestamps[i], offset)
+		offset += len(blobs[i])
+	for blob in blobs:
+		out += blob
+	return bytes(out)
+
+
+def main():
+	args = sys.argv[1:]
+	columns = 32
+	stride = 8
+	rotation = 0
+	fps = 10
+	overrides = {}
+	filenames = []
+	while args:
+		arg = args.pop(0)
+		if arg == '--config' and args:
+			f = open(args.pop(0))
+			config = json.loads(f.read())
+			f.close()
+			if 'LedMatrix' in config:
+				config = config['LedMatrix']
+				if 'columns' in config:
+					columns = config['columns']
+				if 'stride' in config:
+					stride = config['stride']
+				if 'rotation' in config:
+					rotation = (360 + config['rotation']) % 360
+		elif arg in ('--columns', '--stride', '--rotation', '--fps') and args:
+			overrides[arg] = int(args.pop(0))
+		elif arg.startswith('-'):
+			usage()
+		else:
+			filenames.append(arg)
+	if not filenames:
+		usage()
+	columns = overrides.get('--columns', columns)
+	stride = overrides.get('--stride', stride)
+	rotation = (360 + overrides.get('--rotation', rotation)) % 360
+	fps = overrides.get('--fps', fps)
+	layout = Layout(columns, stride, rotation)
+
+	for filename in filenames:
+		if filename.lower().endswith('.gif'):
+			frames = gif_frames(filename, columns, stride)
+		else:
+			frames = ffmpeg_frames(filename, columns, stride, fps)
+		data = encode(frames, layout)
+		out_filename = '.'.join(filename.split('.')[:-1]) + '.lmv'
+		f = open(out_filename, 'wb')
+		f.write(data)
+		f.close()
+		print('Created {} from {}: {} of {} frames, {} bytes'.format(out_filename, filename, struct.unpack_from('!I', data, 12)[0], len(frames), len(data)))
+
+
+if __name__ == '__main__':
+	main()
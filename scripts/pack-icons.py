@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#
+# Bundle icons into a single atlas file (see iconatlas.py for the format).
+#
+# Run it from the top-level directory:
+#
+#   python scripts/pack-icons.py [-o icons.atlas] [icon.bin ...]
+#
+# Without any icons given, icons/*.bin and weather/*.bin are packed.
+#
+import os
+import sys
+import glob
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import iconencoder
+from iconatlas import icon_name
+
+
+def pack(filenames, out_filename):
+	icons = []
+	names = set()
+	for filename in filenames:
+		name = icon_name(filename)
+		if name in names:
+			print('Skipping {}, there is already an icon named {}'.format(filename, name))
+			continue
+		f = open(filename, 'rb')
+		data = f.read()
+		f.close()
+		names.add(name)
+		icons.append((name, data))
+
+	out = iconencoder.encode_atlas(icons)
+	f = open(out_filename, 'wb')
+	f.write(out)
+	f.close()
+	print('Packed {} icons into {} ({} bytes)'.format(len(icons), out_filename, len(out)))
+
+
+def main():
+	out_filename = 'icons.atlas'
+	args = sys.argv[1:]
+	filenames = []
+	while args:
+		arg = args.pop(0)
+		if arg == '-o' and args:
+			out_filename = args.pop(0)
+		elif arg.startswith('-'):
+			print('Usage: {} [-o icons.atlas] [icon.bin ...]'.format(sys.argv[0]))
+			sys.exit(1)
+		else:
+			filenames.append(arg)
+	if not filenames:
+		filenames = sorted(glob.glob('icons/*.bin')) + sorted(glob.glob('weather/*.bin'))
+	pack(filenames, out_filename)
+
+
+if __name__ == '__main__':
+	main()
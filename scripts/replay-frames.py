@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+# Replay frame logs recorded by LedMatrix (see "record" in the LedMatrix
+# config block) or VirtualHAL through a HAL, at the original speed or as fast
+# as the HAL can take it.  The latter is useful for benchmarking HALs and
+# protocol encoders on real traffic and comparing them on identical input.
+#
+# Run it from the top-level directory:
+#
+#   python scripts/replay-frames.py [--config config.json] [--hal module:Class]
+#       [--max-speed] [--loops N] frames.lmxf.1 frames.lmxf
+#
+# The HAL defaults to the virtual display (virtualhal:VirtualHAL) and is
+# constructed with the config file, if any.  Rotated logs should be listed
+# oldest first.
+#
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from framelog import FrameLogReader
+
+
+def usage():
+	print('Usage: {} [--config config.json] [--hal module:Class] [--max-speed] [--loops N] <recording> [...]'.format(sys.argv[0]))
+	sys.exit(1)
+
+
+def load_hal(spec, config):
+	if ':' not in spec:
+		usage()
+	module, cls = spec.split(':', 1)
+	mod = __import__(module)
+	return getattr(mod, cls)(config)
+
+
+def replay(driver, filename, max_speed, stats):
+	"""
+	Feed the frames in a frame log to the driver
+	"""
+	reader = FrameLogReader(filename)
+	t_base = None
+	t_wall = time.time()
+	for t_ms, pixels in reader:
+		if t_base is None or t_ms < t_base:
+			# First frame, or the log was appended to after a restart
+			t_base = t_ms
+			t_wall = time.time()
+		if not max_speed:
+			delay = t_wall + (t_ms - t_base) / 1000.0 - time.time()
+			if delay > 0:
+				time.sleep(delay)
+		num_modified_pixels = 0
+		t0 = time.perf_counter()
+		for addr, r, g, b in pixels:
+			driver.put_pixel(addr, r, g, b)
+			if addr >= num_modified_pixels:
+				num_modified_pixels = addr + 1
+		t1 = time.perf_counter()
+		driver.update_display(num_modified_pixels)
+		t2 = time.perf_counter()
+		stats['frames'] += 1
+		stats['pixels'] += len(pixels)
+		stats['put_pixel'] += t1 - t0
+		stats['update_display'] += t2 - t1
+	reader.close()
+	return reader.num_pixels
+
+
+def main():
+	config_file = None
+	hal = 'virtualhal:VirtualHAL'
+	max_speed = False
+	loops = 1
+	filenames = []
+	args = sys.argv[1:]
+	while args:
+		arg = args.pop(0)
+		if arg == '--config' and args:
+			config_file = args.pop(0)
+		elif arg == '--hal' and args:
+			hal = args.pop(0)
+		elif arg == '--max-speed':
+			max_speed = True
+		elif arg == '--loops' and args:
+			loops = int(args.pop(0))
+		elif arg.startswith('-'):
+			usage()
+		else:
+			filenames.append(arg)
+	if not filenames:
+		usage()
+
+	config = {}
+	if config_file:
+		f = open(config_file)
+		config = json.loads(f.read())
+		f.close()
+	reader = FrameLogReader(filenames[0])
+	num_pixels = reader.num_pixels
+	reader.close()
+
+	driver = load_hal(hal, config)
+	driver.init_display(num_pixels)
+	stats = {'frames': 0, 'pixels': 0, 'put_pixel': 0.0, 'update_display': 0.0}
+	t0 = time.time()
+	for i in range(loops):
+		for filename in filenames:
+			replay(driver, filename, max_speed, stats)
+	t = time.time() - t0
+	if hasattr(driver, 'close'):
+		driver.close()
+
+	frames = max(stats['frames'], 1)
+	print('Replayed {} frames with {} pixels in {:.3f}s ({:.1f} frames/s)'.format(stats['frames'], stats['pixels'], t, stats['frames'] / t if t else 0))
+	print('put_pixel(): {:.1f}us/frame, update_display(): {:.1f}us/frame'.format(stats['put_pixel'] * 1000000 / frames, stats['update_display'] * 1000000 / frames))
+
+
+if __name__ == '__main__':
+	main()
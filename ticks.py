@@ -0,0 +1,31 @@
+# Monotonic clock of MicroPython's utime module, for all platforms
+#
+# On CPython, time.ticks_us() and friends from
+# https://docs.pycom.io/firmwareapi/micropython/utime.html are emulated on
+# top of a monotonic clock, which unlike time.time() doesn't jump when the
+# wall clock is adjusted by NTP.  Modules using them import this first, and
+# take the difference between two tick values with ticks_diff() from here
+# rather than time.ticks_diff(), which older Pycom firmware implements with
+# the arguments the other way around:
+#
+#   import time
+#   from ticks import ticks_diff
+#   t = time.ticks_us()
+#   ...
+#   elapsed_us = ticks_diff(time.ticks_us(), t)
+#
+import time
+if not hasattr(time, 'ticks_us'):
+	time.ticks_us = lambda: time.monotonic_ns() // 1000
+	time.ticks_ms = lambda: time.monotonic_ns() // 1000000
+	time.ticks_add = lambda t, delta: t + delta
+	time.ticks_diff = lambda t1, t0: t1 - t0
+	time.sleep_us = lambda x: time.sleep(x/1000000.0)
+	time.sleep_ms = lambda x: time.sleep(x/1000.0)
+
+# Like time.ticks_diff() in mainline MicroPython, returns t1 - t0 taking
+# wraparound of the tick counter into account
+if time.ticks_diff(1, 0) < 0:
+	ticks_diff = lambda t1, t0: time.ticks_diff(t0, t1)
+else:
+	ticks_diff = time.ticks_diff
@@ -0,0 +1,346 @@
+# Wall clock time for the scenes, kept in sync with NTP and the MCU's RTC
+#
+# Reading and breaking down the wall clock on every frame is wasteful when
+# the result only changes once a second, and on MCUs time.time() only has a
+# resolution of a second.  The clock here is anchored to the wall clock and
+# advanced from the monotonic millisecond ticks in between.  The broken down
+# local time is cached, with its seconds advanced when the second changes
+# and only broken down again when the minute does.  Every `checkInterval`
+# seconds the clock is compared with the wall clock, and re-anchored if it
+# has drifted or the wall clock was adjusted.
+#
+# On MCUs, the RTC is set with SNTP (see sync_ntp()), in a background job
+# (see jobqueue.py) trying each of the servers in turn.  Server names are
+# looked up through urequests' DNS cache, and a lookup that misses the cache
+# blocks the job (and the frame) until getaddrinfo() returns.  On the host
+# computer, the MCU's RTC (used for showing the time while the host is
+# offline) is resynchronized periodically (see attach_rtc()).
+#
+# Settings go in the "Time" block in the config file:
+#
+#   "Time": {
+#     "ntpServers": ["pool.ntp.org"],
+#     "ntpInterval": 86400,     # seconds between NTP syncs on MCUs
+#     "rtcSyncInterval": 3600,  # seconds between MCU RTC syncs from the host
+#     "checkInterval": 60       # seconds between comparing with the wall clock
+#   }
+#
+import time
+from ticks import ticks_diff
+try:
+	import usocket as socket
+except ImportError:
+	import socket
+from metrics import metrics
+from jobqueue import jobs
+from urequests import _resolve
+
+
+def days_from_civil(y, m, d):
+	"""
+	Number of days from 1970-01-01 to a date in the proleptic Gregorian
+	calendar
+	"""
+	if m <= 2:
+		y -= 1
+	era = y // 400
+	yoe = y - era*400
+	doy = (153*(m - 3 if m > 2 else m + 9) + 2)//5 + d - 1
+	doe = yoe*365 + yoe//4 - yoe//100 + doy
+	return era*146097 + doe - 719468
+
+# Some MicroPython ports count seconds from 2000-01-01 rather than 1970
+_t = time.gmtime(0)
+EPOCH = days_from_civil(_t[0], _t[1], _t[2])*86400 + _t[3]*3600
+del _t
+
+# Seconds from 1900-01-01, where NTP timestamps start, to the epoch
+NTP_DELTA = 2208988800 + EPOCH
+
+# EAGAIN, EINPROGRESS, and EINPROGRESS on some MicroPython ports
+WOULD_BLOCK = (11, 115, 119)
+
+
+def wall_clock():
+	"""
+	Return the wall clock as (seconds since the epoch, milliseconds)
+	"""
+	t = time.time()
+	if type(t) is float:
+		s = int(t)
+		return (s, int((t - s) * 1000))
+	if hasattr(time, 'time_ns'):
+		t = time.time_ns()
+		return (t // 1000000000, t // 1000000 % 1000)
+	return (t, 0)
+
+
+class TimeService:
+	"""
+	Wall clock time advanced from the monotonic ticks
+	"""
+
+	def __init__(self):
+		self.debug = False
+		self.ntp_servers = ['ntps1-1.eecsit.tu-berlin.de', 'pool.ntp.org']
+		self.ntp_interval_ms = 86400000
+		self.ntp_timeout_ms = 2000
+		self.rtc_sync_interval_ms = 3600000
+		self.check_interval_ms = 60000
+		# The time at the anchor, in seconds and milliseconds, and the ticks
+		# (in ms) at that time
+		self.t_base = 0
+		self.t_base_ms = 0
+		self.ticks_base = 0
+		self.anchored = False
+		# Milliseconds the wall clock may differ from the anchored time
+		# before re-anchoring, which is how precise it can be read
+		self.tolerance_ms = 10 if type(time.time()) is float or hasattr(time, 'time_ns') else 1000
+		# Added to the wall clock where it can't be set (on the host)
+		self.offset_ms = 0
+		# Drift of the ticks from the wall clock at the most recent check,
+		# in parts per million
+		self.drift_ppm = 0
+		self.t_check = 0
+		# Cached broken down local time and the second it's for
+		self.tm = None
+		self.tm_second = 0
+		# Called with the local time in seconds to set the MCU's RTC
+		self.set_rtc = None
+		self.tz_adjust = 0
+		self.t_rtc_sync = 0
+		# NTP sync job and when to run it next, if started by sync_ntp()
+		self.ntp_job = None
+		self.t_ntp = None
+		self.synced = False
+
+	def configure(self, config):
+		"""
+		Apply settings from the "Time" block in the config file
+		"""
+		if not config:
+			return
+		if 'debug' in config:
+			self.debug = config['debug']
+		if 'ntpServers' in config:
+			self.ntp_servers = config['ntpServers']
+		if 'ntpInterval' in config:
+			self.ntp_interval_ms = int(config['ntpInterval'] * 1000)
+		if 'ntpTimeout' in config:
+			self.ntp_timeout_ms = int(config['ntpTimeout'] * 1000)
+		if 'rtcSyncInterval' in config:
+			self.rtc_sync_interval_ms = int(config['rtcSyncInterval'] * 1000)
+		if 'checkInterval' in config:
+			self.check_interval_ms = int(config['checkInterval'] * 1000)
+
+	def anchor(self, s, ms, ticks=None):
+		"""
+		Set the time to s seconds and ms milliseconds at the given ticks
+		"""
+		if ticks is None:
+			ticks = time.ticks_ms()
+		self.t_base = s
+		self.t_base_ms = ms
+		self.ticks_base = ticks
+		self.t_check = ticks
+		self.anchored = True
+		self.tm = None
+
+	def check(self, ticks):
+		"""
+		Compare with the wall clock, and re-anchor if they differ by more
+		than it can be read precisely (or the ticks went backwards)
+		"""
+		s, ms = wall_clock()
+		ms += self.offset_ms
+		elapsed = ticks_diff(ticks, self.ticks_base)
+		if not self.anchored or elapsed < 0:
+			self.anchor(s + ms // 1000, ms % 1000, ticks)
+			return 0
+		self.t_check = ticks
+		ms_now = self.t_base_ms + elapsed
+		skew = (s - self.t_base - ms_now // 1000) * 1000 + ms - ms_now % 1000
+		if elapsed:
+			self.drift_ppm = skew * 1000000 // elapsed
+		metrics.observe('clock_skew_ms', skew)
+		if abs(skew) < self.tolerance_ms:
+			if elapsed > 86400000:
+				# Move the anchor along before the ticks wrap around
+				self.anchor(self.t_base + ms_now // 1000, ms_now % 1000, ticks)
+			return skew
+		if self.debug:
+			print('TimeService: off by {} ms after {} s ({} ppm), re-anchoring'.format(skew, elapsed // 1000, self.drift_ppm))
+		self.anchor(s + ms // 1000, ms % 1000, ticks)
+		if abs(skew) >= 1000 and self.set_rtc:
+			# The wall clock was adjusted, pass it on to the MCU right away
+			self.t_rtc_sync = time.ticks_add(ticks, -self.rtc_sync_interval_ms)
+		return skew
+
+	def now(self):
+		"""
+		Return the current time as (seconds since the epoch, milliseconds)
+		"""
+		ticks = time.ticks_ms()
+		elapsed = ticks_diff(ticks, self.ticks_base)
+		if not self.anchored or elapsed < 0 or ticks_diff(ticks, self.t_check) >= self.check_interval_ms:
+			self.check(ticks)
+			elapsed = ticks_diff(ticks, self.ticks_base)
+		ms = self.t_base_ms + elapsed
+		return (self.t_base + ms // 1000, ms % 1000)
+
+	def time(self):
+		"""
+		Return the current time in seconds since the epoch, like time.time()
+		"""
+		return self.now()[0]
+
+	def localtime(self):
+		"""
+		Return the current local time like time.localtime(), but only
+		broken down again when the minute changes.  Don't modify it.
+		"""
+		s = self.now()[0]
+		tm = self.tm
+		if tm is not None and s != self.tm_second:
+			second = tm[5] + s - self.tm_second
+			if 0 <= second < 60:
+				# Same minute, only the seconds changed
+				tm = self.tm = tm[:5] + (second,) + tm[6:]
+			else:
+				tm = None
+		if tm is None:
+			tm = self.tm = time.localtime(s)
+		self.tm_second = s
+		return tm
+
+	def ms_until_minute(self):
+		"""
+		Return the number of milliseconds until the minute changes
+		"""
+		ms = self.now()[1]
+		return (60 - self.localtime()[5]) * 1000 - ms
+
+	def attach_rtc(self, set_rtc, tz_adjust=0):
+		"""
+		Periodically call set_rtc() with the local time in seconds since the
+		epoch, e.g. ArduinoSerialHAL.set_rtc() to keep the MCU's RTC in sync
+		"""
+		self.set_rtc = set_rtc
+		self.tz_adjust = tz_adjust
+		self.t_rtc_sync = time.ticks_ms()
+
+	def poll(self):
+		"""
+		Run periodic work that's due, called by the render loop every frame
+		"""
+		ticks = time.ticks_ms()
+		if ticks_diff(ticks, self.t_check) >= self.check_interval_ms:
+			self.check(ticks)
+		if self.set_rtc and ticks_diff(ticks, self.t_rtc_sync) >= self.rtc_sync_interval_ms:
+			self.t_rtc_sync = ticks
+			s, ms = self.now()
+			# The RTC is set in whole seconds, round to the nearest
+			self.set_rtc(s + (ms >= 500) + self.tz_adjust)
+			metrics.incr('rtc_syncs')
+			if self.debug:
+				print('TimeService: resynchronized RTC, drift {} ppm'.format(self.drift_ppm))
+		if self.t_ntp is not None and not self.ntp_job and ticks_diff(ticks, self.t_ntp) >= 0:
+			self.sync_ntp()
+
+	def sync_ntp(self):
+		"""
+		Set the time from the first NTP server to respond, in a background
+		job, and again every `ntpInterval` seconds
+		"""
+		if self.ntp_job and jobs.active(self.ntp_job):
+			return
+		self.t_ntp = time.ticks_add(time.ticks_ms(), self.ntp_interval_ms)
+		self.ntp_job = self.ntp_query()
+		jobs.add(self.ntp_job)
+
+	def ntp_query(self):
+		"""
+		Generator querying the NTP servers in turn until one responds,
+		yielding False while waiting for the network
+		"""
+		try:
+			for server in self.ntp_servers:
+				sock = None
+				try:
+					ai = _resolve(server, 123)
+					sock = socket.socket(ai[0], socket.SOCK_DGRAM)
+					sock.setblocking(False)
+					query = bytearray(48)
+					# Version 3, client mode
+					query[0] = 0x1b
+					t_sent = time.ticks_ms()
+					sock.sendto(query, ai[-1])
+					while ticks_diff(time.ticks_ms(), t_sent) < self.ntp_timeout_ms:
+						try:
+							data = sock.recv(48)
+						except OSError as e:
+							if e.args and e.args[0] in WOULD_BLOCK:
+								yield False
+								continue
+							raise
+						ticks = time.ticks_ms()
+						if self.ntp_response(data, ticks, ticks_diff(ticks, t_sent)):
+							return
+						break
+					print('TimeService: no valid response from {}'.format(server))
+				except OSError as e:
+					print('TimeService: NTP query to {} failed: {}'.format(server, e))
+				finally:
+					if sock:
+						sock.close()
+				yield True
+			metrics.incr('ntp_failures')
+			# Try again sooner than usual
+			self.t_ntp = time.ticks_add(time.ticks_ms(), min(self.ntp_interval_ms, 300000))
+		finally:
+			self.ntp_job = None
+
+	def ntp_response(self, data, ticks, rtt_ms):
+		"""
+		Set the time from an NTP response received at the given ticks,
+		returns False if it's not usable
+		"""
+		# Server mode, and not a kiss-of-death packet (stratum 0)
+		if len(data) < 48 or data[0] & 7 != 4 or not data[1]:
+			return False
+		s = (data[40] << 24 | data[41] << 16 | data[42] << 8 | data[43]) - NTP_DELTA
+		# The transmit timestamp plus the time the response took
+		ms = ((data[44] << 8 | data[45]) * 1000 >> 16) + rtt_ms // 2
+		self.set_time(s + ms // 1000, ms % 1000, ticks)
+		metrics.incr('ntp_syncs')
+		if self.debug:
+			print('TimeService: NTP sync, round trip {} ms'.format(rtt_ms))
+		return True
+
+	def set_time(self, s, ms=0, ticks=None):
+		"""
+		Set the wall clock to s seconds and ms milliseconds since the epoch,
+		or remember the difference where it can't be set
+		"""
+		if ticks is None:
+			ticks = time.ticks_ms()
+		try:
+			import machine
+			rtc = machine.RTC()
+			tm = time.gmtime(s)
+			if hasattr(rtc, 'datetime'):
+				# Mainline MicroPython
+				rtc.datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
+			else:
+				rtc.init((tm[0], tm[1], tm[2], tm[3], tm[4], tm[5], ms * 1000))
+			self.offset_ms = 0
+		except ImportError:
+			# Host computer, where the OS takes care of the system clock
+			ws, wms = wall_clock()
+			elapsed = ticks_diff(time.ticks_ms(), ticks)
+			self.offset_ms = (s - ws) * 1000 + ms + elapsed - wms
+		self.anchor(s, ms, ticks)
+		self.synced = True
+
+
+clock = TimeService()
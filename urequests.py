@@ -1,4 +1,208 @@
-import usocket
+# HTTP/1.1 client for MicroPython and CPython, based on micropython-lib's
+# urequests.
+#
+# Connections are kept alive and reused for requests to the same host (up
+# to pool_size idle connections per host, for max_idle seconds), and
+# getaddrinfo() results are cached for dns_ttl seconds.  Chunked responses
+# are decoded and redirects followed (up to max_redirects).  Response bodies
+# are read through Response.raw, which supports read() and readinto().
+#
+# For conditional requests, pass If-None-Match/If-Modified-Since headers
+# with the ETag/Last-Modified of a previous response (see Response.headers),
+# and expect a status code of 304 with no body if nothing has changed.
+#
+import time
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+
+pool_size = 2
+max_idle = 30
+dns_ttl = 300
+
+# Idle connections by (scheme, host, port), and cached addresses by
+# (host, port)
+_pool = {}
+_dns = {}
+
+
+def _resolve(host, port):
+    key = (host, port)
+    entry = _dns.get(key)
+    t = time.time()
+    if entry and entry[1] > t:
+        return entry[0]
+    ai = None
+    for entry in socket.getaddrinfo(host, port):
+        # CPython returns an entry per socket type
+        if entry[1] == socket.SOCK_STREAM:
+            ai = entry
+            break
+    if ai is None:
+        raise OSError("No address for " + host)
+    _dns[key] = (ai, t + dns_ttl)
+    return ai
+
+
+class Connection:
+
+    def __init__(self, key):
+        self.key = key
+        scheme, host, port = key
+        ai = _resolve(host, port)
+        s = socket.socket(ai[0], ai[1], ai[2])
+        try:
+            s.connect(ai[-1])
+        except OSError:
+            s.close()
+            # The address may have changed
+            _dns.pop((host, port), None)
+            raise
+        if scheme == "https:":
+            try:
+                import ussl
+                s = ussl.wrap_socket(s, server_hostname=host)
+            except ImportError:
+                import ssl
+                s = ssl.create_default_context().wrap_socket(s, server_hostname=host)
+        self.sock = s
+        if hasattr(s, "readline"):
+            # MicroPython sockets read and write directly
+            self.f = s
+            self.flush = None
+        else:
+            self.f = s.makefile("rwb")
+            self.flush = self.f.flush
+        self.idle_since = 0
+        self.reused = False
+
+    def settimeout(self, timeout):
+        if hasattr(self.sock, "settimeout"):
+            self.sock.settimeout(timeout)
+
+    def close(self):
+        try:
+            if self.f is not self.sock:
+                self.f.close()
+        except OSError:
+            # Unsent data on a broken connection
+            pass
+        self.sock.close()
+
+
+def _connect(key):
+    idle = _pool.get(key)
+    t = time.time()
+    while idle:
+        conn = idle.pop()
+        if t - conn.idle_since < max_idle:
+            conn.reused = True
+            return conn
+        conn.close()
+    return Connection(key)
+
+
+def _release(conn):
+    idle = _pool.setdefault(conn.key, [])
+    if len(idle) >= pool_size:
+        conn.close()
+        return
+    conn.idle_since = time.time()
+    idle.append(conn)
+
+
+def close_all():
+    """
+    Close all idle connections
+    """
+    for key in _pool:
+        for conn in _pool[key]:
+            conn.close()
+    _pool.clear()
+
+
+class Body:
+    """
+    Response body, read up to its Content-Length, chunk by chunk or until
+    the connection is closed
+    """
+
+    def __init__(self, conn, length, chunked, keep_alive):
+        self.conn = conn
+        self.f = conn.f
+        # Bytes left of the body, or of the current chunk
+        self.left = length
+        self.chunked = chunked
+        self.keep_alive = keep_alive and (chunked or length is not None)
+        self.done = length == 0 and not chunked
+
+    def readinto(self, buf, nbytes=-1):
+        if self.done:
+            return 0
+        f = self.f
+        n = len(buf) if nbytes < 0 else nbytes
+        if self.chunked and not self.left:
+            if self.left == 0:
+                # The CRLF ending the previous chunk
+                f.readline()
+            l = f.readline()
+            self.left = int(l.split(b";", 1)[0], 16)
+            if not self.left:
+                # Skip trailers
+                while True:
+                    l = f.readline()
+                    if not l or l == b"\r\n":
+                        break
+                self.done = True
+                return 0
+        if self.left is not None:
+            n = min(n, self.left)
+        if n < len(buf):
+            buf = memoryview(buf)[:n]
+        count = f.readinto(buf)
+        if not count:
+            if self.left is not None:
+                raise OSError("Connection closed")
+            self.done = True
+            return 0
+        if self.left is not None:
+            self.left -= count
+            if not self.left and not self.chunked:
+                self.done = True
+        return count
+
+    def read(self, size=-1):
+        if size >= 0:
+            buf = bytearray(size)
+            n = 0
+            while n < size:
+                count = self.readinto(memoryview(buf)[n:])
+                if not count:
+                    break
+                n += count
+            return bytes(buf[:n])
+        data = bytearray()
+        buf = bytearray(512)
+        while True:
+            count = self.readinto(buf)
+            if not count:
+                break
+            data += buf[:count]
+        return bytes(data)
+
+    def close(self):
+        conn = self.conn
+        if not conn:
+            return
+        self.conn = None
+        self.f = None
+        if self.done and self.keep_alive:
+            _release(conn)
+        else:
+            # Partly read, the rest would have to be read before reusing it
+            conn.close()
+
 
 class Response:
 
@@ -28,11 +232,17 @@ class Response:
         return str(self.content, self.encoding)
 
     def json(self):
-        import ujson
-        return ujson.loads(self.content)
+        try:
+            import ujson as json
+        except ImportError:
+            import json
+        return json.loads(self.content)
 
 
-def request(method, url, data=None, json=None, headers={}, stream=None):
+def _split_url(url):
+    """
+    Split a URL into (scheme, host, port, path)
+    """
     try:
         proto, dummy, host, path = url.split("/", 3)
     except ValueError:
@@ -41,7 +251,6 @@ def request(method, url, data=None, json=None, headers={}, stream=None):
     if proto == "http:":
         port = 80
     elif proto == "https:":
-        import ussl
         port = 443
     else:
         raise ValueError("Unsupported protocol: " + proto)
@@ -49,62 +258,138 @@ def request(method, url, data=None, json=None, headers={}, stream=None):
     if ":" in host:
         host, port = host.split(":", 1)
         port = int(port)
+    return (proto, host, port, path)
 
-    ai = usocket.getaddrinfo(host, port)
-    ai = ai[0]
 
-    s = usocket.socket(ai[0], ai[1], ai[2])
-    try:
-        s.connect(ai[-1])
-        if proto == "https:":
-            s = ussl.wrap_socket(s, server_hostname=host)
-        s.write(b"%s /%s HTTP/1.0\r\n" % (method, path))
-        if not "Host" in headers:
-            s.write(b"Host: %s\r\n" % host)
-        # Iterate over keys to avoid tuple alloc
-        for k in headers:
-            s.write(k)
-            s.write(b": ")
-            s.write(headers[k])
-            s.write(b"\r\n")
-        if json is not None:
-            assert data is None
-            import ujson
-            data = ujson.dumps(json)
-            s.write(b"Content-Type: application/json\r\n")
-        if data:
-            s.write(b"Content-Length: %d\r\n" % len(data))
-        s.write(b"\r\n")
-        if data:
-            s.write(data)
-
-        l = s.readline()
-        #print(l)
-        l = l.split(None, 2)
-        status = int(l[1])
-        reason = ""
-        if len(l) > 2:
-            reason = l[2].rstrip()
-        while True:
-            l = s.readline()
-            if not l or l == b"\r\n":
-                break
+def _request_head(method, host, port, path, headers, data):
+    """
+    Build the request in one buffer, to write it in one go
+    """
+    req = bytearray(method.encode())
+    req += b" /"
+    req += path.encode()
+    req += b" HTTP/1.1\r\n"
+    if not "Host" in headers:
+        req += b"Host: "
+        req += host.encode()
+        if port != 80 and port != 443:
+            req += b":%d" % port
+        req += b"\r\n"
+    # Iterate over keys to avoid tuple alloc
+    for k in headers:
+        v = headers[k]
+        req += k.encode() if type(k) == str else k
+        req += b": "
+        req += v.encode() if type(v) == str else v
+        req += b"\r\n"
+    if data:
+        req += b"Content-Length: %d\r\n" % len(data)
+    req += b"\r\n"
+    if data:
+        req += data
+    return req
 
-            if l.startswith(b"Transfer-Encoding:"):
-                if b"chunked" in l:
-                    raise ValueError("Unsupported " + l)
-            elif l.startswith(b"Location:") and not 200 <= status <= 299:
-                raise NotImplementedError("Redirects not yet supported")
-    except OSError:
-        s.close()
-        raise
 
-    resp = Response(s)
+def _framing(method, version, status, headers):
+    """
+    Return (length, chunked, keep_alive) of a response body, where length
+    is None when it's not known up front
+    """
+    connection = headers.get("connection", "").lower()
+    if version == b"HTTP/1.0":
+        keep_alive = connection == "keep-alive"
+    else:
+        keep_alive = connection != "close"
+    chunked = "chunked" in headers.get("transfer-encoding", "").lower()
+    length = None
+    if method == "HEAD" or status == 204 or status == 304 or 100 <= status < 200:
+        length = 0
+        chunked = False
+    elif not chunked and "content-length" in headers:
+        length = int(headers["content-length"])
+    return (length, chunked, keep_alive)
+
+
+def _send(conn, method, host, port, path, headers, data):
+    """
+    Send a request and read the response headers, returns a Response
+    """
+    req = _request_head(method, host, port, path, headers, data)
+    f = conn.f
+    f.write(req)
+    if conn.flush:
+        conn.flush()
+
+    l = f.readline()
+    if not l:
+        raise OSError("Connection closed")
+    l = l.split(None, 2)
+    version = l[0]
+    status = int(l[1])
+    reason = ""
+    if len(l) > 2:
+        reason = l[2].rstrip().decode()
+    resp_headers = {}
+    while True:
+        l = f.readline()
+        if not l or l == b"\r\n":
+            break
+        k, v = l.decode().split(":", 1)
+        resp_headers[k.strip().lower()] = v.strip()
+
+    length, chunked, keep_alive = _framing(method, version, status, resp_headers)
+    resp = Response(Body(conn, length, chunked, keep_alive))
     resp.status_code = status
     resp.reason = reason
+    resp.headers = resp_headers
     return resp
 
 
+def request(method, url, data=None, json=None, headers={}, stream=None, timeout=None, max_redirects=5):
+    if json is not None:
+        assert data is None
+        try:
+            import ujson as jsonlib
+        except ImportError:
+            import json as jsonlib
+        data = jsonlib.dumps(json)
+        headers = dict(headers)
+        headers["Content-Type"] = "application/json"
+    if type(data) == str:
+        data = data.encode()
+
+    for redirect in range(max_redirects + 1):
+        proto, host, port, path = _split_url(url)
+        key = (proto, host, port)
+        while True:
+            conn = _connect(key)
+            conn.settimeout(timeout)
+            try:
+                resp = _send(conn, method, host, port, path, headers, data)
+                break
+            except OSError:
+                conn.close()
+                if not conn.reused:
+                    raise
+                # The server closed the idle connection, try a new one
+
+        location = resp.headers.get("location")
+        if resp.status_code not in (301, 302, 303, 307, 308) or not location:
+            return resp
+        # Read what's left of the redirect so that the connection can be
+        # reused
+        resp.content
+        if location.startswith("/"):
+            location = "{}//{}{}".format(proto, host if port in (80, 443) else "{}:{}".format(host, port), location)
+        elif "://" not in location:
+            location = url.rsplit("/", 1)[0] + "/" + location
+        url = location
+        if resp.status_code == 303 or (resp.status_code in (301, 302) and method == "POST"):
+            method = "GET"
+            data = None
+    raise OSError("Too many redirects")
+
+
 def head(url, **kw):
     return request("HEAD", url, **kw)
 
@@ -0,0 +1,336 @@
+# Play back video clips converted with scripts/convert-video.py
+#
+# Clips are stored in a container with a seek index, and frames laid out in
+# physical order (see LedMatrix.xy_to_phys()) for a given display size and
+# rotation, so that they can be copied straight into the frame buffer:
+#
+#   b'LMVC', version (uint8), reserved (uint8)
+#   columns (uint16 BE), stride (uint16 BE), rotation (uint16 BE)
+#   number of frames (uint32 BE), duration in ms (uint32 BE)
+#
+# ..followed by the index, one entry per frame:
+#
+#   time in ms the frame is shown at (uint32 BE)
+#   offset of the frame from the start of the file (uint32 BE)
+#
+# ..and the frames, columns*stride*3 bytes each.
+#
+# Frames are read ahead into a few buffers, by a background thread on the
+# host computer and a bounded number of frames per rendered frame on MCUs.
+# Configure the scene with e.g.:
+#
+#   "Video": {"clips": ["intro.lmv"], "loops": 2, "readahead": 8}
+#
+try:
+	from ustruct import unpack_from
+except ImportError:
+	from struct import unpack_from
+try:
+	import threading
+except ImportError:
+	threading = None
+from metrics import metrics
+
+MAGIC = b'LMVC'
+VERSION = 1
+HEADER_SIZE = 20
+INDEX_ENTRY_SIZE = 8
+
+
+class VideoFile:
+	"""
+	Header, index and frames of a clip
+	"""
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.f = open(filename, 'rb')
+		header = self.f.read(HEADER_SIZE)
+		if len(header) != HEADER_SIZE or header[0:4] != MAGIC or header[4] != VERSION:
+			self.f.close()
+			raise ValueError('Not a video clip: {}'.format(filename))
+		self.columns, self.stride, self.rotation, self.num_frames, self.duration = unpack_from('!HHHII', header, 6)
+		self.frame_size = self.columns*self.stride*3
+		self.index = self.f.read(self.num_frames*INDEX_ENTRY_SIZE)
+		# Current file position, to avoid seeking when reading sequentially
+		self.pos = self.f.tell()
+
+	def timestamp(self, i):
+		"""
+		Time in ms frame i is shown at, or the duration of the clip past the
+		last frame
+		"""
+		if i >= self.num_frames:
+			return self.duration
+		return unpack_from('!I', self.index, i*INDEX_ENTRY_SIZE)[0]
+
+	def read_frame(self, i, buf):
+		offset = unpack_from('!I', self.index, i*INDEX_ENTRY_SIZE + 4)[0]
+		if self.pos != offset:
+			self.f.seek(offset)
+		n = self.f.readinto(buf)
+		self.pos = offset + n
+
+	def close(self):
+		self.f.close()
+
+
+class Readahead:
+	"""
+	Frames read ahead of playback into a fixed set of buffers.  With a
+	thread, frames are read in the background.  Otherwise, fill() reads
+	frames into the free buffers.
+	"""
+
+	def __init__(self, video, size, threaded):
+		self.video = video
+		self.free = [bytearray(video.frame_size) for i in range(size)]
+		# (frame index, buffer) in playback order
+		self.queue = []
+		# Next frame to read
+		self.next_read = 0
+		# Bumped on seeks, so that frames read meanwhile are thrown away
+		self.seeks = 0
+		self.stopped = False
+		self.cond = None
+		self.thread = None
+		if threaded:
+			self.cond = threading.Condition()
+			self.thread = threading.Thread(target=self.run)
+			self.thread.daemon = True
+			self.thread.start()
+
+	def run(self):
+		cond = self.cond
+		video = self.video
+		while True:
+			with cond:
+				while not self.stopped and (not self.free or self.next_read >= video.num_frames):
+					cond.wait()
+				if self.stopped:
+					return
+				buf = self.free.pop()
+				i = self.next_read
+				self.next_read += 1
+				seeks = self.seeks
+			video.read_frame(i, buf)
+			with cond:
+				if seeks == self.seeks:
+					self.queue.append((i, buf))
+				else:
+					self.free.append(buf)
+
+	def fill(self, max_frames):
+		"""
+		Read up to max_frames frames into free buffers (without a thread)
+		"""
+		video = self.video
+		while max_frames and self.free and self.next_read < video.num_frames:
+			buf = self.free.pop()
+			video.read_frame(self.next_read, buf)
+			self.queue.append((self.next_read, buf))
+			self.next_read += 1
+			max_frames -= 1
+
+	def take(self, i, dest):
+		"""
+		Copy frame i into dest and return True, or return False if it hasn't
+		been read yet.  Frames before i are dropped unseen.
+		"""
+		if self.cond:
+			with self.cond:
+				found = self.take_locked(i, dest)
+				self.cond.notify()
+			return found
+		if not self.take_locked(i, dest):
+			# Read it right away
+			self.fill(1)
+			return self.take_locked(i, dest)
+		return True
+
+	def take_locked(self, i, dest):
+		queue = self.queue
+		while queue and queue[0][0] < i:
+			self.free.append(queue.pop(0)[1])
+		if queue and queue[0][0] == i:
+			buf = queue.pop(0)[1]
+			dest[:] = buf
+			self.free.append(buf)
+			return True
+		if not queue and self.next_read < i:
+			# Playback got ahead of reading, skip the frames in between
+			self.next_read = i
+			self.seeks += 1
+		return False
+
+	def close(self):
+		if self.cond:
+			with self.cond:
+				self.stopped = True
+				self.cond.notify()
+			self.thread.join()
+		self.video.close()
+
+
+class VideoScene:
+	"""Play back video clips"""
+
+	def __init__(self, display, config):
+		self.display = display
+		self.debug = False
+		self.clips = []
+		self.loops = 1
+		# Number of frame buffers to read ahead into
+		self.readahead = 8
+		# Frames to read per rendered frame, without a thread
+		self.prefetch = 2
+		self.threaded = threading is not None
+		# Scale colors by intensity/255 on the host computer, None to show
+		# them as stored
+		self.intensity = None
+		# Frame rate requested from the render loop, defaults to the display's
+		self.fps = None
+		self.clip = 0
+		self.loop = 0
+		self.reader = None
+		self.table = None
+		if config:
+			if 'debug' in config:
+				self.debug = config['debug']
+			if 'clips' in config:
+				self.clips = config['clips']
+			if 'loops' in config:
+				self.loops = config['loops']
+			if 'readahead' in config:
+				self.readahead = max(1, config['readahead'])
+			if 'prefetch' in config:
+				self.prefetch = max(1, config['prefetch'])
+			if 'threaded' in config:
+				self.threaded = config['threaded'] and threading is not None
+			if 'fps' in config:
+				self.fps = config['fps']
+			if 'intensity' in config:
+				self.intensity = int(round(config['intensity']*255))
+		self.set_table()
+
+	def reset(self):
+		self.clip = 0
+		self.loop = 0
+		self.open_clip()
+
+	def open_clip(self):
+		"""
+		Open the current clip, skipping clips that can't be played on this
+		display.  Returns False when there are no clips left.
+		"""
+		self.stop()
+		display = self.display
+		while self.clip < len(self.clips):
+			filename = self.clips[self.clip]
+			try:
+				video = VideoFile(filename)
+			except (OSError, ValueError) as e:
+				print('VideoScene: failed to open {}: {}'.format(filename, e))
+				self.clip += 1
+				continue
+			if video.columns != display.columns or video.stride != display.stride or video.rotation != display.rotation:
+				print('VideoScene: {} was converted for a {}x{} display rotated {} degrees'.format(filename, video.columns, video.stride, video.rotation))
+				video.close()
+				self.clip += 1
+				continue
+			if not video.num_frames:
+				video.close()
+				self.clip += 1
+				continue
+			self.reader = Readahead(video, self.readahead, self.threaded)
+			# Frame number playback started at, and the video frame shown
+			self.start_frame = None
+			self.shown = -1
+			if self.debug:
+				print('VideoScene: playing {}, {} frames, {} ms'.format(filename, video.num_frames, video.duration))
+			return True
+		return False
+
+	def stop(self):
+		if self.reader:
+			self.reader.close()
+			self.reader = None
+
+	def input(self, button_state):
+		"""
+		Handle button input
+		"""
+		return 0  # signal that we did not handle the input
+
+	def set_intensity(self, value=None):
+		if value is not None:
+			if self.intensity is None:
+				self.intensity = 255
+			self.intensity -= 16
+			if self.intensity <= 0:
+				self.intensity = 255
+			self.set_table()
+		return self.intensity
+
+	def set_table(self):
+		self.table = None
+		if self.intensity is not None and self.intensity < 255 and hasattr(b'', 'translate'):
+			# Lacking bytes.translate(), MicroPython shows frames as stored
+			from icon import scale_table
+			self.table = scale_table(self.intensity)
+
+	def render(self, frame, dropped_frames, fps):
+		reader = self.reader
+		if not reader:
+			return False
+		video = reader.video
+		if self.start_frame is None:
+			self.start_frame = frame
+		# Playback follows the frame number, which also moves ahead by the
+		# frames the render loop dropped, so the video frames that would have
+		# been shown meanwhile are skipped without being copied
+		t_ms = (frame - self.start_frame) * 1000 // fps
+		i = self.shown
+		while i < video.num_frames and video.timestamp(i + 1) <= t_ms:
+			i += 1
+		if i >= video.num_frames:
+			# End of the clip, loop it or move on to the next one
+			self.loop += 1
+			if self.loop >= self.loops:
+				self.loop = 0
+				self.clip += 1
+			if not self.open_clip():
+				return False
+			return self.render(frame, 0, fps)
+		if i != self.shown:
+			if i > self.shown + 1:
+				metrics.incr('video_frames_skipped', i - self.shown - 1)
+			display = self.display
+			fb = display.fb[display.fb_index]
+			if reader.take(i, fb):
+				if self.table:
+					fb[:] = bytes(fb).translate(self.table)
+				display.put_frame()
+				self.shown = i
+			else:
+				# Not read yet, keep showing the previous frame
+				metrics.incr('video_readahead_misses')
+			display.render()
+		if not reader.cond:
+			reader.fill(self.prefetch)
+		return True
+
+	def next_wakeup(self, frame, fps):
+		"""
+		Return the frame number at which the next video frame is due
+		"""
+		if not self.reader or self.start_frame is None:
+			return frame
+		t_ms = self.reader.video.timestamp(self.shown + 1)
+		return max(frame, self.start_frame - (-t_ms * fps // 1000))
+
+	def close(self):
+		"""
+		Stop reading ahead, called before the scene is unloaded
+		"""
+		self.stop()
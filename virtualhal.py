@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+#
+# HAL for running without any LED matrix, MCU or serial port attached.
+#
+# The display is kept as an in-memory buffer of LEDs in physical order.
+# Frames can optionally be written to a frame log (see framelog.py), shown
+# as an ANSI preview in the terminal and/or saved as a sequence of PNGs.
+# Button presses can be scripted from a file to allow for unattended runs.
+#
+# Configure it by adding a "Virtual" section to the config file:
+#
+#   "Virtual": {
+#     "recording": "frames.lmxf",   # write frames to a frame log
+#     "ansi": true,                 # render frames in the terminal
+#     "ansiGain": 4,                # brighten dim pixels in the terminal
+#     "pngDir": "frames",           # write frames as frames/frame-000001.png
+#     "pngScale": 8,                # size of each LED in pixels
+#     "inputScript": "input.txt",   # scripted button presses, see below
+#     "maxFrames": 1000             # exit after this many frames
+#   }
+#
+# The input script has one event per line.  Each line starts with the time
+# in seconds since the HAL was initialized, or '@' followed by a frame
+# number, and is followed by the line the MCU would have sent:
+#
+#   # Switch scene after five seconds, then change intensity at frame 100
+#   5.0 LEFTB_SHRT_PRESS
+#   @100 LEFTB_LONG_PRESS
+#
+import os
+import sys
+import struct
+import time
+import zlib
+from framelog import FrameLogWriter
+
+class VirtualHAL:
+	"""
+	VirtualHAL implements the HAL API on top of an in-memory LED buffer
+	"""
+
+	def __init__(self, config):
+		self.columns = 32
+		self.stride = 8
+		if 'LedMatrix' in config:
+			if 'columns' in config['LedMatrix']:
+				self.columns = config['LedMatrix']['columns']
+			if 'stride' in config['LedMatrix']:
+				self.stride = config['LedMatrix']['stride']
+		self.num_pixels = self.columns * self.stride
+		self.tz_adjust = 0
+		if 'tzOffsetSeconds' in config:
+			self.tz_adjust = config['tzOffsetSeconds']
+		self.leds = bytearray(self.num_pixels*3)
+		self.frame = 0
+		self.t_init = time.time()
+		self.rtc = 0
+		self.enable_auto_time = False
+		self.reboot_at = 0
+		self.recorder = None
+		self.recording = None
+		self.ansi = False
+		self.ansi_gain = 4
+		self.png_dir = None
+		self.png_scale = 8
+		self.max_frames = 0
+		self.events = []
+		conf = config.get('Virtual')
+		if conf:
+			if 'recording' in conf:
+				self.recording = conf['recording']
+			if 'ansi' in conf:
+				self.ansi = conf['ansi']
+			if 'ansiGain' in conf:
+				self.ansi_gain = conf['ansiGain']
+			if 'pngDir' in conf:
+				self.png_dir = conf['pngDir']
+			if 'pngScale' in conf:
+				self.png_scale = conf['pngScale']
+			if 'maxFrames' in conf:
+				self.max_frames = conf['maxFrames']
+			if 'inputScript' in conf:
+				self.load_input_script(conf['inputScript'])
+		if self.png_dir and not os.path.isdir(self.png_dir):
+			os.makedirs(self.png_dir)
+		self.reset()
+
+	def load_input_script(self, filename):
+		"""
+		Load scripted events, see the top of this file for the format
+		"""
+		f = open(filename)
+		for line in f:
+			line = line.strip()
+			if not line or line.startswith('#'):
+				continue
+			when, event = line.split(None, 1)
+			if when.startswith('@'):
+				self.events.append((None, int(when[1:]), event))
+			else:
+				self.events.append((float(when), None, event))
+		f.close()
+
+	def process_input(self):
+		"""
+		Return the next scripted event that is due, if any
+		"""
+		if not self.events:
+			return None
+		t, frame, event = self.events[0]
+		if t is not None and time.time() - self.t_init < t:
+			return None
+		if frame is not None and self.frame < frame:
+			return None
+		self.events.pop(0)
+		return event
+
+	def wait_input(self, timeout_ms):
+		"""
+		Sleep for up to timeout_ms milliseconds or until the next scripted
+		time based event is due.  Returns True if an event is due.
+		"""
+		if self.events:
+			t, frame, event = self.events[0]
+			if t is not None:
+				remaining = t - (time.time() - self.t_init)
+				if remaining * 1000 < timeout_ms:
+					if remaining > 0:
+						time.sleep(remaining)
+					return True
+			elif self.frame >= frame:
+				return True
+		time.sleep(timeout_ms / 1000.0)
+		return False
+
+	def reset(self):
+		"""
+		(Re-)open the frame log and clear the display
+		"""
+		if self.recorder:
+			self.recorder.close()
+			self.recorder = None
+		if self.recording:
+			self.recorder = FrameLogWriter(self.recording, self.num_pixels)
+		if self.ansi:
+			# Clear terminal
+			sys.stdout.write('\x1b[2J')
+		self.clear_display()
+
+	def init_display(self, num_pixels=256):
+		if num_pixels != self.num_pixels:
+			print('VirtualHAL: display initialized with {} pixels but configured for {}'.format(num_pixels, self.num_pixels))
+		self.clear_display()
+
+	def clear_display(self):
+		for i in range(self.num_pixels):
+			self.put_pixel(i, 0, 0, 0)
+		self.update_display(self.num_pixels)
+
+	def update_display(self, num_modified_pixels=None):
+		self.frame += 1
+		if self.recorder:
+			t_ms = int((time.time() - self.t_init) * 1000)
+			self.recorder.end_frame(t_ms)
+		if self.ansi:
+			self.write_ansi()
+		if self.png_dir:
+			self.write_png('{}/frame-{:06d}.png'.format(self.png_dir, self.frame))
+		if self.max_frames and self.frame >= self.max_frames:
+			print('VirtualHAL: rendered {} frames, exiting'.format(self.frame))
+			self.close()
+			sys.exit(0)
+
+	def put_pixel(self, addr, r, g, b):
+		addr %= self.num_pixels
+		offset = addr*3
+		leds = self.leds
+		if leds[offset] == r and leds[offset+1] == g and leds[offset+2] == b:
+			return
+		leds[offset] = r
+		leds[offset+1] = g
+		leds[offset+2] = b
+		if self.recorder:
+			self.recorder.put_pixel(addr, r, g, b)
+
+	def get_pixel(self, x, y):
+		"""
+		Get the color of the LED at (x,y), assuming the same zig-zag layout
+		as the LedMatrix class with no rotation
+		"""
+		stride = self.stride
+		addr = x*stride
+		if x & 1:
+			addr += stride - 1 - y
+		else:
+			addr += y
+		offset = addr*3
+		return self.leds[offset], self.leds[offset+1], self.leds[offset+2]
+
+	def write_ansi(self):
+		"""
+		Render the display in the terminal with 24-bit colors
+		"""
+		gain = self.ansi_gain
+		out = ['\x1b[H']
+		for y in range(self.stride):
+			for x in range(self.columns):
+				r, g, b = self.get_pixel(x, y)
+				out.append('\x1b[38;2;{};{};{}m██'.format(min(r*gain, 255), min(g*gain, 255), min(b*gain, 255)))
+			out.append('\x1b[0m\n')
+		sys.stdout.write(''.join(out))
+		sys.stdout.flush()
+
+	def write_png(self, filename):
+		"""
+		Save the display as an RGB PNG file
+		"""
+		scale = self.png_scale
+		width = self.columns * scale
+		height = self.stride * scale
+		raw = bytearray()
+		for y in range(self.stride):
+			row = bytearray([0])  # filter type: none
+			for x in range(self.columns):
+				row.extend(bytes(self.get_pixel(x, y)) * scale)
+			raw.extend(row * scale)
+
+		def chunk(tag, data):
+			crc = zlib.crc32(tag + data) & 0xffffffff
+			return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', crc)
+
+		f = open(filename, 'wb')
+		f.write(b'\x89PNG\r\n\x1a\n')
+		f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+		f.write(chunk(b'IDAT', zlib.compress(bytes(raw))))
+		f.write(chunk(b'IEND', b''))
+		f.close()
+
+	def set_rtc(self, t):
+		# Nothing to synchronize, just remember what we were told
+		self.rtc = int(t)
+
+	def set_auto_time(self, enable=True):
+		self.enable_auto_time = enable
+
+	def suspend_host(self, restart_timeout_seconds):
+		if restart_timeout_seconds < 15:
+			return
+		self.reboot_at = time.time() + restart_timeout_seconds
+		print('VirtualHAL: host suspend requested, wakeup in {}s'.format(restart_timeout_seconds))
+
+	def close(self):
+		if self.recorder:
+			self.recorder.close()
+			self.recorder = None
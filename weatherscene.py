@@ -1,14 +1,42 @@
 # Render the current weather forecast from SMHI.se
 #
+# The forecast is fetched in the background, in a thread on the host computer
+# and without blocking as a job stepped by the render loop on MCUs, and the
+# most recent one is kept in a small cache file so that it can be shown
+# right away after a restart.
+# Failed fetches are retried with exponential backoff and jitter.
+#
+# A forecast covers the next 24 hours (`hours`), so the scene moves on to the
+# next hour by itself and only fetches a new one when it gets old or is
+# about to run out (less than `minHours` left).  With e.g. "forecastSlots": 3
+# and "forecastStep": 3, the forecast for 3, 6 and 9 hours from now is shown
+# after the current weather.
+#
 import time
-import gc
+import json
+try:
+	import uos as os
+except ImportError:
+	import os
+try:
+	import threading
+except ImportError:
+	threading = None
+from memmanager import manager as memory
+from metrics import metrics
+from jobqueue import jobs
 try:
 	import urequests as requests
 except ImportError:
 	import requests
+try:
+	import nbrequests
+except ImportError:
+	nbrequests = None
 
 # Local imports
 from pixelfont import PixelFont
+from forecastscanner import ForecastScanner, Timeline
 from icon import Icon
 
 # Based on demoscene.py
@@ -39,6 +67,45 @@ class WeatherScene:
 		self.temperature = 0
 		self.wind_speed = 0
 		self.last_refreshed_at = 0
+		# Fetch a new forecast when this old, or when less than min_hours of
+		# it are left
+		self.refresh_interval = 10800
+		self.hours = 24
+		self.min_hours = 6
+		# Upcoming hours to show after the current weather, step_hours apart
+		self.forecast_slots = 0
+		self.forecast_step = 3
+		# Delay before the first retry after a failed fetch, doubled for every
+		# failure up to refresh_interval
+		self.retry_delay = 30
+		self.failures = 0
+		# Time of the next fetch attempt
+		self.next_attempt = 0
+		# Last known good forecast, loaded at startup
+		self.cache_file = 'weather/forecast.json'
+		# Set by runtimes that call refresh() in the background themselves
+		self.background_refresh = False
+		# Fetch job on MCUs (see jobqueue.py), and the thread on the host
+		self.task = None
+		self.thread = None
+		# Validators of the forecast shown, for conditional requests
+		self.etag = None
+		self.last_modified = None
+		# Parser for forecasts, with its buffer allocated up front
+		self.scanner = ForecastScanner()
+		# Most recently fetched forecast not yet picked up by the scene
+		self.forecast = None
+		# Forecast shown, its entry for the next hour and the time at which
+		# the one after it is due
+		self.timeline = None
+		self.slot = -1
+		self.slot_until = 0
+		# 0 for the current weather, otherwise the upcoming slot being shown
+		self.view = 0
+		self.view_text = None
+		self.icon_filename = None
+		# Set once a forecast has been shown or loaded from the cache
+		self.have_forecast = False
 		# http://opendata.smhi.se/apidocs/metfcst/parameters.html#parameter-wsymb
 		self.symbol = None
 		self.symbol_to_icon = [
@@ -84,64 +151,393 @@ class WeatherScene:
 			self.lat = config['lat']
 		if 'lon' in config:
 			self.lon = config['lon']
-
+		if 'refreshInterval' in config:
+			self.refresh_interval = config['refreshInterval']
+		if 'retryDelay' in config:
+			self.retry_delay = config['retryDelay']
+		if 'hours' in config:
+			self.hours = max(1, config['hours'])
+		if 'minHours' in config:
+			self.min_hours = config['minHours']
+		if 'forecastSlots' in config:
+			self.forecast_slots = config['forecastSlots']
+		if 'forecastStep' in config:
+			self.forecast_step = max(1, config['forecastStep'])
+		if 'cacheFile' in config:
+			self.cache_file = config['cacheFile']
+		self.load_cache()
 
 	def reset(self):
 		"""
 		This method is called before transitioning to this scene.
 		Use it to (re-)initialize any state necessary for your scene.
 		"""
+		self.prepare()
+		self.activate()
+
+	def prepare(self):
+		"""
+		This method is called by the render loop ahead of transitioning to
+		this scene.  The cached forecast is shown right away, and a new one
+		is fetched in the background if it's due.
+		"""
+		if self.background_refresh:
+			return
+		if threading:
+			if not self.thread:
+				self.thread = threading.Thread(target=self.run_refresh)
+				self.thread.daemon = True
+				self.thread.start()
+		elif not self.task and self.refresh_due():
+			# Stepped by the render loop in the time to spare between frames
+			self.task = self.fetch(nbrequests is None)
+			jobs.add(self.task)
+
+	def run_refresh(self):
+		"""
+		Keep the forecast fresh, called from a thread on the host computer
+		"""
+		me = threading.current_thread()
+		try:
+			while self.thread is me:
+				try:
+					self.refresh()
+				except Exception as e:
+					# E.g. a malformed response, retried like any failure
+					print('WeatherScene: failed to refresh forecast: {}'.format(e))
+					metrics.incr('network_errors')
+				time.sleep(max(1, min(60, self.next_attempt - time.time())))
+		finally:
+			# Let prepare() start a new thread
+			if self.thread is me:
+				self.thread = None
+
+	def activate(self):
+		"""
+		This method is called when transitioning to this scene after it
+		has been prepared.
+		"""
 		self.next_frame_at = 0
+		self.view = 0
+		self.slot = -1
+		self.apply_forecast()
+		self.select_slot(time.time())
 		self.reset_icon()
+
+	def refresh_due(self):
 		t = time.time()
-		if t < self.last_refreshed_at + 1800:
+		# The clock may have been set back since the last fetch, e.g. on an
+		# MCU which didn't know the time yet
+		return t >= self.next_attempt or t < self.last_refreshed_at
+
+	def refresh(self):
+		"""
+		Fetch a new forecast from SMHI if the current one is too old.
+		The forecast is picked up by the scene in apply_forecast(), which
+		allows for calling this from a different thread than the one
+		rendering the scene.  Returns True if a new forecast was fetched.
+		"""
+		fetched = False
+		for fetched in self.fetch():
+			pass
+		return fetched is True
+
+	def fetch(self, blocking=True):
+		"""
+		Generator doing the work of refresh() a step at a time, yielding
+		between steps and finally True if a new forecast was fetched.  With
+		blocking=False, it never waits for the network.
+		"""
+		if not self.refresh_due():
 			return
+		t = time.time()
+		# Failures push the next attempt back until a fetch succeeds
+		self.retry_later(t)
 
 		# fetch a new forecast from SMHI
 		url = '{}/api/category/pmp3g/version/2/geotype/point/lon/{}/lat/{}/data.json'.format(self.api_url, self.lon, self.lat)
-		print('WeatherScene: reset called, requesting weather forecast from: {}'.format(url))
+		print('WeatherScene: requesting weather forecast from: {}'.format(url))
+
+		# Ask for the forecast only if it has changed since the one we have
+		headers = self.headers
+		current = self.forecast or self.timeline
+		if current and (self.etag or self.last_modified):
+			headers = dict(self.headers)
+			if self.etag:
+				headers['If-None-Match'] = self.etag
+			if self.last_modified:
+				headers['If-Modified-Since'] = self.last_modified
+		# The entry for the current hour and the next self.hours hours
+		timeline = Timeline(self.hours + 1)
+		# Make room for the TLS handshake, and take it back however the
+		# request ends, including when the job is dropped
+		memory.release('tls')
+		try:
+			t_fetch = metrics.start()
+			metrics.incr('network_requests')
+			if blocking:
+				response = yield from self.request(url, headers, timeline)
+			else:
+				response = yield from self.request_nonblocking(url, headers, timeline)
+			metrics.incr('network_bytes_read', self.scanner.bytes_read)
+			metrics.stop('network_fetch_us', t_fetch)
+		finally:
+			memory.restore('tls')
+		if not response:
+			metrics.incr('network_errors')
+			return
+		status, response_headers = response
+		if status == 304 and current:
+			print('WeatherScene: forecast not modified')
+			metrics.incr('network_not_modified')
+			self.last_refreshed_at = t
+			self.failures = 0
+			self.schedule(current)
+			self.save_cache(current, t)
+			return
+		if status != 200:
+			print('WeatherScene: failed to request {}: status {}'.format(url, status))
+			metrics.incr('network_errors')
+			return
 
-		r = requests.get(url, headers=self.headers, stream=True)
-		if r.status_code != 200:
-			print('WeatherScene: failed to request {}: status {}'.format(url, r.status_code))
+		if timeline.end() <= t:
+			print('WeatherScene: failed to find a forecast for the coming hours')
 			return
+		if self.debug:
+			print('WeatherScene: forecast for {} hours'.format((timeline.end() - t) // 3600))
+		yield
+		self.last_refreshed_at = t
+		self.failures = 0
+		self.etag = response_headers.get('etag')
+		self.last_modified = response_headers.get('last-modified')
+		self.schedule(timeline)
+		self.save_cache(timeline, t)
+		self.forecast = timeline
+		yield True
 
-		print('WeatherScene: parsing weather forecast')
-		next_hour = int(time.time())
-		next_hour = next_hour - next_hour%3600 + 3600
-		expected_timestamp = '{:04d}-{:02d}-{:02d}T{:02d}'.format(*time.gmtime(next_hour))
-		temp, ws, symb = self.get_forecast(r.raw, expected_timestamp)
+	def request(self, url, headers, timeline):
+		"""
+		Fetch the forecast into the timeline with blocking I/O, yielding
+		between chunks.  Returns (status code, response headers), or None if
+		the request failed.
+		"""
+		try:
+			r = requests.get(url, headers=headers, stream=True)
+		except OSError as e:
+			print('WeatherScene: failed to request {}: {}'.format(url, e))
+			return None
+		if r.status_code == 200:
+			yield
+			print('WeatherScene: parsing weather forecast')
+			try:
+				yield from self.scanner.scan(r.raw, timeline, int(time.time()))
+			except OSError as e:
+				# Connection lost, go with what we got
+				print('WeatherScene: failed to read forecast: {}'.format(e))
+				metrics.incr('network_errors')
 		# Close socket and free up RAM
 		r.close()
-		r = None
-		gc.collect()
+		return (r.status_code, r.headers)
 
-		if temp == None:
-			print('WeatherScene: failed to find forecast for timestamp prefix: {}'.format(expected_timestamp))
-			return
-		self.temperature = float(temp.decode())
-		self.wind_speed = float(ws.decode())
-		self.symbol = int(symb.decode())
-		self.last_refreshed_at = t
+	def request_nonblocking(self, url, headers, timeline):
+		"""
+		Fetch the forecast into the timeline as a job stepped by the render
+		loop, parsing the response as it arrives.  Yields True while making
+		progress.  Returns (status code, response headers), or None if the
+		request failed.
+		"""
+		self.scanner.begin(timeline, int(time.time()))
+		req = nbrequests.Request(url, self.scanner.feed, headers)
+		try:
+			while req.state != nbrequests.DONE:
+				yield req.step()
+		finally:
+			req.close()
+		if req.error:
+			if req.status_code is None:
+				print('WeatherScene: failed to request {}: {}'.format(url, req.error))
+				return None
+			# Connection lost, go with what we got
+			print('WeatherScene: failed to read forecast: {}'.format(req.error))
+			metrics.incr('network_errors')
+		return (req.status_code, req.headers)
 
-		filename = self.symbol_to_icon[self.symbol]
-		if not filename:
+	def schedule(self, timeline):
+		"""
+		Plan the next fetch for when the forecast gets old or runs short
+		"""
+		t = self.last_refreshed_at
+		t_short = timeline.end() - self.min_hours*3600
+		self.next_attempt = max(t + self.retry_delay, min(t + self.refresh_interval, t_short))
+
+	def retry_later(self, t):
+		"""
+		Back off exponentially, with jitter so that many displays don't
+		retry in lockstep
+		"""
+		delay = min(self.refresh_interval, self.retry_delay << min(self.failures, 16))
+		self.failures += 1
+		delay = delay//2 + (delay//2) * os.urandom(1)[0] // 255
+		self.next_attempt = t + max(1, delay)
+
+	def load_cache(self):
+		"""
+		Pick up the last known good forecast from the cache file
+		"""
+		try:
+			f = open(self.cache_file)
+			obj = json.loads(f.read())
+			f.close()
+			offsets = obj['offsets']
+			timeline = Timeline(len(offsets))
+			timeline.clear(obj['base'])
+			for i in range(len(offsets)):
+				timeline.offsets[i] = offsets[i]
+				timeline.temperature[i] = obj['temperature'][i]
+				timeline.wind_speed[i] = obj['windSpeed'][i]
+				timeline.symbol[i] = obj['symbol'][i]
+			timeline.size = len(offsets)
+			self.last_refreshed_at = obj['fetchedAt']
+			self.etag = obj.get('etag')
+			self.last_modified = obj.get('lastModified')
+			self.schedule(timeline)
+			self.forecast = timeline
+		except (OSError, ValueError, KeyError, IndexError, TypeError) as e:
+			if self.debug:
+				print('WeatherScene: no cached forecast in {}: {}'.format(self.cache_file, e))
+
+	def save_cache(self, timeline, t):
+		"""
+		Write the forecast to the cache file, atomically so that a crash
+		never leaves half of it
+		"""
+		n = timeline.size
+		obj = {
+			'base': timeline.base,
+			'offsets': list(timeline.offsets)[:n],
+			'temperature': list(timeline.temperature)[:n],
+			'windSpeed': list(timeline.wind_speed)[:n],
+			'symbol': list(timeline.symbol)[:n],
+			'fetchedAt': t,
+			'etag': self.etag,
+			'lastModified': self.last_modified,
+		}
+		tmp = self.cache_file + '.tmp'
+		try:
+			f = open(tmp, 'w')
+			f.write(json.dumps(obj))
+			f.close()
+			try:
+				os.rename(tmp, self.cache_file)
+			except OSError:
+				# FAT filesystems on MCUs don't replace existing files
+				os.remove(self.cache_file)
+				os.rename(tmp, self.cache_file)
+		except OSError as e:
+			print('WeatherScene: failed to write {}: {}'.format(self.cache_file, e))
+
+	def apply_forecast(self):
+		"""
+		Switch to the most recently fetched forecast, if any
+		"""
+		timeline = self.forecast
+		if not timeline:
 			return
+		self.forecast = None
+		self.timeline = timeline
+		self.have_forecast = True
+		# Start over with the current weather
+		self.view = 0
+		self.slot = -1
+		self.select_slot(time.time())
+
+	def select_slot(self, t):
+		"""
+		Show the forecast for the hour after t, loading its icon if it
+		differs from the one shown.  Returns True if the slot changed.
+		"""
+		timeline = self.timeline
+		if not timeline:
+			return False
+		i = timeline.slot(t)
+		if i < 0 or i == self.slot:
+			return False
+		self.slot = i
+		self.temperature, self.wind_speed, self.symbol, t_slot = timeline.values(i)
+		self.slot_until = t_slot
+		if self.load_icon(self.icon_for(self.symbol, t_slot)):
+			self.reset_icon()
+		return True
 
+	def icon_for(self, symbol, t):
+		"""
+		Return the filename of the icon for a weather symbol at time t
+		"""
+		filename = None
+		if 0 <= symbol < len(self.symbol_to_icon):
+			filename = self.symbol_to_icon[symbol]
 		if type(filename) == list:
-			lt = time.localtime(next_hour)
+			lt = time.localtime(t)
 			if lt[3] < 7 or lt[3] > 21:
 				# Assume night icon
 				filename = filename[0]
 			else:
 				filename = filename[1]
+		return filename
+
+	def load_icon(self, filename):
+		"""
+		Switch to another icon, returns False if it's already shown
+		"""
+		if self.icon and filename == self.icon_filename:
+			return False
 		if self.icon:
 			# MicroPython does not support destructors so we need to manually
 			# close the file we have opened
 			self.icon.close()  # Close icon file
-		self.icon = Icon(self.dir_prefix + filename)
+			self.icon = None
+		self.icon_filename = filename
+		if not filename:
+			return True
+		try:
+			self.icon = Icon(self.dir_prefix + filename)
+		except (OSError, ValueError) as e:
+			# Show the forecast without an icon
+			print('WeatherScene: failed to load icon {}: {}'.format(filename, e))
+			return True
 		self.icon.set_intensity(self.intensity)
-		self.reset_icon()
+		return True
+
+	def show_view(self, view):
+		"""
+		Switch to the forecast `view` steps ahead, returns False when the
+		forecast doesn't reach that far
+		"""
+		timeline = self.timeline
+		t = timeline.time(self.slot) + view*self.forecast_step*3600
+		i = timeline.slot(t - 1)
+		if i <= self.slot or timeline.time(i) < t:
+			return False
+		temperature, wind_speed, symbol, t_slot = timeline.values(i)
+		self.view = view
+		self.view_text = '{:02d} {:.2g}\''.format(time.localtime(t_slot)[3], temperature)
+		self.load_icon(self.icon_for(symbol, t_slot))
+		self.reset_icon(1, 2000)
+		return True
+
+	def close(self):
+		"""
+		Close the icon file and stop fetching, called before the scene is
+		unloaded
+		"""
+		self.thread = None
+		if self.task:
+			jobs.remove(self.task)
+			self.task.close()
+			self.task = None
+		if self.icon:
+			self.icon.close()
+			self.icon = None
 
 	def input(self, button_state):
 		"""
@@ -166,21 +562,40 @@ class WeatherScene:
 		requested frames per second (FPS).
 		"""
 
+		if self.task and not jobs.active(self.task):
+			# Done fetching (MCUs)
+			self.task = None
+		if self.forecast:
+			# Show a new forecast as soon as it's there
+			self.apply_forecast()
+			self.next_frame_at = frame
+		if not self.have_forecast:
+			# Nothing to show until the first forecast has been fetched, keep
+			# the scene around while fetching it
+			return self.task is not None
+
 		if frame < self.next_frame_at:
 			return True
+		if not self.view and time.time() >= self.slot_until and self.select_slot(time.time()):
+			# The hour rolled over
+			self.next_frame_at = frame
 
 		self.remaining_frames -= 1
 		n = self.num_frames
-		index = n - (self.remaining_frames % n) - 1
-		# Calculate next frame number
-		self.next_frame_at = frame + int(fps * self.icon.frame_length()/1000)
 		# Render frame
 		display = self.display
 		intensity = self.intensity
-		self.icon.blit(display, 0 if display.columns == 32 else 4, 0)
+		if self.icon:
+			# Calculate next frame number
+			self.next_frame_at = frame + int(fps * self.icon.frame_length()/1000)
+			self.icon.blit(display, 0 if display.columns == 32 else 4, 0)
+		else:
+			self.next_frame_at = frame + fps
 
 		# Render text
-		if self.remaining_frames >= n:
+		if self.view:
+			text = self.view_text
+		elif self.remaining_frames >= n:
 			text = '{:.2g}\'c'.format(self.temperature)
 		else:
 			text = '{:.2g}m/s'.format(self.wind_speed)
@@ -190,80 +605,32 @@ class WeatherScene:
 
 		display.render()
 		if self.remaining_frames == 0:
+			if self.view < self.forecast_slots and self.show_view(self.view + 1):
+				return True
 			return False
 		return True
 
-	def reset_icon(self):
+	def next_wakeup(self, frame, fps):
+		"""
+		Return the frame number at which the next icon frame is due
+		"""
+		return self.next_frame_at
+
+	def reset_icon(self, loops=2, min_ms=4000):
+		"""
+		Show the icon `loops` times, and for at least min_ms
+		"""
 		if not self.icon:
+			# Show the temperature and wind speed for a few seconds each
+			self.num_frames = 3
+			self.remaining_frames = 3*loops
 			return
 		self.icon.reset()
 		self.num_frames = self.icon.num_frames
-		self.remaining_frames = self.num_frames*2
+		self.remaining_frames = self.num_frames*loops
 		t_icon = self.icon.length_total()
 		# Ensure a minimum display time
 		for i in range(1,6):
-			if t_icon*i >= 4000:
+			if t_icon*i >= min_ms:
 				break
 			self.remaining_frames += self.num_frames
-
-	def get_forecast(self, f, validTime):
-		"""
-		Extract temperature, windspeed, weather symbol from JSON response
-		"""
-		timeStr = None
-		tempStr = None
-		wsStr = None
-		symbStr = None
-		while True:
-			v = f.read(1)
-			if v != b'"':
-				continue
-			s = self.next_string(f)
-			if not timeStr:
-				if not s.startswith(b'validTime'):
-					continue
-				timeStr = self.next_string(f, 2)
-				if not timeStr.startswith(validTime):
-					timeStr = None
-					continue
-			elif not tempStr and s == b't':
-				tempStr = self.next_array_entry(f)
-			elif not wsStr and s == b'ws':
-				wsStr = self.next_array_entry(f)
-			elif not symbStr and s == b'Wsymb2':
-				symbStr = self.next_array_entry(f)
-			elif timeStr and tempStr and wsStr and symbStr:
-				break
-		return (tempStr, wsStr, symbStr)
-
-	def next_string(self, f, start_at = 0):
-		"""
-		Extract string value from JSON
-		"""
-		if start_at:
-			f.read(start_at)
-		stash = bytearray()
-		while True:
-			c = f.read(1)
-			if c == b'"':
-				break
-			stash.append(c[0])
-		return bytes(stash)
-
-	def next_array_entry(self, f):
-		"""
-		Extract first array entry from JSON
-		"""
-		in_array = False
-		stash = bytearray()
-		while True:
-			c = f.read(1)
-			if not in_array:
-				if c != b'[':
-					continue
-				in_array = True
-				continue
-			if c == b']' or c == b' ' or c == b',':
-				break
-			stash.append(c[0])
-		return bytes(stash)